@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from app.env import Env
+from app.scheduler import Scheduler
+from app.twitter import TwitterUser
+
+
+class AsyncCrawler:
+    def __init__(self, crawling_tweets: Callable[[TwitterUser], int], mode: str, scheduler: Scheduler) -> None:
+        self._crawling_tweets: Callable[[TwitterUser], int] = crawling_tweets
+        self._mode: str = mode
+        self._scheduler: Scheduler = scheduler
+        self._concurrency: int = int(Env.get_environment('CRAWL_CONCURRENCY', default='4'))
+        # tweepy, psycopg2 and the downloaders are blocking, so each crawl runs on a worker thread
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=self._concurrency)
+
+        logger.debug(f'AsyncCrawler setting info. concurrency={self._concurrency}')
+
+    async def _crawl(self, user: TwitterUser, semaphore: asyncio.Semaphore) -> int:
+        async with semaphore:
+            logger.info(f'Crawling start. user = {user.id}, mode={self._mode}')
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, self._crawling_tweets, user)
+            except Exception as e:
+                logger.exception(f'Crawling error. user = {user.id}, exception={e.args}')
+                return 0
+
+    async def _crawl_user(self, user: TwitterUser, semaphore: asyncio.Semaphore) -> None:
+        while True:
+            new_media_count: int = await self._crawl(user, semaphore)
+
+            self._scheduler.complete(user, new_media_count)
+            sleep_seconds: float = self._scheduler.get_sleep_seconds(user)
+            logger.info(f'Interval. user = {user.id}, sleep {sleep_seconds:.0f} seconds.')
+            await asyncio.sleep(sleep_seconds)
+
+    async def crawl(self, user_list: List[TwitterUser]) -> None:
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self._concurrency)
+        await asyncio.gather(*[self._crawl_user(user, semaphore) for user in user_list])
+
+    def main(self, user_list: List[TwitterUser]) -> None:
+        try:
+            asyncio.run(self.crawl(user_list))
+        finally:
+            self._executor.shutdown(wait=False)
+
+
+logger: logging.Logger = logging.getLogger(__name__)
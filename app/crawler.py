@@ -1,70 +1,304 @@
 #!/usr/bin/python3
 
+import dataclasses
+import hashlib
 import logging
 import os
 import re
-import shutil
+import threading
 import time
-import urllib.request
-import urllib.error
+import urllib.parse
 
+import requests
 import tweepy
+from concurrent.futures import Future, ThreadPoolExecutor
 from googleapiclient.errors import HttpError
 from retry import retry
-from typing import List, Tuple, Dict
+from typing import Any, Iterator, List, Optional, Set, Tuple, Dict
 
+from app.async_crawler import AsyncCrawler
+from app.downloader import Downloader, RETRY_EXCEPTIONS
 from app.env import Env
-from app.google_photos import GooglePhotos
+from app.errors import PERMANENT, QUOTA, TRANSIENT, ClassifiedError, PermanentError, classify, error_counter
+from app.google_photos import BATCH_CREATE_LIMIT, GooglePhotos, GoogleApiResponseNG
 from app.log import Log
+from app.perceptual_hash import PerceptualHash, PerceptualHashIndex
+from app.pipeline import Pipeline, PipelineError
+from app.scheduler import Scheduler
 from app.store import Store
-from app.twitter import Twitter, TwitterUser, TweetMedia
+from app.twitter import CrawlProgress, FavoriteSnapshot, Twitter, TwitterUser, TweetMedia
+
+
+@dataclasses.dataclass
+class PendingMediaItem(object):
+    """Media uploaded to Google Photos, whose media item is created later in a batch."""
+    upload_token: str
+    description: str
+    url: str
+    user_id: str
+    media_hash: str
+    phash: Optional[int] = None
+    is_saved: bool = False
+
+
+@dataclasses.dataclass
+class MediaTask(object):
+    tweet_media: TweetMedia
+    url: str
+    description: str
+    media_url: str = ''
+    download_path: str = ''
+    media_hash: str = ''
+    is_saved: bool = False
+    media_items: List[PendingMediaItem] = dataclasses.field(default_factory=list)
 
 
 class Crawler:
     def __init__(self) -> None:
         self._save_mode: str = Env.get_environment('SAVE_MODE', default='local')
+        self._engine: str = Env.get_environment('CRAWLER_ENGINE', default='sequential')
         self.twitter: Twitter = Twitter()
         self.store: Store = Store()
+        self.store.migrate()
+        self.twitter.known_tweet_ids = self.fetch_known_tweet_ids
+        self.downloader: Downloader = Downloader()
         if self._save_mode == 'google':
             self.google_photos: GooglePhotos = GooglePhotos()
+            self.google_photos.load_album_id = self.load_album_id
+            self.google_photos.store_album_id = self.store_album_id
+            self.google_photos.start_token_refresher()
         self._download_dir: str = './download'
+        self._download_workers: int = int(Env.get_environment('DOWNLOAD_WORKERS', default='8'))
+        self._download_host_limit: int = int(Env.get_environment('DOWNLOAD_HOST_LIMIT', default='4'))
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_semaphores_lock: threading.Lock = threading.Lock()
+        # media_hash -> (url, user_id) of the media waiting for its media item, to skip duplicates in the batch
+        self._pending_media_hashes: Dict[str, Tuple[str, str]] = {}
+        self._pending_media_lock: threading.Lock = threading.Lock()
+        self._retry_lock: threading.Lock = threading.Lock()
+        # failed_upload_media is retried at most once in this interval, however many users are crawled
+        self._retry_interval_seconds: float = \
+            float(Env.get_environment('RETRY_INTERVAL', default=Env.get_environment('INTERVAL', default='5'))) * 60
+        self._retried_at: Optional[float] = None
+        self._retry_max_per_cycle: int = int(Env.get_environment('RETRY_MAX_PER_CYCLE', default='100'))
+        self._retry_max_attempts: int = int(Env.get_environment('RETRY_MAX_ATTEMPTS', default='10'))
+        self._retry_backoff_seconds: float = float(Env.get_environment('RETRY_BACKOFF_SECONDS', default='300'))
+        self._retry_backoff_max_seconds: float = \
+            float(Env.get_environment('RETRY_BACKOFF_MAX_SECONDS', default=str(24 * 60 * 60)))
+        # The last error in saving media on each thread, which decides what is done with a failed retry
+        self._save_errors: threading.local = threading.local()
+        # Striped locks keep two workers from uploading the same content at the same time
+        self._media_hash_locks: List[threading.Lock] = [threading.Lock() for _ in range(64)]
+        self._streaming_upload_enabled: bool = self._save_mode == 'google' and \
+            Env.get_bool_environment('GOOGLE_STREAMING_UPLOAD_ENABLED', default=False)
+        self._pipeline_enabled: bool = Env.get_bool_environment('CRAWL_PIPELINE_ENABLED', default=False)
+        self._perceptual_dedup_enabled: bool = Env.get_bool_environment('PERCEPTUAL_DEDUP_ENABLED', default=False)
+        self._perceptual_dedup_action: str = Env.get_environment('PERCEPTUAL_DEDUP_ACTION', default='skip')
+        self._perceptual_index: PerceptualHashIndex = PerceptualHashIndex(
+            threshold=int(Env.get_environment('PERCEPTUAL_DEDUP_THRESHOLD', default='6')))
+        self._is_perceptual_index_loaded: bool = False
+        self._perceptual_index_lock: threading.Lock = threading.Lock()
 
         os.makedirs(self._download_dir, exist_ok=True)
 
-    @staticmethod
-    @retry(urllib.error.HTTPError, tries=3, delay=2, backoff=2)
-    def download_media(media_url: str, download_path: str) -> None:
-        os.makedirs(os.path.dirname(download_path), exist_ok=True)
-        logger.debug(f'Download file. url={media_url}, path={download_path}')
-        urllib.request.urlretrieve(media_url, download_path)
+    def download_media(self, media_url: str, download_path: str) -> str:
+        return self.downloader.download(media_url, download_path)
+
+    @retry(RETRY_EXCEPTIONS + (GoogleApiResponseNG, ConnectionError, TimeoutError), tries=3, delay=2, backoff=2)
+    def stream_media(self, media_url: str, file_name: str) -> Tuple[str, str]:
+        logger.debug(f'Stream file. url={media_url}, file_name={file_name}')
+        media_hash: 'hashlib._Hash' = hashlib.sha256()
+        with self.downloader.open_stream(media_url) as (chunks, size):
+            upload_token: str = self.google_photos.upload_stream(file_name, Downloader.hash_chunks(chunks, media_hash),
+                                                                 size)
+        return upload_token, media_hash.hexdigest()
+
+    def record_save_error(self, error: BaseException) -> None:
+        self._save_errors.last_error = error
+
+    def pop_save_error(self) -> Optional[BaseException]:
+        last_error: Optional[BaseException] = getattr(self._save_errors, 'last_error', None)
+        self._save_errors.last_error = None
+        return last_error
+
+    def _get_host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host: str = urllib.parse.urlparse(url).netloc
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self._download_host_limit)
+            return self._host_semaphores[host]
+
+    def _get_media_hash_lock(self, media_hash: str) -> threading.Lock:
+        return self._media_hash_locks[int(media_hash[:8], 16) % len(self._media_hash_locks)]
+
+    def find_uploaded_media(self, media_hash: str) -> Optional[Tuple[str, str]]:
+        with self._pending_media_lock:
+            pending_media: Optional[Tuple[str, str]] = self._pending_media_hashes.get(media_hash)
+        if pending_media is not None:
+            return pending_media
+        try:
+            return self.store.fetch_uploaded_media_hash(media_hash)
+        except Exception as e:
+            logger.exception(f'Fetch failed. media_hash={media_hash}, exception={e.args}')
+            return None
+
+    def store_media_hash(self, media_hash: str, url: str, user_id: str) -> None:
+        try:
+            self.store.insert_uploaded_media_hash(media_hash, url, user_id)
+        except Exception as e:
+            logger.exception(f'Insert failed. media_hash={media_hash}, url={url}, exception={e.args}')
 
     def upload_google_photos(self, media_path: str, description: str) -> bool:
         try:
-            self.google_photos.upload_media(media_path, description)
+            # GooglePhotos sends the bytes on a connection per upload worker, so the uploads run in parallel
+            status: Dict[str, Any] = self.google_photos.upload_media(media_path, description)
         except HttpError as error:
             logger.exception(f'HTTP status={error.resp.reason}')
+            self.record_save_error(error)
             return False
         except Exception as error:
             logger.exception(f'Error reason={error}')
+            self.record_save_error(error)
             return False
 
+        if not GooglePhotos.is_created(status):
+            logger.error(f'Create media item failed. path={media_path}, status={status}')
+            return False
         return True
 
+    def upload_google_photos_file(self, media_path: str) -> Optional[str]:
+        try:
+            return self.google_photos.upload_file(media_path)
+        except HttpError as error:
+            logger.exception(f'HTTP status={error.resp.reason}')
+            self.record_save_error(error)
+            return None
+        except Exception as error:
+            logger.exception(f'Error reason={error}')
+            self.record_save_error(error)
+            return None
+
+    def create_media_items(self, media_items: List[PendingMediaItem]) -> None:
+        """Create the media items of the uploaded media in batches, and set is_saved of each item."""
+        if not media_items:
+            return
+        try:
+            statuses: List[Dict[str, Any]] = self.google_photos.create_media_items(
+                [(media_item.upload_token, media_item.description) for media_item in media_items])
+        except Exception as error:
+            logger.exception(f'Error reason={error}')
+            statuses = [{'code': 2, 'message': str(error)} for _ in media_items]
+
+        for media_item, status in zip(media_items, statuses):
+            media_item.is_saved = GooglePhotos.is_created(status)
+            if media_item.is_saved:
+                self.store_media_hash(media_item.media_hash, media_item.url, media_item.user_id)
+                if media_item.phash is not None:
+                    self.store_perceptual_hash(media_item.phash, media_item.url, media_item.user_id)
+            else:
+                logger.error(f'Create media item failed. media_url={media_item.url}, status={status}')
+            with self._pending_media_lock:
+                self._pending_media_hashes.pop(media_item.media_hash, None)
+
+    def stream_google_photos(self, url: str, description: str, user_id: str) -> bool:
+        try:
+            with self._get_host_semaphore(url):
+                upload_token, media_hash = self.stream_media(url, self.make_file_name(url))
+
+            # The hash is known only after the bytes are sent, so a duplicate just skips creating the media item
+            with self._get_media_hash_lock(media_hash):
+                uploaded_media: Optional[Tuple[str, str]] = self.find_uploaded_media(media_hash)
+                if uploaded_media is not None:
+                    logger.info(f'Skip duplicate media. media_url={url}, uploaded_media_url={uploaded_media[0]}')
+                    return True
+                status: Dict[str, Any] = self.google_photos.create_media_item(upload_token, description)
+                if not GooglePhotos.is_created(status):
+                    logger.error(f'Create media item failed. media_url={url}, status={status}')
+                    return False
+                self.store_media_hash(media_hash, url, user_id)
+        except HttpError as error:
+            logger.exception(f'HTTP status={error.resp.reason}')
+            self.record_save_error(error)
+            return False
+        except Exception as error:
+            logger.exception(f'Error reason={error}')
+            self.record_save_error(error)
+            return False
+
+        return True
+
+    @staticmethod
+    def make_file_name(url: str) -> str:
+        return os.path.basename(re.sub(r'\?.*$', '', url))
+
     def make_download_path(self, url: str, user_id: str) -> str:
-        url = re.sub(r'\?.*$', '', url)
-        return f'{self._download_dir}/{user_id}/{os.path.basename(url)}'
+        return f'{self._download_dir}/{user_id}/{self.make_file_name(url)}'
 
-    def save_media(self, url: str, description: str, user_id: str) -> bool:
-        # download
-        download_path: str = self.make_download_path(url, user_id)
+    def make_media_url(self, url: str) -> str:
         if url.startswith('https://pbs.twimg.com/media') or url.startswith('http://pbs.twimg.com/media'):
-            url = self.twitter.make_original_image_url(url)
+            return self.twitter.make_original_image_url(url)
+        return url
+
+    def fetch_media(self, url: str, download_path: str) -> Optional[str]:
         try:
-            self.download_media(url, download_path)
-        except urllib.error.HTTPError:
+            with self._get_host_semaphore(url):
+                return self.download_media(url, download_path)
+        except (requests.exceptions.RequestException, ClassifiedError) as e:
             logger.exception(f'Download failed. media_url={url}')
+            self.record_save_error(e)
+            if isinstance(e, PermanentError):
+                # The download will not be resumed
+                self.downloader.remove_partial(download_path)
+            return None
+
+    def remove_duplicate_media(self, download_path: str, uploaded_media: Tuple[str, str]) -> None:
+        uploaded_url, uploaded_user_id = uploaded_media
+        # In local mode the first copy is kept, which may be the very file that was downloaded again
+        if self._save_mode != 'local' or self.make_download_path(uploaded_url, uploaded_user_id) != download_path:
+            os.remove(download_path)
+            logger.debug(f'Delete file. path={download_path}')
+
+    def is_uploaded_media(self, url: str, download_path: str, media_hash: str) -> bool:
+        uploaded_media: Optional[Tuple[str, str]] = self.find_uploaded_media(media_hash)
+        if uploaded_media is None:
             return False
 
+        logger.info(f'Skip duplicate media. media_url={url}, uploaded_media_url={uploaded_media[0]}')
+        self.remove_duplicate_media(download_path, uploaded_media)
+        return True
+
+    def _load_perceptual_index(self) -> None:
+        with self._perceptual_index_lock:
+            if self._is_perceptual_index_loaded:
+                return
+            for phash, url, user_id in self.store.fetch_all_uploaded_media_phashes():
+                self._perceptual_index.add(PerceptualHash.to_unsigned(phash), (url, user_id))
+            self._is_perceptual_index_loaded = True
+        logger.debug(f'Perceptual hash index loaded. count={len(self._perceptual_index)}')
+
+    def find_near_duplicate_media(self, download_path: str) -> Tuple[Optional[int], Optional[Tuple[str, str]]]:
+        if not self._perceptual_dedup_enabled:
+            return None, None
+        phash: Optional[int] = PerceptualHash.dhash(download_path)
+        if phash is None:
+            return None, None
+
+        try:
+            self._load_perceptual_index()
+        except Exception as e:
+            logger.exception(f'Fetch failed. table=uploaded_media_phash, exception={e.args}')
+            return phash, None
+        nearest: Optional[Tuple[Tuple[str, str], int]] = self._perceptual_index.find(phash)
+        return phash, nearest[0] if nearest is not None else None
+
+    def store_perceptual_hash(self, phash: int, url: str, user_id: str) -> None:
+        self._perceptual_index.add(phash, (url, user_id))
+        try:
+            self.store.insert_uploaded_media_phash(PerceptualHash.to_signed(phash), url, user_id)
+        except Exception as e:
+            logger.exception(f'Insert failed. phash={phash}, url={url}, exception={e.args}')
+
+    def upload_media(self, url: str, download_path: str, description: str) -> bool:
         if self._save_mode == 'local':
             return True
 
@@ -72,8 +306,8 @@ class Crawler:
         is_uploaded: bool = self.upload_google_photos(download_path, description)
 
         # delete
-        shutil.rmtree(os.path.dirname(download_path))
-        logger.debug(f'Delete directory. path={os.path.dirname(download_path)}')
+        os.remove(download_path)
+        logger.debug(f'Delete file. path={download_path}')
 
         if not is_uploaded:
             logger.error(f'upload failed. media_url={url}')
@@ -81,92 +315,472 @@ class Crawler:
 
         return True
 
-    def backup_media(self, tweet_medias: Dict[str, TweetMedia]) -> None:
+    def upload_pending_media(self, media_item: PendingMediaItem, download_path: str,
+                             media_items: List[PendingMediaItem]) -> bool:
+        upload_token: Optional[str] = self.upload_google_photos_file(download_path)
+
+        os.remove(download_path)
+        logger.debug(f'Delete file. path={download_path}')
+
+        if upload_token is None:
+            logger.error(f'upload failed. media_url={media_item.url}')
+            return False
+
+        media_item.upload_token = upload_token
+        with self._pending_media_lock:
+            self._pending_media_hashes[media_item.media_hash] = (media_item.url, media_item.user_id)
+        media_items.append(media_item)
+        return True
+
+    def upload_new_media(self, url: str, download_path: str, description: str, user_id: str,
+                         media_hash: str, media_items: Optional[List[PendingMediaItem]] = None) -> bool:
+        """Upload media unless it is a duplicate.
+
+        With `media_items`, only the bytes are uploaded in Google mode, and the media item is added to
+        `media_items` for create_media_items().
+        """
+        with self._get_media_hash_lock(media_hash):
+            if self.is_uploaded_media(url, download_path, media_hash):
+                return True
+
+            phash, near_duplicate_media = self.find_near_duplicate_media(download_path)
+            if near_duplicate_media is not None:
+                if self._perceptual_dedup_action == 'skip':
+                    logger.info(f'Skip near duplicate media. media_url={url}, '
+                                f'uploaded_media_url={near_duplicate_media[0]}')
+                    self.remove_duplicate_media(download_path, near_duplicate_media)
+                    return True
+                logger.info(f'Tag near duplicate media. media_url={url}, uploaded_media_url={near_duplicate_media[0]}')
+                description = f'{description}\nNear duplicate of {near_duplicate_media[0]}'
+
+            if media_items is not None and self._save_mode == 'google':
+                return self.upload_pending_media(PendingMediaItem(upload_token='', description=description, url=url,
+                                                                  user_id=user_id, media_hash=media_hash, phash=phash),
+                                                 download_path, media_items)
+
+            if not self.upload_media(url, download_path, description):
+                return False
+
+            self.store_media_hash(media_hash, url, user_id)
+            if phash is not None:
+                self.store_perceptual_hash(phash, url, user_id)
+        return True
+
+    def upload_media_stream(self, url: str, description: str, user_id: str) -> bool:
+        if not self.stream_google_photos(url, description, user_id):
+            logger.error(f'upload failed. media_url={url}')
+            return False
+
+        return True
+
+    def save_media(self, url: str, description: str, user_id: str,
+                   media_items: Optional[List[PendingMediaItem]] = None) -> bool:
+        # download
+        download_path: str = self.make_download_path(url, user_id)
+        url = self.make_media_url(url)
+
+        if self._save_mode == 'google':
+            # Media downloaded while the uploads are paused could not be uploaded anyway
+            try:
+                self.google_photos.check_upload_quota()
+            except ClassifiedError as e:
+                logger.warning(f'Skip saving media until the upload quota is reset. media_url={url}')
+                self.record_save_error(e)
+                return False
+
+        if self._streaming_upload_enabled:
+            return self.upload_media_stream(url, description, user_id)
+
+        media_hash: Optional[str] = self.fetch_media(url, download_path)
+        if media_hash is None:
+            return False
+
+        return self.upload_new_media(url, download_path, description, user_id, media_hash, media_items)
+
+    def backup_media(self, tweet_medias: Dict[str, TweetMedia]) -> int:
+        """Save media of the tweets not saved yet and return the number of the new media."""
         if not tweet_medias:
             logger.info('No new tweet media.')
-            return
+            return 0
 
         target_tweet_ids = self.store.fetch_not_added_tweet_ids(list(tweet_medias.keys()))
         if not target_tweet_ids:
             logger.info('No new tweet media.')
-            return
+            return 0
         logger.info(f'Target tweet media count={len(target_tweet_ids)}')
 
         if self._save_mode == 'google':
             self.google_photos.init_album()
 
-        for tweet_id, in target_tweet_ids:
-            target_tweet_media: TweetMedia = tweet_medias[tweet_id]
-            target_tweet: tweepy.Status = target_tweet_media.tweet
-            failed_upload_medias: List[Tuple[str, str]] = []
-
-            target_tweet_media.show_info()
-            for url in target_tweet_media.urls:
-                description: str = Twitter.make_tweet_description(target_tweet)
-                is_saved: bool = self.save_media(url, description, target_tweet.user.screen_name)
-                if not is_saved:
-                    failed_upload_medias.append((url, description))
-                    logger.warning(f'Save failed. tweet_id={tweet_id}, media_url={url}')
-                    continue
-
-            self.store_tweet_info(target_tweet)
-
-            if not failed_upload_medias:
-                logger.debug(f'All media upload succeeded. urls={target_tweet_media.urls}')
-                continue
+        with ThreadPoolExecutor(max_workers=self._download_workers) as executor:
+            save_futures: List[Tuple[TweetMedia, List[Tuple[str, str, List[PendingMediaItem], Future]]]] = []
+            for tweet_id, in target_tweet_ids:
+                target_tweet_media: TweetMedia = tweet_medias[tweet_id]
+                description: str = target_tweet_media.description
+
+                target_tweet_media.show_info()
+                media_futures: List[Tuple[str, str, List[PendingMediaItem], Future]] = []
+                for url in target_tweet_media.urls:
+                    media_items: List[PendingMediaItem] = []
+                    media_futures.append((url, description, media_items,
+                                          executor.submit(self.save_media, url, description,
+                                                          target_tweet_media.screen_name, media_items)))
+                save_futures.append((target_tweet_media, media_futures))
+
+            is_uploaded: List[List[bool]] = [[future.result() for _, _, _, future in media_futures]
+                                             for _, media_futures in save_futures]
+
+        # The media items of all the tweets are created together, up to 50 in a request
+        self.create_media_items([media_item for _, media_futures in save_futures
+                                 for _, _, media_items, _ in media_futures for media_item in media_items])
+        for (target_tweet_media, media_futures), uploaded in zip(save_futures, is_uploaded):
+            saved_medias: List[Tuple[str, str, bool]] = [
+                (url, description, is_saved and all(media_item.is_saved for media_item in media_items))
+                for (url, description, media_items, _), is_saved in zip(media_futures, uploaded)
+            ]
+            self._store_saved_tweet_media(target_tweet_media, saved_medias)
+
+        return sum(len(media_futures) for _, media_futures in save_futures)
+
+    def _store_saved_tweet_media(self, target_tweet_media: TweetMedia,
+                                 saved_medias: List[Tuple[str, str, bool]]) -> None:
+        failed_upload_medias: List[Tuple[str, str]] = []
+        for url, description, is_saved in saved_medias:
+            if not is_saved:
+                failed_upload_medias.append((url, description))
+                logger.warning(f'Save failed. tweet_id={target_tweet_media.id_str}, media_url={url}')
+
+        self.store_tweet_info(target_tweet_media)
+
+        if not failed_upload_medias:
+            logger.debug(f'All media upload succeeded. urls={target_tweet_media.urls}')
+            return
 
-            self.store_failed_upload_media(target_tweet, failed_upload_medias)
+        self.store_failed_upload_media(target_tweet_media, failed_upload_medias)
 
-    def store_tweet_info(self, target_tweet: tweepy.Status) -> None:
+    def store_tweet_info(self, target_tweet_media: TweetMedia) -> None:
         try:
-            self.store.insert_tweet_info(target_tweet.id_str, target_tweet.user.screen_name,
-                                         str(target_tweet.created_at))
+            self.store.insert_tweet_info(target_tweet_media.id_str, target_tweet_media.screen_name,
+                                         target_tweet_media.created_at)
         except Exception as e:
-            logger.exception(f'Insert failed. tweet_id={target_tweet.id_str}, exception={e.args}')
+            logger.exception(f'Insert failed. tweet_id={target_tweet_media.id_str}, exception={e.args}')
 
-    def store_failed_upload_media(self, target_tweet: tweepy.Status,
+    def store_failed_upload_media(self, target_tweet_media: TweetMedia,
                                   failed_upload_medias: List[Tuple[str, str]]) -> None:
         for failed_url, description in failed_upload_medias:
             try:
-                self.store.insert_failed_upload_media(failed_url, description, target_tweet.user.screen_name)
+                self.store.insert_failed_upload_media(failed_url, description, target_tweet_media.screen_name)
             except Exception as e:
                 logger.exception(f'Insert failed. failed_url={failed_url}, description={description},'
                                  f' exception={e.args}')
 
     def retry_backup_media(self) -> None:
+        # Users crawled concurrently share the failed_upload_media table, so only one retry runs at a time
+        if not self._retry_lock.acquire(blocking=False):
+            logger.debug('Retry backup is already running.')
+            return
+
+        try:
+            now: float = time.monotonic()
+            if self._retried_at is not None and now - self._retried_at < self._retry_interval_seconds:
+                logger.debug('Retry backup is not due.')
+                return
+            self._retried_at = now
+            self._retry_backup_media()
+        finally:
+            self._retry_lock.release()
+
+    def make_retry_seconds(self, attempts: int) -> float:
+        """Return the seconds until the next attempt, doubled with each failed attempt."""
+        return min(self._retry_backoff_seconds * 2 ** (attempts - 1), self._retry_backoff_max_seconds)
+
+    def _retry_backup_media(self) -> None:
         url: str = ''
         try:
-            for url, description, user_id in self.store.fetch_all_failed_upload_medias():
-                logger.info(f'Retry Save media. media_url={url}')
+            for url, description, user_id, attempts in \
+                    self.store.fetch_due_failed_upload_medias(self._retry_max_per_cycle):
+                logger.info(f'Retry Save media. media_url={url}, attempts={attempts}')
+                self.pop_save_error()
                 is_saved: bool = self.save_media(url, description, user_id)
-                if not is_saved:
-                    logger.warning(f'Retry Save failed. media_url={url}')
+                if is_saved:
+                    self.store.delete_failed_upload_media(url)
+                    continue
+
+                error: Optional[BaseException] = self.pop_save_error()
+                error_class: str = classify(error) if error is not None else TRANSIENT
+                if error_class == QUOTA:
+                    # The rest of the rows are left due, without an attempt, until the quota is reset
+                    logger.warning(f'Retry Save paused by the upload quota. media_url={url}')
+                    break
+                attempts += 1
+                last_error: str = type(error).__name__ if error is not None else 'SaveFailed'
+                if error_class == PERMANENT or attempts >= self._retry_max_attempts:
+                    logger.warning(f'Retry Save gave up. media_url={url}, attempts={attempts}, '
+                                   f'last_error={last_error}')
+                    self.store.move_failed_upload_media_to_dead(url, last_error)
+                    self.downloader.remove_partial(self.make_download_path(url, user_id))
                     continue
-                self.store.delete_failed_upload_media(url)
+                retry_seconds: float = self.make_retry_seconds(attempts)
+                logger.warning(f'Retry Save failed. media_url={url}, attempts={attempts}, last_error={last_error}, '
+                               f'retry_seconds={retry_seconds:.0f}')
+                self.store.update_failed_upload_attempt(url, last_error, retry_seconds)
         except Exception as e:
             logger.exception(f'Retry backup failed. failed_url={url}, exception={e.args}')
 
-    def crawling_tweets(self, user: TwitterUser) -> None:
-        target_tweet_medias: Dict[str, TweetMedia] = self.twitter.get_target_tweets(user)
-        self.backup_media(target_tweet_medias)
+    def load_since_ids(self, user_list: List[TwitterUser]) -> None:
+        try:
+            since_ids: Dict[str, int] = dict(self.store.fetch_since_ids([user.id for user in user_list]))
+        except Exception as e:
+            logger.exception(f'Fetch failed. table=twitter_user, exception={e.args}')
+            return
+
+        for user in user_list:
+            if user.id in since_ids:
+                user.since_id = since_ids[user.id]
+                logger.info(f'Load since_id. user = {user.id}, since_id={user.since_id}')
+
+    def store_since_id(self, user: TwitterUser) -> None:
+        if user.since_id <= 1:
+            return
+        try:
+            self.store.upsert_since_id(user.id, user.since_id)
+        except Exception as e:
+            logger.exception(f'Upsert failed. user = {user.id}, since_id={user.since_id}, exception={e.args}')
+
+    def fetch_known_tweet_ids(self, tweet_ids: List[str]) -> Set[str]:
+        try:
+            not_added_tweet_ids: Set[str] = {tweet_id for tweet_id, in self.store.fetch_not_added_tweet_ids(tweet_ids)}
+        except Exception as e:
+            logger.exception(f'Fetch failed. table=uploaded_media_tweet, exception={e.args}')
+            return set()
+        return set(tweet_ids) - not_added_tweet_ids
+
+    def load_album_id(self, album_title: str) -> Optional[str]:
+        try:
+            return self.store.fetch_google_album_id(album_title)
+        except Exception as e:
+            logger.exception(f'Fetch failed. table=google_album, exception={e.args}')
+            return None
+
+    def store_album_id(self, album_title: str, album_id: str) -> None:
+        try:
+            self.store.upsert_google_album(album_title, album_id)
+        except Exception as e:
+            logger.exception(f'Upsert failed. album_title={album_title}, album_id={album_id}, exception={e.args}')
+
+    def load_fav_snapshots(self, user_list: List[TwitterUser]) -> None:
+        try:
+            fav_snapshots: Dict[str, bytes] = dict(self.store.fetch_fav_snapshots([user.id for user in user_list]))
+        except Exception as e:
+            logger.exception(f'Fetch failed. table=twitter_user, exception={e.args}')
+            return
+
+        for user in user_list:
+            if user.id in fav_snapshots:
+                user.fav_snapshot = FavoriteSnapshot.from_bytes(fav_snapshots[user.id])
+                logger.info(f'Load fav_snapshot. user = {user.id}, tweets={len(user.fav_snapshot)}')
+
+    def store_fav_snapshot(self, user: TwitterUser) -> None:
+        # remember_favorites() keeps the stored snapshot when the favorites have not changed
+        if user.fav_snapshot is None or user.fav_snapshot.is_stored:
+            return
+        try:
+            self.store.upsert_fav_snapshot(user.id, user.fav_snapshot.to_bytes())
+            user.fav_snapshot.is_stored = True
+        except Exception as e:
+            logger.exception(f'Upsert failed. user = {user.id}, tweets={len(user.fav_snapshot)}, '
+                             f'exception={e.args}')
+
+    def crawling_tweets(self, user: TwitterUser) -> int:
+        progress: CrawlProgress = CrawlProgress(since_id=user.since_id)
+        if self._pipeline_enabled:
+            new_media_count: int = self.CyclePipeline(self).run(user, progress)
+        else:
+            target_tweet_medias: Dict[str, TweetMedia] = self.twitter.get_target_tweets(user, progress)
+            new_media_count = self.backup_media(target_tweet_medias)
+        # Only a finished cycle moves the checkpoint, in memory and in the Store, so a failed cycle or a crash makes
+        # the next one read the same tweets again
+        # The tweets buffered in the Store are written before the checkpoint
+        if self.store.flush():
+            user.since_id = progress.since_id
+            self.store_since_id(user)
+            if 'fav' in self.twitter.mode:
+                self.twitter.remember_favorites(user, progress.fav_tweet_ids)
+            self.store_fav_snapshot(user)
+        else:
+            logger.warning(f'Keep the checkpoint until the tweets are stored. user = {user.id}')
         self.retry_backup_media()
+        self.downloader.log_stats()
+        self.store.log_stats()
+        error_counter.log_stats()
+        return new_media_count
 
     def main(self) -> None:
-        interval_minutes: int = int(Env.get_environment('INTERVAL', default='5'))
         user_ids: str = Env.get_environment('TWITTER_USER_IDS', required=True)
 
         user_list: List[TwitterUser] = [TwitterUser(id=user_id) for user_id in user_ids.split(',')]
+        self.load_since_ids(user_list)
+        self.load_fav_snapshots(user_list)
+        scheduler: Scheduler = Scheduler(user_list)
+
+        if self._engine == 'asyncio':
+            AsyncCrawler(self.crawling_tweets, self.twitter.mode, scheduler).main(user_list)
+            return
 
         while True:
+            user, sleep_seconds = scheduler.next_user()
+            if sleep_seconds > 0:
+                logger.info(f'Interval. sleep {sleep_seconds:.0f} seconds until user = {user.id}.')
+                time.sleep(sleep_seconds)
+
+            new_media_count: int = 0
             try:
-                for user in user_list:
-                    logger.info(f'Crawling start. user = {user.id}, mode={self.twitter.mode}')
-                    self.crawling_tweets(user)
+                logger.info(f'Crawling start. user = {user.id}, mode={self.twitter.mode}')
+                new_media_count = self.crawling_tweets(user)
             except Exception as e:
                 logger.exception(f'Crawling error exception={e.args}')
-
-            logger.info(f'Interval. sleep {interval_minutes} minutes.')
-            time.sleep(interval_minutes * 60)
+            scheduler.complete(user, new_media_count)
+
+    class CyclePipeline:
+        def __init__(self, crawler_obj: object) -> None:
+            # noinspection PyTypeChecker
+            self.crawler: Crawler = crawler_obj  # type: ignore
+            self._queue_size: int = int(Env.get_environment('PIPELINE_QUEUE_SIZE', default='16'))
+            self._extract_workers: int = int(Env.get_environment('PIPELINE_EXTRACT_WORKERS', default='4'))
+            self._dedup_workers: int = int(Env.get_environment('PIPELINE_DEDUP_WORKERS', default='1'))
+            self._upload_workers: int = int(Env.get_environment('PIPELINE_UPLOAD_WORKERS', default='1'))
+            self._persist_workers: int = int(Env.get_environment('PIPELINE_PERSIST_WORKERS', default='1'))
+            self._lock: threading.Lock = threading.Lock()
+            self._progress: CrawlProgress = CrawlProgress()
+            self._seen_tweet_ids: Set[str] = set()
+            self._saved_medias: Dict[str, List[Tuple[str, str, bool]]] = {}
+            self._is_album_initialized: bool = False
+            self._new_media_count: int = 0
+            self._user: TwitterUser = TwitterUser()
+            self._pending_tasks: List[MediaTask] = []
+
+        def run(self, user: TwitterUser, progress: CrawlProgress) -> int:
+            """Back up the media of the user, and record the newest tweet and the favorites read in `progress`."""
+            self._user = user
+            self._progress = progress
+            pipeline: Pipeline = Pipeline(queue_size=self._queue_size) \
+                .add_stage('extract', self._extract, workers=self._extract_workers) \
+                .add_stage('dedup', self._dedup, workers=self._dedup_workers) \
+                .add_stage('download', self._download, workers=self.crawler._download_workers) \
+                .add_stage('upload', self._upload, workers=self._upload_workers) \
+                .add_stage('create', self._create) \
+                .add_stage('persist', self._persist, workers=self._persist_workers)
+            pipeline.run(self.crawler.twitter.iter_target_tweet_pages(user, progress))
+            # The stages have stopped, so the last batch is persisted here
+            for task in self._create_batch():
+                self._persist(task)
+            # The items dropped by an error are read again in the next cycle, instead of being skipped by the checkpoint
+            if pipeline.errors > 0:
+                raise PipelineError(f'Pipeline stage error. user = {user.id}, errors={pipeline.errors}')
+            return self._new_media_count
+
+        def _extract(self, page: Tuple[str, List[tweepy.Status]]) -> Iterator[Dict[str, TweetMedia]]:
+            page_type, tweets = page
+            tweet_medias: Dict[str, TweetMedia] = self.crawler.twitter.get_page_tweet_medias(page_type, tweets)
+            if page_type == 'fav':
+                with self._lock:
+                    self._progress.fav_tweet_ids.update(tweet.id_str for tweet in tweets)
+                    self._progress.fav_tweet_ids.update(tweet_medias.keys())
+                tweet_medias = self.crawler.twitter.difference_last_favorites(self._user, tweet_medias)
+
+            if tweet_medias:
+                yield tweet_medias
+
+        def _dedup(self, tweet_medias: Dict[str, TweetMedia]) -> Iterator[MediaTask]:
+            # The same tweet can be found on several pages, e.g. quoted by more than one retweet
+            with self._lock:
+                tweet_medias = {tweet_id: tweet_media for tweet_id, tweet_media in tweet_medias.items()
+                                if tweet_id not in self._seen_tweet_ids}
+                self._seen_tweet_ids.update(tweet_medias.keys())
+            if not tweet_medias:
+                return
+
+            target_tweet_ids = self.crawler.store.fetch_not_added_tweet_ids(list(tweet_medias.keys()))
+            if target_tweet_ids:
+                logger.info(f'Target tweet media count={len(target_tweet_ids)}')
+                with self._lock:
+                    self._new_media_count += sum(len(tweet_medias[tweet_id].urls) for tweet_id, in target_tweet_ids)
+
+            for tweet_id, in target_tweet_ids:
+                target_tweet_media: TweetMedia = tweet_medias[tweet_id]
+                description: str = target_tweet_media.description
+
+                target_tweet_media.show_info()
+                if not target_tweet_media.urls:
+                    yield MediaTask(tweet_media=target_tweet_media, url='', description=description)
+                for url in target_tweet_media.urls:
+                    yield MediaTask(tweet_media=target_tweet_media, url=url, description=description)
+
+        def _download(self, task: MediaTask) -> Iterator[MediaTask]:
+            if task.url:
+                task.media_url = self.crawler.make_media_url(task.url)
+                if not self.crawler._streaming_upload_enabled:
+                    user_id: str = task.tweet_media.screen_name
+                    task.download_path = self.crawler.make_download_path(task.url, user_id)
+                    task.media_hash = self.crawler.fetch_media(task.media_url, task.download_path) or ''
+                    task.is_saved = task.media_hash != ''
+            yield task
+
+        def _init_album(self) -> None:
+            with self._lock:
+                if self._is_album_initialized:
+                    return
+                self.crawler.google_photos.init_album()
+                self._is_album_initialized = True
+
+        def _upload(self, task: MediaTask) -> Iterator[MediaTask]:
+            if not task.url:
+                yield task
+                return
+
+            user_id: str = task.tweet_media.screen_name
+            if self.crawler._streaming_upload_enabled:
+                self._init_album()
+                task.is_saved = self.crawler.upload_media_stream(task.media_url, task.description, user_id)
+            elif task.is_saved:
+                if self.crawler._save_mode == 'google':
+                    self._init_album()
+                task.is_saved = self.crawler.upload_new_media(task.media_url, task.download_path, task.description,
+                                                              user_id, task.media_hash, task.media_items)
+            yield task
+
+        def _create_batch(self) -> List[MediaTask]:
+            with self._lock:
+                tasks: List[MediaTask] = self._pending_tasks
+                self._pending_tasks = []
+            self.crawler.create_media_items([media_item for task in tasks for media_item in task.media_items])
+            for task in tasks:
+                task.is_saved = task.is_saved and all(media_item.is_saved for media_item in task.media_items)
+            return tasks
+
+        def _create(self, task: MediaTask) -> List[MediaTask]:
+            if not task.media_items:
+                return [task]
+            with self._lock:
+                self._pending_tasks.append(task)
+                if len(self._pending_tasks) < BATCH_CREATE_LIMIT:
+                    return []
+            return self._create_batch()
+
+        def _persist(self, task: MediaTask) -> List[None]:
+            target_tweet_media: TweetMedia = task.tweet_media
+            tweet_id: str = target_tweet_media.id_str
+            with self._lock:
+                saved_medias: List[Tuple[str, str, bool]] = self._saved_medias.setdefault(tweet_id, [])
+                if task.url:
+                    saved_medias.append((task.url, task.description, task.is_saved))
+                if len(saved_medias) < len(target_tweet_media.urls):
+                    return []
+                del self._saved_medias[tweet_id]
+
+            # noinspection PyProtectedMember
+            self.crawler._store_saved_tweet_media(target_tweet_media, saved_medias)
+            return []
 
 
 logger: logging.Logger = logging.getLogger(__name__)
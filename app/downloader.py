@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+
+import contextlib
+import dataclasses
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+from concurrent.futures import Future, ThreadPoolExecutor
+from retry import retry
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.env import Env
+from app.errors import DOWNLOAD_STATUSES, classify_errors
+from app.log import Log
+
+RETRY_EXCEPTIONS = (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+
+@dataclasses.dataclass
+class DownloadStats(object):
+    count: int = 0
+    total_bytes: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    @property
+    def average_seconds(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total_seconds / self.count
+
+
+class Downloader:
+    def __init__(self) -> None:
+        self._connect_timeout: float = float(Env.get_environment('DOWNLOAD_CONNECT_TIMEOUT', default='10'))
+        self._read_timeout: float = float(Env.get_environment('DOWNLOAD_READ_TIMEOUT', default='60'))
+        self.chunk_size: int = int(Env.get_environment('STREAM_CHUNK_SIZE', default=str(1024 * 1024)))
+        pool_size: int = int(Env.get_environment('DOWNLOAD_WORKERS', default='8'))
+        self._segments: int = int(Env.get_environment('DOWNLOAD_SEGMENTS', default='1'))
+        self._segment_threshold: int = int(Env.get_environment('DOWNLOAD_SEGMENT_THRESHOLD',
+                                                               default=str(32 * 1024 * 1024)))
+
+        # One session shares keep-alive connections per host between all download workers
+        self.session: requests.Session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size * self._segments)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._stats: DownloadStats = DownloadStats()
+        self._stats_lock: threading.Lock = threading.Lock()
+        self._path_locks: List[threading.Lock] = [threading.Lock() for _ in range(64)]
+
+        logger.debug(f'Downloader setting info. connect_timeout={self._connect_timeout}, '
+                     f'read_timeout={self._read_timeout}, chunk_size={self.chunk_size}, pool_size={pool_size}, '
+                     f'segments={self._segments}, segment_threshold={self._segment_threshold}')
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return self._connect_timeout, self._read_timeout
+
+    def stats(self) -> DownloadStats:
+        with self._stats_lock:
+            return dataclasses.replace(self._stats)
+
+    def log_stats(self) -> None:
+        stats: DownloadStats = self.stats()
+        logger.debug(f'Download stats. count={stats.count}, bytes={stats.total_bytes}, '
+                     f'average_ms={stats.average_seconds * 1000:.1f}, max_ms={stats.max_seconds * 1000:.1f}')
+
+    def _record(self, url: str, status: int, size: int, started_at: float) -> None:
+        elapsed: float = time.monotonic() - started_at
+        with self._stats_lock:
+            self._stats.count += 1
+            self._stats.total_bytes += size
+            self._stats.total_seconds += elapsed
+            self._stats.max_seconds = max(self._stats.max_seconds, elapsed)
+        logger.debug(f'Request finished. url={url}, status={status}, bytes={size}, elapsed_ms={elapsed * 1000:.1f}')
+
+    def _get_path_lock(self, download_path: str) -> threading.Lock:
+        return self._path_locks[hash(download_path) % len(self._path_locks)]
+
+    @staticmethod
+    def make_partial_path(download_path: str) -> str:
+        return f'{download_path}.part'
+
+    @staticmethod
+    def make_validator_path(download_path: str) -> str:
+        return f'{download_path}.part.validator'
+
+    @staticmethod
+    def _get_validator(response: requests.Response) -> Optional[str]:
+        # If-Range takes a strong ETag, or a Last-Modified date
+        etag: Optional[str] = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return response.headers.get('Last-Modified')
+
+    @staticmethod
+    def _load_validator(path: str) -> Optional[str]:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return f.read() or None
+
+    @staticmethod
+    def _save_validator(path: str, validator: Optional[str]) -> None:
+        if validator is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(path, 'w') as f:
+            f.write(validator)
+
+    @staticmethod
+    def _remove_segments(partial_path: str) -> None:
+        for segment_path in glob.glob(f'{glob.escape(partial_path)}.[0-9]*'):
+            os.remove(segment_path)
+
+    def remove_partial(self, download_path: str) -> None:
+        """Delete the partial files of a download which will not be resumed."""
+        with self._get_path_lock(download_path):
+            partial_path: str = self.make_partial_path(download_path)
+            self._remove_segments(partial_path)
+            for path in [partial_path, self.make_validator_path(download_path)]:
+                if os.path.exists(path):
+                    os.remove(path)
+                    logger.debug(f'Delete partial file. path={path}')
+
+    @staticmethod
+    def _get_file_size(path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path)
+
+    @staticmethod
+    def _get_total_size(response: requests.Response) -> Optional[int]:
+        # "Content-Range: bytes 100-199/200" for 206 and "bytes */200" for 416
+        content_range: str = response.headers.get('Content-Range', '')
+        if '/' in content_range and not content_range.endswith('/*'):
+            return int(content_range.rsplit('/', 1)[1])
+        content_length: Optional[str] = response.headers.get('Content-Length')
+        if response.status_code == 200 and content_length:
+            return int(content_length)
+        return None
+
+    @staticmethod
+    def hash_chunks(chunks: Iterable[bytes], media_hash: 'hashlib._Hash') -> Iterator[bytes]:
+        for chunk in chunks:
+            media_hash.update(chunk)
+            yield chunk
+
+    def _hash_file(self, path: str, media_hash: 'hashlib._Hash') -> None:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                media_hash.update(chunk)
+
+    def _write_response(self, response: requests.Response, path: str, mode: str,
+                        media_hash: Optional['hashlib._Hash'] = None) -> int:
+        chunks: Iterator[bytes] = response.iter_content(chunk_size=self.chunk_size)
+        if media_hash is not None:
+            chunks = self.hash_chunks(chunks, media_hash)
+        size: int = 0
+        with open(path, mode) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def _is_segmented(self, response: requests.Response, offset: int) -> bool:
+        if self._segments <= 1 or offset > 0 or response.status_code != 200 \
+                or response.headers.get('Accept-Ranges') != 'bytes':
+            return False
+        total_size: Optional[int] = self._get_total_size(response)
+        return total_size is not None and total_size >= self._segment_threshold
+
+    def download(self, media_url: str, download_path: str) -> str:
+        """Download media and return the SHA-256 hex digest of its content."""
+        # The workers downloading the same media would write to the same partial file, so they take turns
+        with self._get_path_lock(download_path):
+            return self._download(media_url, download_path)
+
+    @retry(RETRY_EXCEPTIONS, tries=3, delay=2, backoff=2)
+    @classify_errors(DOWNLOAD_STATUSES)
+    def _download(self, media_url: str, download_path: str) -> str:
+        os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        logger.debug(f'Download file. url={media_url}, path={download_path}')
+        started_at: float = time.monotonic()
+        # The partial file is kept on failure, so that retries and later cycles resume from where it stopped
+        partial_path: str = self.make_partial_path(download_path)
+        validator_path: str = self.make_validator_path(download_path)
+        validator: Optional[str] = self._load_validator(validator_path)
+        # A partial file without the validator of its content cannot be resumed safely, so it is started over
+        offset: int = self._get_file_size(partial_path) if validator is not None else 0
+        # The server sends the whole content instead of the range when the content has changed since
+        headers: Dict[str, str] = {'Range': f'bytes={offset}-', 'If-Range': validator} \
+            if offset > 0 and validator is not None else {}
+        media_hash: 'hashlib._Hash' = hashlib.sha256()
+
+        with self.session.get(media_url, headers=headers, stream=True, timeout=self.timeout) as response:
+            status: int = response.status_code
+            if status == 200 and self._get_validator(response) != validator:
+                # The segments of another content are not resumed
+                self._remove_segments(partial_path)
+                validator = self._get_validator(response)
+                self._save_validator(validator_path, validator)
+            if status == 416 and self._get_total_size(response) == offset:
+                # The partial file was completed before the rename
+                self._hash_file(partial_path, media_hash)
+                size: int = 0
+            elif self._is_segmented(response, offset):
+                total_size: int = self._get_total_size(response)  # type: ignore
+                response.close()
+                size = self._download_segments(media_url, partial_path, total_size, media_hash, validator)
+            else:
+                if status == 416:
+                    # The partial file does not match the content any more, so start over on the next try
+                    os.remove(partial_path)
+                response.raise_for_status()
+                if offset > 0:
+                    logger.debug(f'Resume download. url={media_url}, offset={offset}, status={status}')
+                if status == 206:
+                    self._hash_file(partial_path, media_hash)
+                # A server which ignores Range, or whose content has changed, answers 200 with the whole content
+                size = self._write_response(response, partial_path, 'ab' if status == 206 else 'wb', media_hash)
+
+        os.replace(partial_path, download_path)
+        self._save_validator(validator_path, None)
+        self._record(media_url, status, size, started_at)
+        return media_hash.hexdigest()
+
+    def _download_segment(self, media_url: str, segment_path: str, start: int, end: int,
+                          validator: Optional[str]) -> int:
+        offset: int = self._get_file_size(segment_path)
+        if start + offset > end:
+            return 0
+
+        headers: Dict[str, str] = {'Range': f'bytes={start + offset}-{end}'}
+        if validator is not None:
+            headers['If-Range'] = validator
+        with self.session.get(media_url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.exceptions.HTTPError(f'Range request is not supported. url={media_url}')
+            return self._write_response(response, segment_path, 'ab')
+
+    def _download_segments(self, media_url: str, partial_path: str, total_size: int,
+                           media_hash: 'hashlib._Hash', validator: Optional[str]) -> int:
+        segment_size: int = -(-total_size // self._segments)
+        segments: List[Tuple[str, int, int]] = [
+            (f'{partial_path}.{i}', start, min(start + segment_size, total_size) - 1)
+            for i, start in enumerate(range(0, total_size, segment_size))
+        ]
+        logger.debug(f'Download segments. url={media_url}, total_size={total_size}, segments={len(segments)}')
+
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures: List[Future] = [executor.submit(self._download_segment, media_url, segment_path, start, end,
+                                                     validator)
+                                     for segment_path, start, end in segments]
+            size: int = sum(future.result() for future in futures)
+
+        with open(partial_path, 'wb') as f:
+            for segment_path, _, _ in segments:
+                with open(segment_path, 'rb') as segment:
+                    for chunk in iter(lambda: segment.read(self.chunk_size), b''):
+                        media_hash.update(chunk)
+                        f.write(chunk)
+        for segment_path, _, _ in segments:
+            os.remove(segment_path)
+        return size
+
+    @contextlib.contextmanager
+    def open_stream(self, media_url: str) -> Iterator[Tuple[Iterator[bytes], Optional[int]]]:
+        started_at: float = time.monotonic()
+        with self.session.get(media_url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            content_length: Optional[str] = response.headers.get('Content-Length')
+            size: Optional[int] = int(content_length) if content_length else None
+            yield response.iter_content(chunk_size=self.chunk_size), size
+            self._record(media_url, response.status_code, size or 0, started_at)
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='downloader')
+    logger = logging.getLogger(__name__)
+    downloader = Downloader()
+    downloader.download('https://pbs.twimg.com/media/EHA6tW9U4AECSrH.png?name=orig', './download/test.png')
+    print(downloader.stats())
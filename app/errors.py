@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+import contextlib
+import dataclasses
+import functools
+import logging
+import threading
+import time
+
+import pendulum
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar, cast
+
+from app.log import Log
+
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+QUOTA = 'quota'
+
+# The media is gone, or is not shown to anyone, so downloading it again fails the same way
+DOWNLOAD_STATUSES: Dict[int, str] = {400: PERMANENT, 401: PERMANENT, 403: PERMANENT, 404: PERMANENT, 410: PERMANENT,
+                                     451: PERMANENT}
+# Google Photos answers RESOURCE_EXHAUSTED with 429 when the quota of the project is used up. 401 and 403 are left
+# transient, since they come from the credentials and not from the media.
+GOOGLE_API_STATUSES: Dict[int, str] = {400: PERMANENT, 404: PERMANENT, 413: PERMANENT, 429: QUOTA}
+# The daily quota of the Library API is reset at midnight Pacific Time
+QUOTA_RESET_ZONE = 'America/Los_Angeles'
+
+FuncT = TypeVar('FuncT', bound=Callable[..., Any])
+
+
+class ClassifiedError(Exception):
+    """An error raised from the error it was classified from, which @retry does not retry."""
+    error_class: str = TRANSIENT
+
+    def __init__(self, error: BaseException) -> None:
+        super().__init__(str(error))
+        self.error: BaseException = error
+        self.status: Optional[int] = get_status(error)
+
+
+class PermanentError(ClassifiedError):
+    error_class = PERMANENT
+
+
+class QuotaExceededError(ClassifiedError):
+    error_class = QUOTA
+
+
+def get_response(error: BaseException) -> Any:
+    # requests has the response in `response`, googleapiclient in `resp`
+    response: Any = getattr(error, 'response', None)
+    return response if response is not None else getattr(error, 'resp', None)
+
+
+def get_status(error: BaseException) -> Optional[int]:
+    if isinstance(error, ClassifiedError):
+        return error.status
+    response: Any = get_response(error)
+    if response is None:
+        return None
+    status: Any = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    return int(status) if status is not None else None
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """Return the seconds of the Retry-After header, which is not used when it is a date."""
+    response: Any = get_response(error)
+    if response is None:
+        return None
+    # The headers of httplib2 are the response itself, with the names in lower case
+    retry_after: Any = getattr(response, 'headers', response).get('retry-after')
+    return float(retry_after) if isinstance(retry_after, str) and retry_after.isdigit() else None
+
+
+def classify(error: BaseException, statuses: Optional[Dict[int, str]] = None) -> str:
+    """Return whether trying again fails the same way, may succeed, or has to wait for the quota."""
+    if isinstance(error, ClassifiedError):
+        return error.error_class
+    status: Optional[int] = get_status(error)
+    if status is None or statuses is None:
+        return TRANSIENT
+    return statuses.get(status, TRANSIENT)
+
+
+@dataclasses.dataclass
+class ErrorStats(object):
+    permanent: int = 0
+    transient: int = 0
+    quota: int = 0
+
+
+class ErrorCounter:
+    def __init__(self) -> None:
+        self._stats: ErrorStats = ErrorStats()
+        self._lock: threading.Lock = threading.Lock()
+
+    def count(self, error_class: str) -> None:
+        with self._lock:
+            setattr(self._stats, error_class, getattr(self._stats, error_class) + 1)
+
+    def stats(self) -> ErrorStats:
+        with self._lock:
+            return dataclasses.replace(self._stats)
+
+    def log_stats(self) -> None:
+        stats: ErrorStats = self.stats()
+        logger.debug(f'Error stats. permanent={stats.permanent}, transient={stats.transient}, quota={stats.quota}')
+
+
+# The errors of every function with classify_errors, which are counted once when they are raised
+error_counter: ErrorCounter = ErrorCounter()
+
+
+def classify_errors(statuses: Dict[int, str]) -> Callable[[FuncT], FuncT]:
+    """Raise PermanentError or QuotaExceededError from the errors of those classes, and count the errors.
+
+    Put it under @retry, so that only the transient errors are retried.
+    """
+    def decorator(func: FuncT) -> FuncT:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            try:
+                return func(*args, **kwargs)
+            except ClassifiedError:
+                raise
+            except Exception as error:
+                error_class: str = classify(error, statuses)
+                error_counter.count(error_class)
+                if error_class == PERMANENT:
+                    raise PermanentError(error) from error
+                if error_class == QUOTA:
+                    raise QuotaExceededError(error) from error
+                raise
+        return cast(FuncT, wrapper)
+    return decorator
+
+
+class QuotaGate:
+    """Fail the requests fast from a quota error until the quota is reset, instead of sending them.
+
+    The gate is open again after the seconds of Retry-After, or at the next daily reset of the quota.
+    """
+
+    def __init__(self, name: str, clock: Callable[[], float] = time.time) -> None:
+        self._name: str = name
+        self._clock: Callable[[], float] = clock
+        self._reopen_at: float = 0.0
+        self._error: Optional[QuotaExceededError] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def next_reset(self) -> float:
+        now: Any = pendulum.from_timestamp(self._clock(), tz=QUOTA_RESET_ZONE)
+        return float(now.add(days=1).start_of('day').timestamp())
+
+    @property
+    def seconds_until_open(self) -> float:
+        with self._lock:
+            return max(0.0, self._reopen_at - self._clock())
+
+    def close(self, error: QuotaExceededError) -> None:
+        retry_after: Optional[float] = get_retry_after(error.error)
+        reopen_at: float = self._clock() + retry_after if retry_after is not None else self.next_reset()
+        with self._lock:
+            self._reopen_at = max(self._reopen_at, reopen_at)
+            self._error = error
+        logger.warning(f'Pause {self._name} until the quota is reset. seconds={reopen_at - self._clock():.0f}, '
+                       f'status={error.status}')
+
+    def check(self) -> None:
+        if self.seconds_until_open > 0:
+            raise QuotaExceededError(self._error.error if self._error is not None else Exception(self._name))
+
+    @contextlib.contextmanager
+    def guard(self) -> Iterator[None]:
+        """Fail while the gate is closed, and close it on a quota error."""
+        self.check()
+        try:
+            yield
+        except QuotaExceededError as error:
+            self.close(error)
+            raise
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='errors')
+    logger = logging.getLogger(__name__)
+    gate = QuotaGate('test')
+    print(gate.next_reset() - time.time(), error_counter.stats())
@@ -1,103 +1,460 @@
 #!/usr/bin/python3
 
+import contextlib
+import datetime
+import httplib2
+import json
 import logging
+import mimetypes
 import os
+import queue
+import socket
+import threading
+import time
 import googleapiclient.errors
 
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from retry import retry
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from google_auth_httplib2 import AuthorizedHttp
+from google_auth_httplib2 import AuthorizedHttp, Request
 
 from app.env import Env
+from app.errors import GOOGLE_API_STATUSES, ClassifiedError, PermanentError, QuotaGate, classify_errors, get_status
 from app.log import Log
 
 API_SERVICE_NAME = 'photoslibrary'
 API_VERSION = 'v1'
 SCOPES: List[str] = ['https://www.googleapis.com/auth/photoslibrary']
 UPLOAD_API_URL = 'https://photoslibrary.googleapis.com/v1/uploads'
-DUMMY_ACCESS_TOKEN = 'dummy_access_token'
+# The most newMediaItems which mediaItems.batchCreate accepts
+BATCH_CREATE_LIMIT = 50
+MIB = 1024 * 1024
+# Resuming an upload session gives up after this many failures in a row
+RESUMABLE_UPLOAD_TRIES = 5
+TOKEN_REFRESH_RETRY_SECONDS = 30
 
 
 class GoogleApiResponseNG(Exception):
-    pass
+    def __init__(self, msg: str, response: Optional[httplib2.Response] = None) -> None:
+        super().__init__(msg)
+        self.response: Optional[httplib2.Response] = response
+
+
+class InvalidAlbumError(PermanentError):
+    def __init__(self, album_id: str, http_error: googleapiclient.errors.HttpError) -> None:
+        super().__init__(http_error)
+        self.album_id: str = album_id
+        self.http_error: googleapiclient.errors.HttpError = http_error
+
+
+class OneShotBody(object):
+    """The body of a streamed request, which fails when it is sent again instead of sending the consumed stream.
+
+    httplib2 resends a request on a dropped connection, and AuthorizedHttp resends it after refreshing the token
+    on 401, which would send an empty or partial body.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks: Iterable[bytes] = chunks
+        self._is_sent: bool = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._is_sent:
+            raise ConnectionError('The streamed body cannot be sent again, so the stream must be reopened')
+        self._is_sent = True
+        return iter(self._chunks)
+
+
+class TokenFile:
+    """The access token and its expiry in a local file, which only the owner can read."""
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+
+    def load(self, client_id: str) -> Optional[Tuple[str, datetime.datetime]]:
+        try:
+            with open(self.path, 'r') as f:
+                token_info: Any = json.load(f)
+            if not isinstance(token_info, dict):
+                raise TypeError(f'The token file is not a JSON object. type={type(token_info).__name__}')
+            if token_info.get('client_id') != client_id:
+                return None
+            # The expiry of google-auth is a naive datetime in UTC
+            return token_info['token'], datetime.datetime.strptime(token_info['expiry'], '%Y-%m-%dT%H:%M:%S')
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError, TypeError) as e:
+            # A truncated or edited file makes a new token be fetched, instead of stopping the crawler
+            logger.warning(f'Load token failed. path={self.path}, exception={e.args}')
+            return None
+
+    def save(self, client_id: str, token: str, expiry: datetime.datetime) -> None:
+        token_info: dict = {'client_id': client_id, 'token': token, 'expiry': expiry.strftime('%Y-%m-%dT%H:%M:%S')}
+        temp_path: str = f'{self.path}.tmp'
+        # The file is created with 0600, and replaces the old one at once
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(token_info, f)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, self.path)
+
+
+class SharedCredentials(Credentials):
+    """Credentials shared by the upload workers and the service.
+
+    When the access token expires, the workers get 401 at about the same time. Only the first of them refreshes the
+    token, and the others wait for it and use the refreshed token. A refreshed token is saved in the token file.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)  # type: ignore
+        self._refresh_lock: threading.Lock = threading.Lock()
+        self.token_file: Optional[TokenFile] = None
+
+    def refresh(self, request: Any) -> None:
+        expired_token: Optional[str] = self.token
+        with self._refresh_lock:
+            if self.token != expired_token:
+                return
+            super().refresh(request)  # type: ignore
+            if self.token_file is None or self.token is None or self.expiry is None:
+                return
+            try:
+                self.token_file.save(self.client_id, self.token, self.expiry)
+            except OSError as e:
+                logger.warning(f'Save token failed. path={self.token_file.path}, exception={e.args}')
 
 
 class GooglePhotos:
     def __init__(self) -> None:
         self.credentials = self.make_credentials()
         self.service = build(API_SERVICE_NAME, API_VERSION, credentials=self.credentials, cache_discovery=False)
-        self.authorized_http = AuthorizedHttp(credentials=self.credentials)
+        # The service has a single httplib2 connection, which is not thread-safe
+        self._service_lock: threading.Lock = threading.Lock()
+        self.upload_workers: int = int(Env.get_environment('GOOGLE_UPLOAD_WORKERS', default='4'))
+        # Each upload worker borrows its own connection, so the bytes are sent in parallel
+        self._upload_https: 'queue.Queue[AuthorizedHttp]' = queue.Queue()
+        for _ in range(self.upload_workers):
+            self._upload_https.put(AuthorizedHttp(credentials=self.credentials))
+        self._upload_api_url: str = Env.get_environment('GOOGLE_UPLOAD_API_URL', default=UPLOAD_API_URL)
+        self._resumable_threshold: int = \
+            int(Env.get_environment('GOOGLE_RESUMABLE_UPLOAD_THRESHOLD_MB', default='20')) * MIB
+        self._upload_chunk_size: int = int(Env.get_environment('GOOGLE_UPLOAD_CHUNK_SIZE_MB', default='8')) * MIB
+        # Refresh the access token this many seconds before it expires, so that no request waits for the refresh
+        self._token_refresh_margin: float = float(Env.get_environment('GOOGLE_TOKEN_REFRESH_MARGIN', default='600'))
+        self._token_refresher_stop: threading.Event = threading.Event()
         self._album_title: str = Env.get_environment('GOOGLE_ALBUM_TITLE', default='')
         self._album_id: str = ''
+        self._album_lock: threading.Lock = threading.Lock()
+        # Load and store the album id of an album title in the Store. Set by Crawler.
+        self.load_album_id: Callable[[str], Optional[str]] = lambda album_title: None
+        self.store_album_id: Callable[[str, str], None] = lambda album_title, album_id: None
+        # Closed by a quota error, so that the uploads fail without a request until the quota is reset
+        self.quota_gate: QuotaGate = QuotaGate('Google Photos uploads')
 
     @staticmethod
-    def make_credentials() -> Credentials:
+    def make_credentials() -> SharedCredentials:
         client_id: str = Env.get_environment('GOOGLE_CLIENT_ID', required=True)
         client_secret: str = Env.get_environment('GOOGLE_CLIENT_SECRET', required=True)
         refresh_token: str = Env.get_environment('GOOGLE_REFRESH_TOKEN', required=True)
-        return Credentials(
-            token=DUMMY_ACCESS_TOKEN,
+        token_file = TokenFile(Env.get_environment('GOOGLE_TOKEN_FILE', default='./.google_token.json'))
+        credentials = SharedCredentials(
+            token=None,
             refresh_token=refresh_token,
             token_uri='https://oauth2.googleapis.com/token',
             client_id=client_id,
             client_secret=client_secret,
             scopes=SCOPES
         )
+        # Without a saved token, the first request refreshes it instead of failing with 401
+        saved_token: Optional[Tuple[str, datetime.datetime]] = token_file.load(client_id)
+        if saved_token is not None:
+            credentials.token, credentials.expiry = saved_token
+            logger.debug(f'Load saved token. path={token_file.path}, expiry={credentials.expiry}')
+        credentials.token_file = token_file
+        return credentials
+
+    def _seconds_until_refresh(self) -> float:
+        if self.credentials.token is None or self.credentials.expiry is None:
+            return 0.0
+        seconds: float = (self.credentials.expiry - datetime.datetime.utcnow()).total_seconds()
+        return max(seconds - self._token_refresh_margin, 0.0)
+
+    def refresh_token(self) -> bool:
+        logger.debug('Refresh the access token of Google Photos.')
+        try:
+            self.credentials.refresh(Request(httplib2.Http()))
+        except Exception as e:
+            logger.exception(f'Refresh token failed. exception={e.args}')
+            return False
+        return True
+
+    def _refresh_token_loop(self) -> None:
+        wait_seconds: float = self._seconds_until_refresh()
+        while not self._token_refresher_stop.wait(wait_seconds):
+            wait_seconds = self._seconds_until_refresh() if self.refresh_token() else TOKEN_REFRESH_RETRY_SECONDS
+
+    def start_token_refresher(self) -> threading.Thread:
+        """Refresh the access token in the background before it expires."""
+        self._token_refresher_stop.clear()
+        thread = threading.Thread(target=self._refresh_token_loop, name='google_token_refresher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop_token_refresher(self) -> None:
+        self._token_refresher_stop.set()
+
+    @staticmethod
+    def is_created(status: Dict[str, Any]) -> bool:
+        # A failed item has the google.rpc.Status code, and a created one has only the message
+        return status.get('code', 0) == 0
+
+    @staticmethod
+    def is_invalid_album_error(error: googleapiclient.errors.HttpError) -> bool:
+        # e.g. the album was deleted, or it was not created by this app
+        return error.resp.status in (400, 403, 404) and 'album' in str(error).lower()
+
+    def _create_media_item(self, upload_token: str, description: str) -> Dict[str, Any]:
+        return self._create_media_items_in_album([(upload_token, description)])[0]
+
+    def _create_media_items_in_album(self, items: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        with self.quota_gate.guard():
+            try:
+                return self._batch_create_media_items(items)
+            except InvalidAlbumError as error:
+                logger.warning(f'Invalid album. album_title={self._album_title}, album_id={error.album_id}, '
+                               f'status={error.http_error.resp.status}')
+                self._revalidate_album(error.album_id)
+            try:
+                return self._batch_create_media_items(items)
+            except InvalidAlbumError as error:
+                raise error.http_error
 
     @retry(googleapiclient.errors.HttpError, tries=3, delay=2, backoff=2)
-    def _create_media_item(self, upload_token: str, description: str) -> Dict[str, str]:
-        logger.debug('Create new item for Google Photos')
+    @classify_errors(GOOGLE_API_STATUSES)
+    def _batch_create_media_items(self, items: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        logger.debug(f'Create new items for Google Photos. count={len(items)}')
+        # FIRST_IN_ALBUM puts the whole batch in front of the album in the given order. Reversing it gives the
+        # same order as creating the items one by one, where the last item comes first.
+        new_media_items: List[Tuple[str, str]] = list(reversed(items))
         new_item: dict = {
             'newMediaItems': [{
                 'description': description,
                 'simpleMediaItem': {
                     'uploadToken': upload_token
                 }
-            }]
+            } for upload_token, description in new_media_items]
         }
 
+        album_id: str = self._album_id
         if self._album_title != '':
             new_item.update({
-                'albumId': self._album_id,
+                'albumId': album_id,
                 'albumPosition': {
                     'position': 'FIRST_IN_ALBUM',
                 }})
-        response: dict = self.service.mediaItems().batchCreate(body=new_item).execute()
-        status: Dict[str, str] = response['newMediaItemResults'][0]['status']
-        return status
+        try:
+            with self._service_lock:
+                response: dict = self.service.mediaItems().batchCreate(body=new_item).execute()
+        except googleapiclient.errors.HttpError as error:
+            # Not retried, since the same album fails again
+            if self._album_title != '' and self.is_invalid_album_error(error):
+                raise InvalidAlbumError(album_id, error)
+            raise
+        results: List[dict] = response.get('newMediaItemResults', [])
+        statuses: Dict[str, Dict[str, Any]] = {result.get('uploadToken', ''): result['status'] for result in results}
+        item_statuses: List[Dict[str, Any]] = []
+        for i, (upload_token, _) in enumerate(new_media_items):
+            if upload_token in statuses:
+                item_statuses.append(statuses[upload_token])
+            elif i < len(results):
+                # The results are in the order of newMediaItems
+                item_statuses.append(results[i]['status'])
+            else:
+                item_statuses.append({'code': 2, 'message': 'No result for the upload token'})
+        return item_statuses[::-1]
+
+    def create_media_items(self, items: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """Create the media items of (upload_token, description) in batches, and return the status of each item."""
+        logger.info(f'Create media items in Google Photos. count={len(items)}')
+        statuses: List[Dict[str, Any]] = []
+        for start in range(0, len(items), BATCH_CREATE_LIMIT):
+            batch: List[Tuple[str, str]] = items[start:start + BATCH_CREATE_LIMIT]
+            try:
+                statuses.extend(self._create_media_items_in_album(batch))
+            except (googleapiclient.errors.HttpError, ClassifiedError) as error:
+                # A failed batch fails each of its items, while the other batches go on
+                status: Optional[int] = get_status(error)
+                logger.exception(f'Batch create failed. count={len(batch)}, status={status}')
+                statuses.extend({'code': status or 2, 'message': str(error)} for _ in batch)
+        return statuses
+
+    @contextlib.contextmanager
+    def _upload_http(self) -> Iterator[AuthorizedHttp]:
+        """Borrow the connection of an idle upload worker, waiting for one when all of them are busy."""
+        authorized_http: AuthorizedHttp = self._upload_https.get()
+        try:
+            yield authorized_http
+        finally:
+            self._upload_https.put(authorized_http)
+
+    @classify_errors(GOOGLE_API_STATUSES)
+    def _request_upload(self, uri: str, body: Any, headers: Dict[str, str]) -> Tuple[httplib2.Response, bytes]:
+        # AuthorizedHttp sets the Authorization header with the current token, which another worker may refresh
+        with self._upload_http() as authorized_http:
+            (response, content) = authorized_http.request(uri=uri, method='POST', body=body, headers=headers)
+
+        if response.status != 200:
+            msg: str = f'"POST:{uri}" response NG, status={response.status}, content={content}'
+            raise GoogleApiResponseNG(msg, response)
+        return response, content
+
+    def _request_upload_api(self, file_name: str, body: Any, size: Optional[int] = None) -> str:
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Goog-Upload-File-Name': file_name,
+            'X-Goog-Upload-Protocol': 'raw',
+        }
+        if size is not None:
+            headers['Content-Length'] = str(size)
+        (_, upload_token) = self._request_upload(self._upload_api_url, body, headers)
+        return upload_token.decode('utf-8')
 
     @retry((GoogleApiResponseNG, ConnectionError, TimeoutError), tries=3, delay=2, backoff=2)
     def _execute_upload_api(self, file_path: str) -> str:
-        logger.debug(f'Execute "POST:{UPLOAD_API_URL}" to upload media to Google Photos. path={file_path}')
+        logger.debug(f'Execute "POST:{self._upload_api_url}" to upload media to Google Photos. path={file_path}')
         with open(file_path, 'rb') as file_data:
-            headers = {
-                'Authorization': 'Bearer ' + self.credentials.token,
-                'Content-Type': 'application/octet-stream',
-                'X-Goog-Upload-File-Name': os.path.basename(file_path),
-                'X-Goog-Upload-Protocol': 'raw',
-            }
-            (response, upload_token) = self.authorized_http.request(uri=UPLOAD_API_URL, method='POST', body=file_data,
-                                                                    headers=headers)
+            return self._request_upload_api(os.path.basename(file_path), file_data)
 
-        if response.status != 200:
-            msg: str = f'"POST:{UPLOAD_API_URL}" response NG, status={response.status}, content={upload_token}'
-            raise GoogleApiResponseNG(msg)
-        return upload_token.decode('utf-8')
+    @retry((GoogleApiResponseNG, ConnectionError, TimeoutError, socket.timeout), tries=3, delay=2, backoff=2)
+    def _start_resumable_upload(self, file_name: str, size: int) -> Tuple[str, int]:
+        """Start an upload session and return its URL and the chunk granularity."""
+        headers = {
+            'Content-Length': '0',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Content-Type': mimetypes.guess_type(file_name)[0] or 'application/octet-stream',
+            'X-Goog-Upload-File-Name': file_name,
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Raw-Size': str(size),
+        }
+        (response, _) = self._request_upload(self._upload_api_url, b'', headers)
+        return response['x-goog-upload-url'], int(response.get('x-goog-upload-chunk-granularity', '1'))
 
-    def upload_media(self, file_path: str, description: str) -> Dict[str, str]:
+    def _query_resumable_upload(self, upload_url: str) -> Tuple[int, Optional[str]]:
+        """Return the bytes committed by the session, and the upload token when the session is already finalized."""
+        headers = {
+            'Content-Length': '0',
+            'X-Goog-Upload-Command': 'query',
+        }
+        (response, content) = self._request_upload(upload_url, b'', headers)
+        upload_token: Optional[str] = content.decode('utf-8') \
+            if response.get('x-goog-upload-status') == 'final' else None
+        return int(response['x-goog-upload-size-received']), upload_token
+
+    def _upload_chunk(self, upload_url: str, chunk: bytes, offset: int, is_last: bool) -> str:
+        headers = {
+            'Content-Length': str(len(chunk)),
+            'X-Goog-Upload-Command': 'upload, finalize' if is_last else 'upload',
+            'X-Goog-Upload-Offset': str(offset),
+        }
+        (_, content) = self._request_upload(upload_url, chunk, headers)
+        return content.decode('utf-8')
+
+    def _execute_resumable_upload_api(self, file_path: str) -> str:
+        """Upload a file in chunks. After a failure, the upload resumes from the bytes the session has committed."""
+        size: int = os.path.getsize(file_path)
+        logger.debug(f'Execute "POST:{self._upload_api_url}" to upload media to Google Photos in chunks. '
+                     f'path={file_path}, size={size}')
+        upload_url, granularity = self._start_resumable_upload(os.path.basename(file_path), size)
+        # Every chunk but the last one must be a multiple of the granularity
+        chunk_size: int = max(self._upload_chunk_size // granularity, 1) * granularity
+        # None means the committed offset is unknown, and is queried from the session
+        offset: Optional[int] = 0
+        failures = 0
+        with open(file_path, 'rb') as file_data:
+            while True:
+                try:
+                    if offset is None:
+                        offset, upload_token = self._query_resumable_upload(upload_url)
+                        if upload_token is not None:
+                            return upload_token
+                    file_data.seek(offset)
+                    chunk: bytes = file_data.read(chunk_size)
+                    is_last: bool = offset + len(chunk) >= size
+                    upload_token = self._upload_chunk(upload_url, chunk, offset, is_last)
+                    if is_last:
+                        return upload_token
+                    offset += len(chunk)
+                    failures = 0
+                # socket.timeout is not a TimeoutError before Python 3.10
+                except (GoogleApiResponseNG, ConnectionError, TimeoutError, socket.timeout,
+                        httplib2.HttpLib2Error) as error:
+                    failures += 1
+                    if failures >= RESUMABLE_UPLOAD_TRIES:
+                        raise
+                    logger.warning(f'Resume upload. path={file_path}, offset={offset}, failures={failures}, '
+                                   f'error={error}')
+                    time.sleep(2 ** failures)
+                    offset = None
+
+    def _execute_upload_stream_api(self, file_name: str, chunks: Iterable[bytes], size: Optional[int]) -> str:
+        # A consumed stream cannot be sent again, so retrying is left to the caller which reopens the download
+        logger.debug(f'Execute "POST:{self._upload_api_url}" to upload media stream to Google Photos. '
+                     f'file_name={file_name}, size={size}')
+        return self._request_upload_api(file_name, OneShotBody(chunks), size)
+
+    def upload_media(self, file_path: str, description: str) -> Dict[str, Any]:
+        upload_token: str = self.upload_file(file_path)
+
+        return self._create_media_item(upload_token, description)
+
+    def upload_file(self, file_path: str) -> str:
+        """Upload the bytes only and return the upload token for create_media_items()."""
         logger.info(f'Upload media to Google Photos. path={file_path}')
-        upload_token: str = self._execute_upload_api(file_path=file_path)
+        with self.quota_gate.guard():
+            if os.path.getsize(file_path) > self._resumable_threshold:
+                return self._execute_resumable_upload_api(file_path)
+            return self._execute_upload_api(file_path=file_path)
+
+    def upload_stream(self, file_name: str, chunks: Iterable[bytes], size: Optional[int] = None) -> str:
+        """Upload the bytes only and return the upload token for create_media_item()."""
+        logger.info(f'Upload media stream to Google Photos. file_name={file_name}')
+        with self.quota_gate.guard():
+            return self._execute_upload_stream_api(file_name, chunks, size)
 
+    def create_media_item(self, upload_token: str, description: str) -> Dict[str, Any]:
         return self._create_media_item(upload_token, description)
 
+    def check_upload_quota(self) -> None:
+        """Raise QuotaExceededError while the uploads are paused by the quota."""
+        self.quota_gate.check()
+
     def init_album(self) -> None:
+        """Set the album id from the memory, the Store, or Google Photos in this order."""
         if self._album_title == '':
             return
+        with self._album_lock:
+            if self._album_id != '':
+                return
+            self._album_id = self.load_album_id(self._album_title) or ''
+            if self._album_id != '':
+                logger.debug(f'Use the stored album id. album_title={self._album_title}, album_id={self._album_id}')
+                return
+            self._find_album()
+
+    def _revalidate_album(self, invalid_album_id: str) -> None:
+        with self._album_lock:
+            if self._album_id != invalid_album_id:
+                # Another worker has revalidated it
+                return
+            self._find_album()
+
+    def _find_album(self) -> None:
         self._album_id = self._fetch_album_id()
         if self._album_id == '':
             self._create_new_album()
+        logger.info(f'Found album. album_title={self._album_title}, album_id={self._album_id}')
+        self.store_album_id(self._album_title, self._album_id)
 
     def _fetch_album_id(self) -> str:
         page_token = ''
@@ -120,7 +477,8 @@ class GooglePhotos:
             'pageToken': page_token,
             'excludeNonAppCreatedData': True
         }
-        return self.service.albums().list(**params).execute(num_retries=3)
+        with self._service_lock:
+            return self.service.albums().list(**params).execute(num_retries=3)
 
     def _create_new_album(self) -> None:
         logger.debug(f'Execute "service.albums().create()" to create new album to Google Photos. '
@@ -130,7 +488,8 @@ class GooglePhotos:
                 'title': self._album_title
             }
         }
-        api_result: dict = self.service.albums().create(body=params).execute(num_retries=3)
+        with self._service_lock:
+            api_result: dict = self.service.albums().create(body=params).execute(num_retries=3)
         self._album_id = api_result['id']
 
 
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+import array
+import bisect
+import dataclasses
+import heapq
+import logging
+import threading
+
+from typing import Iterable, List, Optional, Set, Tuple
+
+from app.log import Log
+
+# The added ids are merged into the sorted array when this many are waiting
+MERGE_SIZE = 4096
+
+
+@dataclasses.dataclass
+class KnownTweetCacheStats(object):
+    size: int
+    watermark: Optional[int]
+    hits: int
+    misses: int
+
+
+class KnownTweetCache:
+    """The tweet ids already in uploaded_media_tweet, as int64 in a sorted array.
+
+    The cache has all of the stored ids from the watermark up, so an id at or above it is known exactly when it is
+    in the cache. Whether an id below the watermark, or one which is not a number, is stored can only be answered
+    by the database. When the cache grows over max_size, the smallest ids, which are of the oldest tweets, are
+    dropped and the watermark is raised.
+
+    Every id stored must be added by add(), so the cache is right only while this process is the only writer.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size: int = max_size
+        self._ids: array.array = array.array('q')
+        self._added_ids: Set[int] = set()
+        # None until the ids in the database are loaded, when nothing is known to be complete
+        self._watermark: Optional[int] = None
+        self._hits: int = 0
+        self._misses: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def is_warm(self) -> bool:
+        return self._watermark is not None
+
+    @staticmethod
+    def _to_int(tweet_id: str) -> Optional[int]:
+        # A leading zero would make another string of the same number
+        if not (tweet_id.isascii() and tweet_id.isdigit()) or tweet_id.startswith('0'):
+            return None
+        value: int = int(tweet_id)
+        return value if value < 1 << 63 else None
+
+    def warm(self, tweet_ids: Iterable[str]) -> None:
+        """Load the ids in the database, keeping the largest max_size of them."""
+        stored_ids: List[int] = []
+        for tweet_id in tweet_ids:
+            value: Optional[int] = self._to_int(tweet_id)
+            if value is not None:
+                stored_ids.append(value)
+        with self._lock:
+            stored_ids.extend(self._ids)
+            stored_ids.extend(self._added_ids)
+            self._added_ids = set()
+            self._ids = array.array('q', sorted(set(stored_ids)))
+            self._watermark = 0
+            self._evict()
+        logger.info(f'Warm known tweet cache. size={len(self._ids)}, watermark={self._watermark}')
+
+    def _merge(self) -> None:
+        added_ids: List[int] = [value for value in sorted(self._added_ids) if not self._in_ids(value)]
+        self._ids = array.array('q', heapq.merge(self._ids, added_ids))
+        self._added_ids = set()
+        self._evict()
+
+    def _evict(self) -> None:
+        if len(self._ids) <= self._max_size:
+            return
+        del self._ids[:len(self._ids) - self._max_size]
+        if self._watermark is not None:
+            self._watermark = max(self._watermark, self._ids[0]) if self._ids else None
+
+    def _in_ids(self, value: int) -> bool:
+        i: int = bisect.bisect_left(self._ids, value)
+        return i < len(self._ids) and self._ids[i] == value
+
+    def _contains(self, value: int) -> bool:
+        return value in self._added_ids or self._in_ids(value)
+
+    def add(self, tweet_id: str) -> None:
+        value: Optional[int] = self._to_int(tweet_id)
+        if value is None:
+            return
+        with self._lock:
+            self._added_ids.add(value)
+            if len(self._added_ids) >= MERGE_SIZE:
+                self._merge()
+
+    def classify(self, tweet_ids: List[str]) -> Tuple[List[str], List[str]]:
+        """Return the ids known not to be stored, and the ids which have to be looked up in the database.
+
+        The ids known to be stored are in neither of them.
+        """
+        not_added_ids: List[str] = []
+        unknown_ids: List[str] = []
+        with self._lock:
+            for tweet_id in tweet_ids:
+                value: Optional[int] = self._to_int(tweet_id)
+                if value is not None and self._contains(value):
+                    continue
+                if value is None or self._watermark is None or value < self._watermark:
+                    unknown_ids.append(tweet_id)
+                else:
+                    not_added_ids.append(tweet_id)
+            self._misses += len(unknown_ids)
+            self._hits += len(tweet_ids) - len(unknown_ids)
+        return not_added_ids, unknown_ids
+
+    def stats(self) -> KnownTweetCacheStats:
+        with self._lock:
+            return KnownTweetCacheStats(size=len(self._ids) + len(self._added_ids), watermark=self._watermark,
+                                        hits=self._hits, misses=self._misses)
+
+    def log_stats(self) -> None:
+        stats: KnownTweetCacheStats = self.stats()
+        logger.debug(f'Known tweet cache stats. size={stats.size}, watermark={stats.watermark}, hits={stats.hits}, '
+                     f'misses={stats.misses}')
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='known_tweet_cache')
+    logger = logging.getLogger(__name__)
+    cache = KnownTweetCache(max_size=2)
+    cache.warm(['1', '2', '3'])
+    print(cache.classify(['1', '3', '4']), cache.stats())
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+import dataclasses
+import logging
+
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from app.env import Env
+from app.log import Log
+from app.store_backend import StoreBackend
+from app.tz import Tz
+
+# Rows updated or copied by a statement of a backfill, each of which is a transaction of its own
+BACKFILL_BATCH_SIZE = 10000
+# A tweet id is made of (milliseconds since the Unix epoch - TWITTER_EPOCH_MS) << 22, so it is ordered by time
+TWITTER_EPOCH_MS = 1288834974657
+# Partitions are made for the years from the first tweet id with a time up to this many years ahead
+PARTITION_YEARS_AHEAD = 2
+
+# A statement run by itself, the statements of a transaction, or a function for the steps which loop
+Step = Union[str, List[str], Callable[[StoreBackend], None]]
+
+
+@dataclasses.dataclass
+class Migration(object):
+    version: int
+    name: str
+    # The steps for each backend name. A backend without steps skips the migration, which is not recorded.
+    steps: Dict[str, List[Step]]
+
+
+def tweet_id_at(year: int) -> int:
+    """Return the first tweet id of a year."""
+    epoch_ms: int = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    return (epoch_ms - TWITTER_EPOCH_MS) << 22
+
+
+def backfill_typed_columns(backend: StoreBackend) -> None:
+    query: str = 'WITH batch AS (' \
+                 '  UPDATE uploaded_media_tweet ' \
+                 '  SET tweet_id = tweet_id ' \
+                 '  WHERE ctid = ANY(ARRAY(' \
+                 '    SELECT ctid FROM uploaded_media_tweet WHERE tweet_id_new IS NULL LIMIT %s)) ' \
+                 '  RETURNING 1) ' \
+                 'SELECT count(*) FROM batch'
+    total: int = 0
+    while True:
+        # The trigger fills the typed columns of the updated rows
+        count: int = backend.execute('migrate', query, (BACKFILL_BATCH_SIZE,))[0][0]
+        if count == 0:
+            break
+        total += count
+        logger.info(f'Backfill uploaded_media_tweet. rows={total}')
+
+
+def create_partitioned_table(backend: StoreBackend) -> None:
+    if backend.execute('migrate', "SELECT to_regclass('uploaded_media_tweet_partitioned')")[0][0] is not None:
+        return
+    statements: List[str] = [
+        'CREATE TABLE uploaded_media_tweet_partitioned '
+        '(LIKE uploaded_media_tweet INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+        'PARTITION BY RANGE (tweet_id)',
+        'ALTER TABLE uploaded_media_tweet_partitioned '
+        'ADD CONSTRAINT uploaded_media_tweet_partitioned_pk PRIMARY KEY (tweet_id)',
+        'CREATE INDEX uploaded_media_tweet_partitioned_user_id_tweet_date_idx '
+        'ON uploaded_media_tweet_partitioned (user_id, tweet_date)',
+        'CREATE TABLE uploaded_media_tweet_default PARTITION OF uploaded_media_tweet_partitioned DEFAULT',
+    ]
+    # The ids before the time was put in them are in the first partition
+    lower: str = 'MINVALUE'
+    for year in range(2011, datetime.now(timezone.utc).year + PARTITION_YEARS_AHEAD + 1):
+        statements.append(f'CREATE TABLE uploaded_media_tweet_y{year - 1} '
+                          f'PARTITION OF uploaded_media_tweet_partitioned '
+                          f'FOR VALUES FROM ({lower}) TO ({tweet_id_at(year)})')
+        lower = str(tweet_id_at(year))
+    backend.execute_transaction('migrate', [(statement, ()) for statement in statements])
+
+
+def backfill_partitioned_table(backend: StoreBackend) -> None:
+    last_query: str = 'SELECT max(tweet_id), count(*) ' \
+                      'FROM (SELECT tweet_id FROM uploaded_media_tweet WHERE tweet_id > %s ' \
+                      '      ORDER BY tweet_id LIMIT %s) T'
+    copy_query: str = 'INSERT INTO uploaded_media_tweet_partitioned ' \
+                      'SELECT * FROM uploaded_media_tweet WHERE tweet_id > %s AND tweet_id <= %s ' \
+                      'ON CONFLICT (tweet_id) DO NOTHING'
+    last_id: int = -1
+    total: int = 0
+    while True:
+        batch_last_id, count = backend.execute('migrate', last_query, (last_id, BACKFILL_BATCH_SIZE))[0]
+        if count == 0:
+            break
+        backend.execute('migrate', copy_query, (last_id, batch_last_id))
+        last_id = batch_last_id
+        total += count
+        logger.info(f'Copy uploaded_media_tweet to the partitioned table. rows={total}')
+
+
+# The tables added after uploaded_media_tweet and failed_upload_media of database.sql, which a database made from
+# database.sql does not have
+STATE_TABLES: List[str] = [
+    'CREATE TABLE IF NOT EXISTS uploaded_media_hash ('
+    '  media_hash text not null constraint uploaded_media_hash_pk primary key,'
+    '  url        text not null,'
+    '  user_id    text not null,'
+    '  add_date   text not null)',
+    'CREATE TABLE IF NOT EXISTS uploaded_media_phash ('
+    '  phash    bigint not null,'
+    '  url      text   not null,'
+    '  user_id  text   not null,'
+    '  add_date text   not null)',
+    'CREATE TABLE IF NOT EXISTS twitter_user ('
+    '  user_id      text   not null constraint twitter_user_pk primary key,'
+    '  since_id     bigint not null default 1,'
+    '  fav_snapshot bytea,'
+    '  update_date  text   not null)',
+    'CREATE TABLE IF NOT EXISTS google_album ('
+    '  album_title text not null constraint google_album_pk primary key,'
+    '  album_id    text not null,'
+    '  update_date text not null)',
+]
+
+
+def make_migrations(zone: str) -> List[Migration]:
+    """Return the migrations from the tables of database.sql.
+
+    add_date was written in the time zone of TZ, and tweet_date in UTC.
+    """
+    zone_literal: str = "'" + zone.replace("'", "''") + "'"
+    return [
+        Migration(version=1, name='typed_uploaded_media_tweet', steps={
+            # The typed columns are filled next to the text ones, and swapped with them in a short transaction
+            'postgres': [
+                'ALTER TABLE uploaded_media_tweet '
+                'ADD COLUMN IF NOT EXISTS tweet_id_new bigint, '
+                'ADD COLUMN IF NOT EXISTS tweet_date_new timestamptz, '
+                'ADD COLUMN IF NOT EXISTS add_date_new timestamptz',
+                'CREATE OR REPLACE FUNCTION uploaded_media_tweet_typed() RETURNS trigger AS $$ '
+                'BEGIN '
+                '  NEW.tweet_id_new := NEW.tweet_id::bigint; '
+                "  NEW.tweet_date_new := NEW.tweet_date::timestamp AT TIME ZONE 'UTC'; "
+                f'  NEW.add_date_new := NEW.add_date::timestamp AT TIME ZONE {zone_literal}; '
+                '  RETURN NEW; '
+                'END $$ LANGUAGE plpgsql',
+                ['DROP TRIGGER IF EXISTS uploaded_media_tweet_typed ON uploaded_media_tweet',
+                 'CREATE TRIGGER uploaded_media_tweet_typed BEFORE INSERT OR UPDATE ON uploaded_media_tweet '
+                 'FOR EACH ROW EXECUTE PROCEDURE uploaded_media_tweet_typed()'],
+                backfill_typed_columns,
+                # A valid check lets SET NOT NULL skip the scan of the table under the exclusive lock
+                ['ALTER TABLE uploaded_media_tweet DROP CONSTRAINT IF EXISTS uploaded_media_tweet_typed_not_null',
+                 'ALTER TABLE uploaded_media_tweet ADD CONSTRAINT uploaded_media_tweet_typed_not_null '
+                 'CHECK (tweet_id_new IS NOT NULL AND tweet_date_new IS NOT NULL AND add_date_new IS NOT NULL) '
+                 'NOT VALID'],
+                'ALTER TABLE uploaded_media_tweet VALIDATE CONSTRAINT uploaded_media_tweet_typed_not_null',
+                # An index left invalid by a failed build is made again
+                'DROP INDEX CONCURRENTLY IF EXISTS uploaded_media_tweet_tweet_id_new_idx',
+                'CREATE UNIQUE INDEX CONCURRENTLY uploaded_media_tweet_tweet_id_new_idx '
+                'ON uploaded_media_tweet (tweet_id_new)',
+                ['DROP TRIGGER uploaded_media_tweet_typed ON uploaded_media_tweet',
+                 'DROP FUNCTION uploaded_media_tweet_typed()',
+                 'ALTER TABLE uploaded_media_tweet DROP CONSTRAINT uploaded_media_tweet_pk',
+                 'ALTER TABLE uploaded_media_tweet DROP COLUMN tweet_id, DROP COLUMN tweet_date, DROP COLUMN add_date',
+                 'ALTER TABLE uploaded_media_tweet RENAME COLUMN tweet_id_new TO tweet_id',
+                 'ALTER TABLE uploaded_media_tweet RENAME COLUMN tweet_date_new TO tweet_date',
+                 'ALTER TABLE uploaded_media_tweet RENAME COLUMN add_date_new TO add_date',
+                 'ALTER TABLE uploaded_media_tweet '
+                 'ALTER COLUMN tweet_id SET NOT NULL, '
+                 'ALTER COLUMN tweet_date SET NOT NULL, '
+                 'ALTER COLUMN add_date SET NOT NULL',
+                 'ALTER TABLE uploaded_media_tweet DROP CONSTRAINT uploaded_media_tweet_typed_not_null',
+                 'ALTER TABLE uploaded_media_tweet '
+                 'ADD CONSTRAINT uploaded_media_tweet_pk '
+                 'PRIMARY KEY USING INDEX uploaded_media_tweet_tweet_id_new_idx'],
+            ],
+            # SQLite cannot change the type of a column, and has no type for timestamps, so the table is made again
+            # with an integer id, and the dates are kept in text
+            'sqlite': [
+                ['CREATE TABLE uploaded_media_tweet_typed ('
+                 '  tweet_id   integer not null constraint uploaded_media_tweet_pk primary key,'
+                 '  user_id    text    not null,'
+                 '  add_date   text    not null,'
+                 '  tweet_date text    not null)',
+                 'INSERT INTO uploaded_media_tweet_typed (tweet_id, user_id, add_date, tweet_date) '
+                 'SELECT CAST(tweet_id AS integer), user_id, add_date, tweet_date FROM uploaded_media_tweet',
+                 'DROP TABLE uploaded_media_tweet',
+                 'ALTER TABLE uploaded_media_tweet_typed RENAME TO uploaded_media_tweet'],
+            ],
+        }),
+        Migration(version=2, name='uploaded_media_tweet_user_id_tweet_date_idx', steps={
+            'postgres': [
+                'DROP INDEX CONCURRENTLY IF EXISTS uploaded_media_tweet_user_id_tweet_date_idx',
+                'CREATE INDEX CONCURRENTLY uploaded_media_tweet_user_id_tweet_date_idx '
+                'ON uploaded_media_tweet (user_id, tweet_date)',
+            ],
+            'sqlite': [
+                'CREATE INDEX IF NOT EXISTS uploaded_media_tweet_user_id_tweet_date_idx '
+                'ON uploaded_media_tweet (user_id, tweet_date)',
+            ],
+        }),
+        # A failed media is retried at next_attempt_at, later after each attempt, and is moved to
+        # failed_upload_media_dead when it has failed too many times
+        Migration(version=4, name='failed_upload_media_retry', steps={
+            'postgres': [
+                # A constant default does not rewrite the table
+                'ALTER TABLE failed_upload_media '
+                'ADD COLUMN IF NOT EXISTS attempts integer not null default 0, '
+                'ADD COLUMN IF NOT EXISTS last_error text, '
+                "ADD COLUMN IF NOT EXISTS next_attempt_at timestamptz not null default '-infinity'",
+                'DROP INDEX CONCURRENTLY IF EXISTS failed_upload_media_next_attempt_at_idx',
+                'CREATE INDEX CONCURRENTLY failed_upload_media_next_attempt_at_idx '
+                'ON failed_upload_media (next_attempt_at)',
+                ['CREATE TABLE IF NOT EXISTS failed_upload_media_dead ('
+                 '  url         text        not null constraint failed_upload_media_dead_pk primary key,'
+                 '  description text        not null,'
+                 '  user_id     text        not null,'
+                 '  attempts    integer     not null,'
+                 '  last_error  text,'
+                 '  dead_date   timestamptz not null)'],
+            ],
+            # The empty text of next_attempt_at is before any time
+            'sqlite': [
+                ['ALTER TABLE failed_upload_media ADD COLUMN attempts integer not null default 0',
+                 'ALTER TABLE failed_upload_media ADD COLUMN last_error text',
+                 "ALTER TABLE failed_upload_media ADD COLUMN next_attempt_at text not null default ''",
+                 'CREATE INDEX failed_upload_media_next_attempt_at_idx ON failed_upload_media (next_attempt_at)',
+                 'CREATE TABLE failed_upload_media_dead ('
+                 '  url         text    not null constraint failed_upload_media_dead_pk primary key,'
+                 '  description text    not null,'
+                 '  user_id     text    not null,'
+                 '  attempts    integer not null,'
+                 '  last_error  text,'
+                 '  dead_date   text    not null)'],
+            ],
+        }),
+        Migration(version=5, name='crawler_state_tables', steps={
+            # twitter_user was first made without fav_snapshot and the default of since_id
+            'postgres': [
+                STATE_TABLES + [
+                    'ALTER TABLE twitter_user '
+                    'ADD COLUMN IF NOT EXISTS fav_snapshot bytea, '
+                    'ALTER COLUMN since_id SET DEFAULT 1'],
+            ],
+            # twitter_user of SQLite is only made here, with the columns
+            'sqlite': [
+                STATE_TABLES,
+            ],
+        }),
+    ]
+
+
+def make_partition_migration() -> Migration:
+    """Return the migration to a table partitioned by the year of the tweet id, which keeps ON CONFLICT (tweet_id).
+
+    The old table is kept as uploaded_media_tweet_unpartitioned, and can be dropped after the migration.
+    """
+    return Migration(version=3, name='partition_uploaded_media_tweet', steps={
+        'postgres': [
+            create_partitioned_table,
+            'CREATE OR REPLACE FUNCTION uploaded_media_tweet_mirror() RETURNS trigger AS $$ '
+            'BEGIN '
+            '  INSERT INTO uploaded_media_tweet_partitioned VALUES (NEW.*) ON CONFLICT (tweet_id) DO NOTHING; '
+            '  RETURN NEW; '
+            'END $$ LANGUAGE plpgsql',
+            ['DROP TRIGGER IF EXISTS uploaded_media_tweet_mirror ON uploaded_media_tweet',
+             'CREATE TRIGGER uploaded_media_tweet_mirror AFTER INSERT ON uploaded_media_tweet '
+             'FOR EACH ROW EXECUTE PROCEDURE uploaded_media_tweet_mirror()'],
+            backfill_partitioned_table,
+            ['LOCK TABLE uploaded_media_tweet IN ACCESS EXCLUSIVE MODE',
+             'DROP TRIGGER uploaded_media_tweet_mirror ON uploaded_media_tweet',
+             'DROP FUNCTION uploaded_media_tweet_mirror()',
+             'ALTER TABLE uploaded_media_tweet RENAME TO uploaded_media_tweet_unpartitioned',
+             'ALTER TABLE uploaded_media_tweet_partitioned RENAME TO uploaded_media_tweet'],
+        ],
+    })
+
+
+class Migrator:
+    """Apply the migrations not applied yet to the database, in the order of their versions.
+
+    The applied versions are recorded in schema_migrations. The steps of a migration can be run again after a
+    failure, and the last one, when it is a transaction, records the version in the same transaction. The other
+    steps are run in autocommit mode, so CREATE INDEX CONCURRENTLY and the backfill batches do not hold locks
+    for long, and the crawler of an older version can keep writing during the migration.
+    """
+
+    def __init__(self, backend: StoreBackend) -> None:
+        self._backend: StoreBackend = backend
+        self._partition_tweets: bool = Env.get_bool_environment('DATABASE_PARTITION_TWEETS', default=False)
+        self._zone: str = Tz.timezone().name
+
+        logger.debug(f'Migrator setting info. _partition_tweets={self._partition_tweets}, _zone={self._zone}')
+
+    def migrations(self) -> List[Migration]:
+        migrations: List[Migration] = make_migrations(self._zone)
+        if self._partition_tweets:
+            migrations.append(make_partition_migration())
+        return sorted(migrations, key=lambda migration: migration.version)
+
+    def applied_versions(self) -> Set[int]:
+        self._backend.execute('migrate', 'CREATE TABLE IF NOT EXISTS schema_migrations ('
+                                         '  version    integer not null constraint schema_migrations_pk primary key,'
+                                         '  name       text    not null,'
+                                         '  applied_at text    not null)')
+        return {version for version, in self._backend.execute('migrate', 'SELECT version FROM schema_migrations')}
+
+    def migrate(self) -> List[int]:
+        """Return the versions applied now."""
+        applied_versions: Set[int] = self.applied_versions()
+        versions: List[int] = []
+        for migration in self.migrations():
+            steps: Optional[List[Step]] = migration.steps.get(self._backend.name)
+            if migration.version in applied_versions or steps is None:
+                continue
+            logger.info(f'Apply migration. version={migration.version}, name={migration.name}')
+            self._apply(migration, steps)
+            versions.append(migration.version)
+        return versions
+
+    def _apply(self, migration: Migration, steps: List[Step]) -> None:
+        record: Tuple[str, Sequence[Any]] = (
+            'INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)',
+            (migration.version, migration.name, datetime.now(timezone.utc).isoformat(sep=' ', timespec='seconds')))
+        for step in steps[:-1]:
+            self._run(step)
+        last_step: Step = steps[-1]
+        if isinstance(last_step, list):
+            self._backend.execute_transaction('migrate', [(statement, ()) for statement in last_step] + [record])
+        else:
+            self._run(last_step)
+            self._backend.execute('migrate', *record)
+
+    def _run(self, step: Step) -> None:
+        if isinstance(step, str):
+            self._backend.execute_autocommit('migrate', step)
+        elif isinstance(step, list):
+            self._backend.execute_transaction('migrate', [(statement, ()) for statement in step])
+        else:
+            step(self._backend)
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='migration')
+    logger = logging.getLogger(__name__)
+    migrator = Migrator(StoreBackend.from_url(Env.get_environment('DATABASE_URL', required=True)))
+    print(migrator.migrate())
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import itertools
+import logging
+import threading
+
+import numpy
+from PIL import Image
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.log import Log
+
+HASH_BITS = 64
+
+
+class PerceptualHash:
+    @staticmethod
+    def dhash(image_path: str) -> Optional[int]:
+        """Return the 64 bit difference hash of an image, or None when the file is not an image (e.g. a video)."""
+        try:
+            with Image.open(image_path) as image:
+                # 9x8 pixels give 8 horizontal gradients per row
+                pixels: numpy.ndarray = numpy.asarray(image.convert('L').resize((9, 8), Image.Resampling.BILINEAR),
+                                                      dtype=numpy.int16)
+        except (OSError, ValueError):
+            return None
+
+        gradients: numpy.ndarray = pixels[:, 1:] > pixels[:, :-1]
+        return int.from_bytes(numpy.packbits(gradients).tobytes(), 'big')
+
+    @staticmethod
+    def distance(hash1: int, hash2: int) -> int:
+        return bin(hash1 ^ hash2).count('1')
+
+    @staticmethod
+    def to_signed(phash: int) -> int:
+        # For the bigint column of the database
+        return phash - (1 << HASH_BITS) if phash >= 1 << (HASH_BITS - 1) else phash
+
+    @staticmethod
+    def to_unsigned(phash: int) -> int:
+        return phash & ((1 << HASH_BITS) - 1)
+
+
+class PerceptualHashIndex:
+    """Multi-index hashing over 64 bit hashes.
+
+    A hash is split into chunks, and each chunk is indexed in its own table. When two hashes are within
+    `threshold` bits, at least one of their chunks is within `threshold // chunks` bits, so a lookup only
+    compares the hashes found in the buckets next to the query chunks instead of every entry.
+    """
+
+    def __init__(self, threshold: int, chunks: int = 3) -> None:
+        self.threshold: int = threshold
+        # e.g. 22, 21 and 21 bits for 3 chunks
+        self._chunk_bits: List[int] = [HASH_BITS // chunks + (1 if i < HASH_BITS % chunks else 0)
+                                       for i in range(chunks)]
+        self._chunk_shifts: List[int] = [sum(self._chunk_bits[:i]) for i in range(chunks)]
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(chunks)]
+        # hash -> (url, user_id) of the media uploaded first
+        self._medias: Dict[int, Tuple[str, str]] = {}
+        self._lock: threading.Lock = threading.Lock()
+        # Bit masks flipping up to `threshold // chunks` bits of each chunk
+        radius: int = threshold // chunks
+        self._neighbor_masks: List[List[int]] = [
+            [sum(1 << bit for bit in bits)
+             for r in range(radius + 1) for bits in itertools.combinations(range(width), r)]
+            for width in self._chunk_bits
+        ]
+
+    def __len__(self) -> int:
+        return len(self._medias)
+
+    def _split(self, phash: int) -> Iterable[Tuple[int, int]]:
+        for i, (width, shift) in enumerate(zip(self._chunk_bits, self._chunk_shifts)):
+            yield i, (phash >> shift) & ((1 << width) - 1)
+
+    def add(self, phash: int, media: Tuple[str, str]) -> None:
+        with self._lock:
+            if phash in self._medias:
+                return
+            self._medias[phash] = media
+            for i, chunk in self._split(phash):
+                self._tables[i].setdefault(chunk, []).append(phash)
+
+    def find(self, phash: int) -> Optional[Tuple[Tuple[str, str], int]]:
+        """Return the media and the distance of the nearest hash within the threshold."""
+        nearest: Optional[Tuple[Tuple[str, str], int]] = None
+        with self._lock:
+            for i, chunk in self._split(phash):
+                table: Dict[int, List[int]] = self._tables[i]
+                for mask in self._neighbor_masks[i]:
+                    for candidate in table.get(chunk ^ mask, ()):
+                        distance: int = PerceptualHash.distance(phash, candidate)
+                        if distance <= self.threshold and (nearest is None or distance < nearest[1]):
+                            nearest = (self._medias[candidate], distance)
+        return nearest
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='perceptual_hash')
+    logger = logging.getLogger(__name__)
+    print(PerceptualHash.dhash('./download/test.jpg'))
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import logging
+import queue
+import threading
+
+from typing import Any, Callable, Iterable, List, Optional
+
+# Marks the end of a stream. Each stage forwards it once all of its workers have drained their input.
+_STOP = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable[[Any], Iterable[Any]], workers: int) -> None:
+        self.name: str = name
+        self.func: Callable[[Any], Iterable[Any]] = func
+        self.workers: int = max(1, workers)
+        self._running: int = 0
+        self.errors: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def start(self, input_queue: queue.Queue, output_queue: Optional[queue.Queue]) -> List[threading.Thread]:
+        self._running = self.workers
+        threads: List[threading.Thread] = [
+            threading.Thread(target=self._work, args=(input_queue, output_queue), name=f'{self.name}-{i}',
+                             daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _work(self, input_queue: queue.Queue, output_queue: Optional[queue.Queue]) -> None:
+        while True:
+            item: Any = input_queue.get()
+            if item is _STOP:
+                # Put it back so that the other workers of this stage stop too
+                input_queue.put(_STOP)
+                break
+
+            try:
+                for result in self.func(item):
+                    if output_queue is not None:
+                        output_queue.put(result)
+            except Exception as e:
+                logger.exception(f'Pipeline stage error. stage={self.name}, exception={e.args}')
+                with self._lock:
+                    self.errors += 1
+
+        with self._lock:
+            self._running -= 1
+            if self._running == 0 and output_queue is not None:
+                output_queue.put(_STOP)
+
+
+class Pipeline:
+    def __init__(self, queue_size: int) -> None:
+        self._queue_size: int = queue_size
+        self._stages: List[Stage] = []
+
+    def add_stage(self, name: str, func: Callable[[Any], Iterable[Any]], workers: int = 1) -> 'Pipeline':
+        self._stages.append(Stage(name, func, workers))
+        return self
+
+    @property
+    def errors(self) -> int:
+        """The count of the items dropped by a stage error, which the caller can not report as done."""
+        return sum(stage.errors for stage in self._stages)
+
+    def run(self, source: Iterable[Any]) -> None:
+        # Bounded queues make a slow stage block the put() of the stage before it
+        queues: List[queue.Queue] = [queue.Queue(maxsize=self._queue_size) for _ in self._stages]
+        threads: List[threading.Thread] = []
+        for i, stage in enumerate(self._stages):
+            output_queue: Optional[queue.Queue] = queues[i + 1] if i + 1 < len(queues) else None
+            threads.extend(stage.start(queues[i], output_queue))
+
+        try:
+            for item in source:
+                queues[0].put(item)
+        finally:
+            queues[0].put(_STOP)
+            for thread in threads:
+                thread.join()
+
+
+logger: logging.Logger = logging.getLogger(__name__)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+import dataclasses
+import heapq
+import logging
+import random
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.env import Env
+from app.log import Log
+from app.twitter import TwitterUser
+
+
+@dataclasses.dataclass
+class UserSchedule(object):
+    user: TwitterUser
+    due_at: float
+    interval_seconds: float
+    # EWMA of new media per minute
+    media_rate: float = 0.0
+    last_crawled_at: Optional[float] = None
+
+
+class Scheduler:
+    """Decide when each user is crawled next.
+
+    Every user gets an interval of `INTERVAL * mean(weight) / weight`, where the weight is the EWMA of its new
+    media rate plus the mean rate of all users. The sum of the polling rates is the same as with a flat INTERVAL,
+    but active users are polled more often than quiet ones.
+    """
+
+    def __init__(self, user_list: List[TwitterUser], clock: Callable[[], float] = time.time,
+                 rand: Optional[random.Random] = None) -> None:
+        self._interval_seconds: float = float(Env.get_environment('INTERVAL', default='5')) * 60
+        self._min_seconds: float = float(Env.get_environment('INTERVAL_MIN', default='1')) * 60
+        self._max_seconds: float = float(Env.get_environment('INTERVAL_MAX', default='60')) * 60
+        self._jitter: float = float(Env.get_environment('INTERVAL_JITTER', default='0.1'))
+        self._alpha: float = float(Env.get_environment('INTERVAL_EWMA_ALPHA', default='0.3'))
+        self._clock: Callable[[], float] = clock
+        self._rand: random.Random = rand or random.Random()
+
+        now: float = self._clock()
+        self._schedules: Dict[str, UserSchedule] = {
+            user.id: UserSchedule(user=user, due_at=now, interval_seconds=self._interval_seconds)
+            for user in user_list
+        }
+        # (due_at, order, user_id). Entries superseded by a later complete() are skipped by their order.
+        self._queue: List[Tuple[float, int, str]] = [(now, i, user.id) for i, user in enumerate(user_list)]
+        self._orders: Dict[str, int] = {user.id: i for i, user in enumerate(user_list)}
+        self._order: int = len(user_list)
+
+        logger.debug(f'Scheduler setting info. interval_seconds={self._interval_seconds}, '
+                     f'min_seconds={self._min_seconds}, max_seconds={self._max_seconds}, jitter={self._jitter}, '
+                     f'alpha={self._alpha}')
+
+    def get_schedule(self, user: TwitterUser) -> UserSchedule:
+        return self._schedules[user.id]
+
+    def get_sleep_seconds(self, user: TwitterUser) -> float:
+        return max(0.0, self._schedules[user.id].due_at - self._clock())
+
+    def next_user(self) -> Tuple[TwitterUser, float]:
+        """Return the user due first and the seconds until it is due."""
+        while self._queue[0][1] != self._orders[self._queue[0][2]]:
+            heapq.heappop(self._queue)
+        user: TwitterUser = self._schedules[self._queue[0][2]].user
+        return user, self.get_sleep_seconds(user)
+
+    def _update_media_rate(self, schedule: UserSchedule, new_media_count: int, now: float) -> None:
+        if schedule.last_crawled_at is not None:
+            elapsed_minutes: float = max(now - schedule.last_crawled_at, 1.0) / 60
+            schedule.media_rate += self._alpha * (new_media_count / elapsed_minutes - schedule.media_rate)
+        schedule.last_crawled_at = now
+
+    def _make_interval(self, schedule: UserSchedule) -> float:
+        mean_rate: float = sum(s.media_rate for s in self._schedules.values()) / len(self._schedules)
+        if mean_rate == 0.0:
+            interval: float = self._interval_seconds
+        else:
+            # mean(weight) is twice the mean rate
+            interval = self._interval_seconds * 2 * mean_rate / (schedule.media_rate + mean_rate)
+        interval = min(self._max_seconds, max(self._min_seconds, interval))
+        return interval * (1 + self._rand.uniform(-self._jitter, self._jitter))
+
+    def complete(self, user: TwitterUser, new_media_count: int) -> UserSchedule:
+        """Record a finished crawl and schedule the next one."""
+        now: float = self._clock()
+        schedule: UserSchedule = self._schedules[user.id]
+        self._update_media_rate(schedule, new_media_count, now)
+        schedule.interval_seconds = self._make_interval(schedule)
+        # Counting from the previous due time keeps the crawl time from adding up, unless the crawl overran it
+        schedule.due_at = max(schedule.due_at + schedule.interval_seconds, now)
+
+        heapq.heappush(self._queue, (schedule.due_at, self._order, user.id))
+        self._orders[user.id] = self._order
+        self._order += 1
+        logger.debug(f'Next crawl. user = {user.id}, new_media_count={new_media_count}, '
+                     f'media_rate={schedule.media_rate:.3f}, interval_seconds={schedule.interval_seconds:.0f}')
+        return schedule
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='scheduler')
+    logger = logging.getLogger(__name__)
+    scheduler = Scheduler([TwitterUser(id='user1'), TwitterUser(id='user2')])
+    print(scheduler.complete(TwitterUser(id='user1'), 3))
@@ -1,83 +1,329 @@
 #!/usr/bin/python3
 
+import atexit
+import itertools
 import logging
-import psycopg2
+import threading
 
-from datetime import datetime
-from typing import Tuple, List
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set, Tuple, List
 
 from app.env import Env
+from app.known_tweet_cache import KnownTweetCache
+from app.migration import Migrator
 from app.log import Log
+from app.store_backend import OperationStats, StoreBackend
 from app.tz import Tz
 
+# The statements of the buffered operations, which take the rows of a batch with execute_values
+WRITE_BEHIND_QUERIES: Dict[str, str] = {
+    'insert_tweet_info': 'INSERT INTO uploaded_media_tweet (tweet_id, user_id, tweet_date, add_date) '
+                         'VALUES %s '
+                         'ON CONFLICT (tweet_id) DO NOTHING',
+    'insert_failed_upload_media': 'INSERT INTO failed_upload_media (url, description, user_id) '
+                                  'VALUES %s '
+                                  'ON CONFLICT (url) DO NOTHING',
+    'delete_failed_upload_media': 'DELETE FROM failed_upload_media '
+                                  'WHERE url IN (VALUES %s)',
+}
+
 
 class Store:
     def __init__(self) -> None:
         self._db_url: str = Env.get_environment('DATABASE_URL', required=True)
-        self._sslmode: str = Env.get_environment('DATABASE_SSLMODE', default='require', required=False)
         self._tz = Tz.timezone()
+        # PostgreSQL for postgres://, or an embedded SQLite for sqlite:///<path>
+        self._backend: StoreBackend = StoreBackend.from_url(self._db_url)
+        # Write-behind buffer of (operation, row), flushed when it has this many rows or at this interval
+        self._write_batch_size: int = int(Env.get_environment('DATABASE_WRITE_BATCH_SIZE', default='100'))
+        self._write_interval: float = float(Env.get_environment('DATABASE_WRITE_INTERVAL_MS', default='1000')) / 1000
+        # The rows kept while the database cannot be written, over which the oldest ones are dropped
+        self._write_buffer_size: int = int(Env.get_environment('DATABASE_WRITE_BUFFER_SIZE', default='10000'))
+        self._writes: List[Tuple[str, tuple]] = []
+        self._writes_lock: threading.Lock = threading.Lock()
+        self._flush_lock: threading.Lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._flusher_stop: threading.Event = threading.Event()
+        # The tweet ids known to be stored are not sent to the database again. 0 disables the cache
+        known_tweet_cache_size: int = int(Env.get_environment('KNOWN_TWEET_CACHE_SIZE', default='1000000'))
+        self._known_tweets: Optional[KnownTweetCache] = \
+            KnownTweetCache(known_tweet_cache_size) if known_tweet_cache_size > 0 else None
+        # Exiting by SystemExit, including SIGTERM handled by run.py, writes the buffered rows
+        atexit.register(self.close)
+
+        logger.debug(f'Store setting info. _db_url={self._db_url}, _backend={type(self._backend).__name__}')
+
+    def migrate(self) -> None:
+        """Bring the tables up to the version of this code, which is run once at startup."""
+        versions: List[int] = Migrator(self._backend).migrate()
+        logger.debug(f'Migrated. versions={versions}')
+
+    def stats(self) -> Dict[str, OperationStats]:
+        return self._backend.stats()
+
+    def log_stats(self) -> None:
+        self._backend.log_stats()
+        if self._known_tweets is not None:
+            self._known_tweets.log_stats()
+
+    def _write_behind(self, operation: str, row: tuple) -> None:
+        with self._writes_lock:
+            self._writes.append((operation, row))
+            is_full: bool = len(self._writes) >= self._write_batch_size
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='store_flusher', daemon=True)
+                self._flusher.start()
+        if is_full:
+            self.flush()
+
+    def _flush_loop(self) -> None:
+        while not self._flusher_stop.wait(self._write_interval):
+            self.flush()
+
+    def flush(self) -> bool:
+        """Write the buffered rows with a statement per run of the same operation, in the order they were added.
+
+        When a batch fails by the data, its rows are written one at a time, and a row which fails again is dropped.
+        On a transient error of the database, the rows not written are put back to the buffer for the next flush,
+        and False is returned.
+        """
+        with self._flush_lock:
+            with self._writes_lock:
+                writes: List[Tuple[str, tuple]] = self._writes
+                self._writes = []
+            if not writes:
+                return True
 
-        logger.debug(f'Store setting info. _db_url={self._db_url}, _sslmode={self._sslmode}')
+            # The rows written or dropped, which are not put back
+            done: int = 0
+            try:
+                for operation, group in itertools.groupby(writes, key=lambda write: write[0]):
+                    rows: List[tuple] = [row for _, row in group]
+                    try:
+                        self._backend.execute_values(operation, WRITE_BEHIND_QUERIES[operation], rows)
+                    except Exception as e:
+                        if self._backend.is_transient_error(e):
+                            raise
+                        logger.warning(f'Flush {operation} failed, write the rows one at a time. rows={len(rows)}, '
+                                       f'exception={e.args}')
+                        for row in rows:
+                            self._write_row(operation, row)
+                            done += 1
+                    else:
+                        done += len(rows)
+                    logger.debug(f'Flush {operation}. rows={len(rows)}')
+            except Exception as e:
+                logger.exception(f'Flush failed. rows={len(writes) - done}, exception={e.args}')
+                self._put_back(writes[done:])
+                return False
+            return True
 
-    # noinspection PyUnresolvedReferences
-    def _get_connection(self) -> psycopg2.extensions.connection:
+    def _write_row(self, operation: str, row: tuple) -> None:
         try:
-            connection = psycopg2.connect(self._db_url, sslmode=self._sslmode)
+            self._backend.execute_values(operation, WRITE_BEHIND_QUERIES[operation], [row])
         except Exception as e:
-            logger.exception(f'Connection error. exception={e.args}')
-            raise
+            if self._backend.is_transient_error(e):
+                raise
+            # The row would fail every flush, and keep the checkpoints of the crawler from moving
+            logger.error(f'Drop the row which cannot be written. operation={operation}, row={row}, '
+                         f'exception={e.args}')
 
-        connection.autocommit = True
-        return connection
+    def _put_back(self, writes: List[Tuple[str, tuple]]) -> None:
+        with self._writes_lock:
+            self._writes[:0] = writes
+            dropped: List[Tuple[str, tuple]] = self._writes[:max(0, len(self._writes) - self._write_buffer_size)]
+            del self._writes[:len(dropped)]
+        if dropped:
+            logger.error(f'Drop the oldest buffered rows. rows={len(dropped)}, buffer_size={self._write_buffer_size}')
+
+    def close(self) -> None:
+        self._flusher_stop.set()
+        self.flush()
+        self._backend.close()
 
     def insert_tweet_info(self, tweet_id: str, user_id: str, tweet_date: str) -> None:
         logger.debug(f'Insert tweet_id={tweet_id}, user_id={user_id}, and tweet_date={tweet_date} '
                      f'into failed_upload_media table.')
-        add_date: str = datetime.now(self._tz).strftime('%Y-%m-%d %H:%M:%S')
-        query: str = 'INSERT INTO uploaded_media_tweet (tweet_id, user_id, tweet_date, add_date) ' \
-                     'VALUES (%s, %s, %s, %s)'
-        with self._get_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query=query, vars=(tweet_id, user_id, tweet_date, add_date))
+        # add_date is a timestamptz, so it has the offset, while tweet_date is in UTC
+        add_date: str = datetime.now(self._tz).isoformat(sep=' ', timespec='seconds')
+        self._write_behind('insert_tweet_info', (tweet_id, user_id, tweet_date, add_date))
+        if self._known_tweets is not None:
+            self._known_tweets.add(tweet_id)
 
     def insert_failed_upload_media(self, url: str, description: str, user_id: str) -> None:
         logger.debug(f'Insert url={url}, description={description} and user_id={user_id} '
                      f'into failed_upload_media table.')
-        query: str = 'INSERT INTO failed_upload_media (url, description, user_id) ' \
-                     'VALUES (%s, %s, %s)'
-        with self._get_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query=query, vars=(url, description, user_id))
+        self._write_behind('insert_failed_upload_media', (url, description, user_id))
 
     def fetch_not_added_tweet_ids(self, tweet_ids: List[str]) -> List[Tuple[str]]:
         logger.debug('Fetch not added tweets from uploaded_media_tweet table.')
+        # The buffered tweets are added before they are read
+        self.flush()
+        if self._known_tweets is None:
+            return self._select_not_added_tweet_ids(tweet_ids)
+        if not self._known_tweets.is_warm:
+            self._warm_known_tweets(self._known_tweets)
+
+        not_added_tweet_ids, unknown_tweet_ids = self._known_tweets.classify(tweet_ids)
+        if unknown_tweet_ids:
+            not_added_unknown_ids: Set[str] = {tweet_id for tweet_id, in
+                                               self._select_not_added_tweet_ids(unknown_tweet_ids)}
+            for tweet_id in unknown_tweet_ids:
+                if tweet_id in not_added_unknown_ids:
+                    not_added_tweet_ids.append(tweet_id)
+                else:
+                    self._known_tweets.add(tweet_id)
+        not_added: Set[str] = set(not_added_tweet_ids)
+        return [(tweet_id,) for tweet_id in tweet_ids if tweet_id in not_added]
+
+    def _warm_known_tweets(self, known_tweets: KnownTweetCache) -> None:
+        # Only the largest ids are kept, and the one more id makes the cache raise the watermark over the rest
+        query: str = 'SELECT tweet_id ' \
+                     'FROM uploaded_media_tweet ' \
+                     'ORDER BY tweet_id DESC ' \
+                     'LIMIT %s'
+        rows: List[Tuple[int]] = self._backend.execute('warm_known_tweets', query, (known_tweets.max_size + 1,))
+        known_tweets.warm(str(tweet_id) for tweet_id, in rows)
+
+    def _select_not_added_tweet_ids(self, tweet_ids: List[str]) -> List[Tuple[str]]:
         query: str = 'SELECT T2.tweet_id ' \
-                     'FROM uploaded_media_tweet T1 ' \
-                     'RIGHT OUTER JOIN' \
-                     '  (SELECT unnest(%s) as tweet_id) T2 ' \
+                     'FROM (SELECT unnest(%s::bigint[]) as tweet_id) T2 ' \
+                     'LEFT OUTER JOIN uploaded_media_tweet T1 ' \
                      'ON T1.tweet_id = T2.tweet_id ' \
                      'WHERE T1.tweet_id is null'
-        with self._get_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query=query, vars=(tweet_ids,))
-                return cursor.fetchall()
-
-    def fetch_all_failed_upload_medias(self) -> List[Tuple[str, str, str]]:
-        logger.debug('Fetch url and description from failed_upload_media table.')
-        query: str = 'SELECT url, description, user_id ' \
-                     'FROM failed_upload_media'
-        with self._get_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query=query)
-                return cursor.fetchall()
+        int_tweet_ids: List[int] = [int(tweet_id) for tweet_id in tweet_ids]
+        rows: List[Tuple[int]] = self._backend.execute('fetch_not_added_tweet_ids', query,
+                                                       (self._backend.array(int_tweet_ids),))
+        return [(str(tweet_id),) for tweet_id, in rows]
+
+    def fetch_due_failed_upload_medias(self, limit: int) -> List[Tuple[str, str, str, int]]:
+        logger.debug(f'Fetch url, description, user_id and attempts of limit={limit} due rows '
+                     f'from failed_upload_media table.')
+        self.flush()
+        query: str = 'SELECT url, description, user_id, attempts ' \
+                     'FROM failed_upload_media ' \
+                     'WHERE next_attempt_at <= %s ' \
+                     'ORDER BY next_attempt_at ' \
+                     'LIMIT %s'
+        # next_attempt_at is written in UTC, so that SQLite can compare it as text
+        now: str = datetime.now(timezone.utc).isoformat(sep=' ', timespec='seconds')
+        return self._backend.execute('fetch_due_failed_upload_medias', query, (now, limit))
+
+    def update_failed_upload_attempt(self, url: str, last_error: str, retry_seconds: float) -> None:
+        logger.debug(f'Update url={url}, last_error={last_error} and retry_seconds={retry_seconds} '
+                     f'in failed_upload_media table.')
+        next_attempt_at: str = (datetime.now(timezone.utc) + timedelta(seconds=retry_seconds)) \
+            .isoformat(sep=' ', timespec='seconds')
+        query: str = 'UPDATE failed_upload_media ' \
+                     'SET attempts = attempts + 1, ' \
+                     '    last_error = %s, ' \
+                     '    next_attempt_at = %s ' \
+                     'WHERE url = %s'
+        self._backend.execute('update_failed_upload_attempt', query, (last_error, next_attempt_at, url))
+
+    def move_failed_upload_media_to_dead(self, url: str, last_error: str) -> None:
+        logger.debug(f'Move url={url} and last_error={last_error} '
+                     f'from failed_upload_media table into failed_upload_media_dead table.')
+        dead_date: str = datetime.now(timezone.utc).isoformat(sep=' ', timespec='seconds')
+        self._backend.execute_transaction('move_failed_upload_media_to_dead', [
+            ('INSERT INTO failed_upload_media_dead (url, description, user_id, attempts, last_error, dead_date) '
+             'SELECT url, description, user_id, attempts + 1, %s, %s '
+             'FROM failed_upload_media '
+             'WHERE url = %s '
+             'ON CONFLICT (url) DO NOTHING', (last_error, dead_date, url)),
+            ('DELETE FROM failed_upload_media '
+             'WHERE url = %s', (url,)),
+        ])
 
     def delete_failed_upload_media(self, url: str) -> None:
         logger.debug(f'Delete row url={url} from failed_upload_media table.')
-        query: str = 'DELETE FROM failed_upload_media ' \
-                     'WHERE url = %s'
-        with self._get_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query=query, vars=(url,))
+        self._write_behind('delete_failed_upload_media', (url,))
+
+    def insert_uploaded_media_hash(self, media_hash: str, url: str, user_id: str) -> None:
+        logger.debug(f'Insert media_hash={media_hash}, url={url} and user_id={user_id} '
+                     f'into uploaded_media_hash table.')
+        add_date: str = datetime.now(self._tz).strftime('%Y-%m-%d %H:%M:%S')
+        query: str = 'INSERT INTO uploaded_media_hash (media_hash, url, user_id, add_date) ' \
+                     'VALUES (%s, %s, %s, %s) ' \
+                     'ON CONFLICT (media_hash) DO NOTHING'
+        self._backend.execute('insert_uploaded_media_hash', query, (media_hash, url, user_id, add_date))
+
+    def fetch_uploaded_media_hash(self, media_hash: str) -> Optional[Tuple[str, str]]:
+        logger.debug(f'Fetch url and user_id of media_hash={media_hash} from uploaded_media_hash table.')
+        query: str = 'SELECT url, user_id ' \
+                     'FROM uploaded_media_hash ' \
+                     'WHERE media_hash = %s'
+        rows: List[Tuple[str, str]] = self._backend.execute('fetch_uploaded_media_hash', query, (media_hash,))
+        return rows[0] if rows else None
+
+    def insert_uploaded_media_phash(self, phash: int, url: str, user_id: str) -> None:
+        logger.debug(f'Insert phash={phash}, url={url} and user_id={user_id} into uploaded_media_phash table.')
+        add_date: str = datetime.now(self._tz).strftime('%Y-%m-%d %H:%M:%S')
+        query: str = 'INSERT INTO uploaded_media_phash (phash, url, user_id, add_date) ' \
+                     'VALUES (%s, %s, %s, %s)'
+        self._backend.execute('insert_uploaded_media_phash', query, (phash, url, user_id, add_date))
+
+    def fetch_all_uploaded_media_phashes(self) -> List[Tuple[int, str, str]]:
+        logger.debug('Fetch phash, url and user_id from uploaded_media_phash table.')
+        query: str = 'SELECT phash, url, user_id ' \
+                     'FROM uploaded_media_phash'
+        return self._backend.execute('fetch_all_uploaded_media_phashes', query)
+
+    def upsert_since_id(self, user_id: str, since_id: int) -> None:
+        logger.debug(f'Upsert user_id={user_id} and since_id={since_id} into twitter_user table.')
+        update_date: str = datetime.now(self._tz).strftime('%Y-%m-%d %H:%M:%S')
+        query: str = 'INSERT INTO twitter_user (user_id, since_id, update_date) ' \
+                     'VALUES (%s, %s, %s) ' \
+                     'ON CONFLICT (user_id) DO UPDATE ' \
+                     'SET since_id = GREATEST(twitter_user.since_id, EXCLUDED.since_id), ' \
+                     '    update_date = EXCLUDED.update_date'
+        self._backend.execute('upsert_since_id', query, (user_id, since_id, update_date))
+
+    def fetch_since_ids(self, user_ids: List[str]) -> List[Tuple[str, int]]:
+        logger.debug('Fetch user_id and since_id from twitter_user table.')
+        query: str = 'SELECT user_id, since_id ' \
+                     'FROM twitter_user ' \
+                     'WHERE user_id = ANY(%s)'
+        return self._backend.execute('fetch_since_ids', query, (self._backend.array(user_ids),))
+
+    def upsert_fav_snapshot(self, user_id: str, fav_snapshot: bytes) -> None:
+        logger.debug(f'Upsert user_id={user_id} and fav_snapshot={len(fav_snapshot)} bytes into twitter_user table.')
+        update_date: str = datetime.now(self._tz).strftime('%Y-%m-%d %H:%M:%S')
+        query: str = 'INSERT INTO twitter_user (user_id, fav_snapshot, update_date) ' \
+                     'VALUES (%s, %s, %s) ' \
+                     'ON CONFLICT (user_id) DO UPDATE ' \
+                     'SET fav_snapshot = EXCLUDED.fav_snapshot, ' \
+                     '    update_date = EXCLUDED.update_date'
+        self._backend.execute('upsert_fav_snapshot', query, (user_id, self._backend.binary(fav_snapshot),
+                                                             update_date))
+
+    def fetch_fav_snapshots(self, user_ids: List[str]) -> List[Tuple[str, bytes]]:
+        logger.debug('Fetch user_id and fav_snapshot from twitter_user table.')
+        query: str = 'SELECT user_id, fav_snapshot ' \
+                     'FROM twitter_user ' \
+                     'WHERE user_id = ANY(%s) AND fav_snapshot IS NOT NULL'
+        rows: List[Tuple[str, bytes]] = self._backend.execute('fetch_fav_snapshots', query,
+                                                              (self._backend.array(user_ids),))
+        # bytea is returned as memoryview by PostgreSQL
+        return [(user_id, bytes(fav_snapshot)) for user_id, fav_snapshot in rows]
+
+    def upsert_google_album(self, album_title: str, album_id: str) -> None:
+        logger.debug(f'Upsert album_title={album_title} and album_id={album_id} into google_album table.')
+        update_date: str = datetime.now(self._tz).strftime('%Y-%m-%d %H:%M:%S')
+        query: str = 'INSERT INTO google_album (album_title, album_id, update_date) ' \
+                     'VALUES (%s, %s, %s) ' \
+                     'ON CONFLICT (album_title) DO UPDATE ' \
+                     'SET album_id = EXCLUDED.album_id, ' \
+                     '    update_date = EXCLUDED.update_date'
+        self._backend.execute('upsert_google_album', query, (album_title, album_id, update_date))
+
+    def fetch_google_album_id(self, album_title: str) -> Optional[str]:
+        logger.debug(f'Fetch album_id of album_title={album_title} from google_album table.')
+        query: str = 'SELECT album_id ' \
+                     'FROM google_album ' \
+                     'WHERE album_title = %s'
+        rows: List[Tuple[str]] = self._backend.execute('fetch_google_album_id', query, (album_title,))
+        return rows[0][0] if rows else None
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+
+import abc
+import contextlib
+import dataclasses
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from typing import Any, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from app.env import Env
+from app.log import Log
+
+SCHEMA_FILE = f'{os.path.dirname(os.path.abspath(__file__))}/../database.sql'
+SQLITE_SCHEME = 'sqlite://'
+# A writer waits this long for the other writer of a SQLite database
+SQLITE_BUSY_TIMEOUT_SECONDS = 30
+
+
+@dataclasses.dataclass
+class OperationStats(object):
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    @property
+    def average_seconds(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total_seconds / self.count
+
+
+class StoreBackend(abc.ABC):
+    """The database which Store runs its statements on.
+
+    The statements are written for PostgreSQL with %s placeholders, and a backend rewrites them for its database.
+    A list parameter is passed by array(), and a bytes parameter by binary().
+    """
+    # The dialect, which picks the statements of a migration
+    name: str = ''
+
+    def __init__(self) -> None:
+        self._stats: Dict[str, OperationStats] = {}
+        self._stats_lock: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def from_url(db_url: str) -> 'StoreBackend':
+        """Select the backend by the scheme of DATABASE_URL."""
+        if db_url.startswith(SQLITE_SCHEME):
+            # sqlite:///relative/path and sqlite:////absolute/path
+            return SQLiteBackend(db_url[len(SQLITE_SCHEME) + 1:])
+        if db_url.startswith(('postgres://', 'postgresql://')):
+            return PostgresBackend(db_url)
+        raise ValueError(f'Unsupported database url. db_url={db_url}')
+
+    @abc.abstractmethod
+    def _connection(self) -> ContextManager[Any]:
+        raise NotImplementedError
+
+    def _autocommit_connection(self) -> ContextManager[Any]:
+        """Lend a connection on which each statement commits by itself, outside of any transaction."""
+        return self._connection()
+
+    @abc.abstractmethod
+    def _execute(self, connection: Any, query: str, params: Sequence[Any]) -> List[tuple]:
+        raise NotImplementedError
+
+    @staticmethod
+    @abc.abstractmethod
+    def is_transient_error(error: Exception) -> bool:
+        """Return whether the statement may succeed when it is run again, as the error is not from the data."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _execute_values(self, connection: Any, query: str, rows: List[tuple]) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _execute_transaction(self, connection: Any, statements: List[Tuple[str, Sequence[Any]]]) -> None:
+        raise NotImplementedError
+
+    @staticmethod
+    def array(values: List[Any]) -> Any:
+        return values
+
+    @staticmethod
+    def binary(data: bytes) -> Any:
+        return data
+
+    def close(self) -> None:
+        pass
+
+    def execute(self, operation: str, query: str, params: Sequence[Any] = ()) -> List[tuple]:
+        """Run a statement, and return the rows it selected."""
+        started_at: float = time.monotonic()
+        with self._connection() as connection:
+            rows: List[tuple] = self._execute(connection, query, params)
+        self._record(operation, time.monotonic() - started_at)
+        return rows
+
+    def execute_autocommit(self, operation: str, query: str, params: Sequence[Any] = ()) -> List[tuple]:
+        """Run a statement which cannot be in a transaction block, such as CREATE INDEX CONCURRENTLY."""
+        started_at: float = time.monotonic()
+        with self._autocommit_connection() as connection:
+            rows: List[tuple] = self._execute(connection, query, params)
+        self._record(operation, time.monotonic() - started_at)
+        return rows
+
+    def execute_values(self, operation: str, query: str, rows: List[tuple]) -> None:
+        """Run a statement with "VALUES %s" for all of the rows in a transaction."""
+        started_at: float = time.monotonic()
+        with self._connection() as connection:
+            self._execute_values(connection, query, rows)
+        self._record(operation, time.monotonic() - started_at)
+
+    def execute_transaction(self, operation: str, statements: List[Tuple[str, Sequence[Any]]]) -> None:
+        """Run the statements in a transaction."""
+        started_at: float = time.monotonic()
+        # The transaction is made by _execute_transaction itself
+        with self._autocommit_connection() as connection:
+            self._execute_transaction(connection, statements)
+        self._record(operation, time.monotonic() - started_at)
+
+    def _record(self, operation: str, elapsed: float) -> None:
+        with self._stats_lock:
+            stats: OperationStats = self._stats.setdefault(operation, OperationStats())
+            stats.count += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def stats(self) -> Dict[str, OperationStats]:
+        with self._stats_lock:
+            return {operation: dataclasses.replace(stats) for operation, stats in self._stats.items()}
+
+    def log_stats(self) -> None:
+        for operation, stats in sorted(self.stats().items()):
+            logger.debug(f'Store stats. operation={operation}, count={stats.count}, '
+                         f'average_ms={stats.average_seconds * 1000:.1f}, max_ms={stats.max_seconds * 1000:.1f}')
+
+
+class PostgresBackend(StoreBackend):
+    name = 'postgres'
+
+    def __init__(self, db_url: str) -> None:
+        super().__init__()
+        self._db_url: str = db_url
+        self._sslmode: str = Env.get_environment('DATABASE_SSLMODE', default='require', required=False)
+        # ThreadedConnectionPool closes a returned connection when it already keeps this many idle ones
+        self._pool_min: int = int(Env.get_environment('DATABASE_POOL_MIN', default='4'))
+        self._pool_max: int = int(Env.get_environment('DATABASE_POOL_MAX', default='8'))
+        # A connection idle longer than this is checked with "SELECT 1" before it is used
+        self._pool_check_seconds: float = float(Env.get_environment('DATABASE_POOL_CHECK_SECONDS', default='30'))
+        # The pool is made by the first operation, and shared by all of the operations
+        self._pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+        self._pool_lock: threading.Lock = threading.Lock()
+        # ThreadedConnectionPool raises PoolError when all of the connections are used, so the callers wait here
+        self._pool_semaphore: threading.BoundedSemaphore = threading.BoundedSemaphore(self._pool_max)
+        self._last_used: Dict[int, float] = {}
+
+        logger.debug(f'PostgresBackend setting info. _sslmode={self._sslmode}, _pool_min={self._pool_min}, '
+                     f'_pool_max={self._pool_max}')
+
+    def _get_pool(self) -> psycopg2.pool.ThreadedConnectionPool:
+        with self._pool_lock:
+            if self._pool is None:
+                # A timestamp without a time zone, such as the date of a tweet, is in UTC
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self._pool_min, self._pool_max, self._db_url,
+                                                                  sslmode=self._sslmode, options='-c TimeZone=UTC')
+            return self._pool
+
+    # noinspection PyUnresolvedReferences
+    def _is_healthy(self, connection: psycopg2.extensions.connection) -> bool:
+        if connection.closed != 0:
+            return False
+        # A new connection has no last use
+        last_used: Optional[float] = self._last_used.get(id(connection))
+        if last_used is None or time.monotonic() - last_used < self._pool_check_seconds:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except psycopg2.Error as e:
+            logger.warning(f'Connection is broken. exception={e.args}')
+            return False
+        return True
+
+    # noinspection PyUnresolvedReferences
+    def _get_connection(self) -> psycopg2.extensions.connection:
+        """Take a healthy connection from the pool, reconnecting instead of a broken one."""
+        try:
+            pool: psycopg2.pool.ThreadedConnectionPool = self._get_pool()
+            connection = pool.getconn()
+            if not self._is_healthy(connection):
+                self._put_connection(connection, close=True)
+                connection = pool.getconn()
+        except Exception as e:
+            logger.exception(f'Connection error. exception={e.args}')
+            raise
+
+        connection.autocommit = True
+        return connection
+
+    # noinspection PyUnresolvedReferences
+    def _put_connection(self, connection: psycopg2.extensions.connection, close: bool = False) -> None:
+        if close:
+            self._last_used.pop(id(connection), None)
+        else:
+            self._last_used[id(connection)] = time.monotonic()
+        self._get_pool().putconn(connection, close=close)
+
+    # noinspection PyUnresolvedReferences
+    @contextlib.contextmanager
+    def _connection(self, transaction: bool = True) -> Iterator[psycopg2.extensions.connection]:
+        """Lend a pooled connection to an operation, in a transaction unless `transaction` is False."""
+        with self._pool_semaphore:
+            connection = self._get_connection()
+            try:
+                # Since psycopg2 2.9, "with connection" opens a transaction even in autocommit mode
+                with connection if transaction else contextlib.nullcontext():
+                    yield connection
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # The connection may be broken, so the pool makes a new one instead
+                self._put_connection(connection, close=True)
+                raise
+            except BaseException:
+                self._put_connection(connection)
+                raise
+            self._put_connection(connection)
+
+    def _autocommit_connection(self) -> ContextManager[psycopg2.extensions.connection]:
+        return self._connection(transaction=False)
+
+    # noinspection PyUnresolvedReferences
+    def _execute(self, connection: psycopg2.extensions.connection, query: str, params: Sequence[Any]) -> List[tuple]:
+        with connection.cursor() as cursor:
+            cursor.execute(query=query, vars=params)
+            return cursor.fetchall() if cursor.description is not None else []
+
+    # noinspection PyUnresolvedReferences
+    def _execute_values(self, connection: psycopg2.extensions.connection, query: str, rows: List[tuple]) -> None:
+        with connection.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, query, rows, page_size=len(rows))
+
+    # noinspection PyUnresolvedReferences
+    def _execute_transaction(self, connection: psycopg2.extensions.connection,
+                             statements: List[Tuple[str, Sequence[Any]]]) -> None:
+        # The connection is in autocommit mode, which leaves the transaction to BEGIN and COMMIT
+        with connection.cursor() as cursor:
+            cursor.execute('BEGIN')
+            try:
+                for query, params in statements:
+                    cursor.execute(query=query, vars=params)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    @staticmethod
+    def binary(data: bytes) -> Any:
+        return psycopg2.Binary(data)
+
+    @staticmethod
+    def is_transient_error(error: Exception) -> bool:
+        # e.g. the server closed the connection, while a constraint violation or bad data is a DatabaseError
+        return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def close(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
+
+
+class SQLiteBackend(StoreBackend):
+    """An embedded database in a file, for running without a PostgreSQL server.
+
+    Each thread has its own connection in WAL mode, so the reads do not wait for the flusher. The statements are
+    rewritten once and then found in the prepared statement cache of the connection. The tables are made from
+    database.sql when the file has none.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._path: str = path
+        self._local: threading.local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock: threading.Lock = threading.Lock()
+
+        logger.debug(f'SQLiteBackend setting info. _path={self._path}')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def translate(query: str) -> str:
+        """Rewrite a PostgreSQL statement for SQLite, where a list parameter is a JSON array."""
+        query = re.sub(r'= ANY\(%s\)', 'IN (SELECT value FROM json_each(%s))', query)
+        query = re.sub(r'SELECT unnest\(%s(::\w+\[\])?\) as (\w+)', r'SELECT value as \2 FROM json_each(%s)', query)
+        query = query.replace('GREATEST(', 'MAX(')
+        return query.replace('%s', '?')
+
+    @staticmethod
+    def array(values: List[Any]) -> Any:
+        return json.dumps(values)
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None runs a statement in its own transaction, unless it is in BEGIN and COMMIT
+        connection: sqlite3.Connection = sqlite3.connect(self._path, timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+                                                         isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # A commit in WAL mode is durable after the next checkpoint, and the database is never corrupted
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connections_lock:
+            if not self._connections:
+                self._create_tables(connection)
+            self._connections.append(connection)
+        return connection
+
+    def _create_tables(self, connection: sqlite3.Connection) -> None:
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone() is not None:
+            return
+        logger.info(f'Create the tables. path={self._path}')
+        with open(SCHEMA_FILE) as f:
+            connection.executescript(f.read())
+
+    @contextlib.contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        connection: Optional[sqlite3.Connection] = getattr(self._local, 'connection', None)
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception as e:
+                logger.exception(f'Connection error. exception={e.args}')
+                raise
+            self._local.connection = connection
+        yield connection
+
+    def _execute(self, connection: sqlite3.Connection, query: str, params: Sequence[Any]) -> List[tuple]:
+        return connection.execute(self.translate(query), params).fetchall()
+
+    def _execute_values(self, connection: sqlite3.Connection, query: str, rows: List[tuple]) -> None:
+        # A statement per row is as fast as a multi-row VALUES in SQLite, as long as they are in a transaction
+        placeholders: str = ', '.join(['%s'] * len(rows[0]))
+        statement: str = self.translate(query.replace('VALUES %s', f'VALUES ({placeholders})'))
+        with self._transaction(connection):
+            connection.executemany(statement, rows)
+
+    def _execute_transaction(self, connection: sqlite3.Connection,
+                             statements: List[Tuple[str, Sequence[Any]]]) -> None:
+        with self._transaction(connection):
+            for query, params in statements:
+                connection.execute(self.translate(query), params)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(connection: sqlite3.Connection) -> Iterator[None]:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @staticmethod
+    def is_transient_error(error: Exception) -> bool:
+        # OperationalError is also raised for a missing table, which does not go away by writing again
+        return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    Log.init_logger(log_name='store_backend')
+    logger = logging.getLogger(__name__)
+    backend = StoreBackend.from_url(Env.get_environment('DATABASE_URL', required=True))
+    print(backend.execute('select', 'SELECT 1'))
@@ -1,12 +1,14 @@
 #!/usr/bin/python3
 
+import array
+import bisect
 import dataclasses
 import dataclasses_json
 import logging
 import re
 import tweepy
 
-from typing import List, Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from app.env import Env
 from app.instagram import Instagram
@@ -14,23 +16,88 @@ from app.log import Log
 from app.util import has_attributes
 
 
+class FavoriteSnapshot:
+    """Sorted ids of the favorited tweets, 8 bytes per tweet."""
+
+    def __init__(self, tweet_ids: Iterable[int] = ()) -> None:
+        self._tweet_ids: array.array = array.array('q', sorted(set(tweet_ids)))
+        self.is_stored: bool = False
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'FavoriteSnapshot':
+        snapshot: FavoriteSnapshot = cls()
+        snapshot._tweet_ids.frombytes(data)
+        snapshot.is_stored = True
+        return snapshot
+
+    def to_bytes(self) -> bytes:
+        return self._tweet_ids.tobytes()
+
+    def __len__(self) -> int:
+        return len(self._tweet_ids)
+
+    def __contains__(self, tweet_id: object) -> bool:
+        if not isinstance(tweet_id, int):
+            return False
+        i: int = bisect.bisect_left(self._tweet_ids, tweet_id)
+        return i < len(self._tweet_ids) and self._tweet_ids[i] == tweet_id
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FavoriteSnapshot) and self._tweet_ids == other._tweet_ids
+
+    def union(self, tweet_ids: Iterable[int]) -> 'FavoriteSnapshot':
+        return FavoriteSnapshot(list(self._tweet_ids) + list(tweet_ids))
+
+
 @dataclasses.dataclass
 class TwitterUser(object):
     id: str = ''
     since_id: int = 1
+    fav_snapshot: Optional[FavoriteSnapshot] = dataclasses.field(default=None, compare=False, repr=False)
+    # Number of finished favorites scans, which decides the next deep scan
+    fav_scans: int = dataclasses.field(default=0, compare=False, repr=False)
+
+
+@dataclasses.dataclass
+class CrawlProgress(object):
+    """What the pages of a cycle have read, which is given to the TwitterUser only once the cycle is stored."""
+    since_id: int = 1
+    fav_tweet_ids: Set[str] = dataclasses.field(default_factory=set)
 
 
 @dataclasses_json.dataclass_json
 @dataclasses.dataclass
 class TweetMedia(object):
+    """The fields of a tweet used to save its media.
+
+    The tweepy.Status is not kept, so that its nested objects and raw json are freed right after parsing.
+    """
+    __slots__ = ('urls', 'id_str', 'screen_name', 'user_name', 'full_text', 'created_at')
     urls: List[str]
-    tweet: tweepy.Status
+    id_str: str
+    screen_name: str
+    user_name: str
+    full_text: str
+    created_at: str
+
+    @classmethod
+    def from_status(cls, urls: List[str], tweet: tweepy.Status) -> 'TweetMedia':
+        return cls(urls=urls, id_str=tweet.id_str, screen_name=tweet.user.screen_name, user_name=tweet.user.name,
+                   full_text=tweet.full_text, created_at=str(tweet.created_at))
+
+    @property
+    def permalink(self) -> str:
+        return f'https://twitter.com/{self.screen_name}/status/{self.id_str}'
+
+    @property
+    def description(self) -> str:
+        return f'{self.user_name}\n' \
+               f'@{self.screen_name}\n' \
+               f'{self.full_text}'
 
     def show_info(self) -> None:
-        tweet: tweepy.Status = self.tweet
-        urls: List[str] = self.urls
-        logger.info(f'user_id={tweet.user.screen_name}, tweet_date={str(tweet.created_at)}, '
-                    f'permalink={Twitter.make_tweet_permalink(tweet)}, media_urls={urls}')
+        logger.info(f'user_id={self.screen_name}, tweet_date={self.created_at}, '
+                    f'permalink={self.permalink}, media_urls={self.urls}')
 
 
 class Twitter:
@@ -38,7 +105,10 @@ class Twitter:
         self.tweet_page: int = int(Env.get_environment('TWEET_PAGES', default='25'))
         self.tweet_count: int = int(Env.get_environment('TWEET_COUNT', default='200'))
         self.mode: str = Env.get_environment('MODE_SPECIFIED', default='rt')
-        self._last_fav_result: Dict[str, TweetMedia] = {}
+        self.fav_known_run: int = int(Env.get_environment('FAV_KNOWN_RUN', default='20'))
+        self.fav_deep_scan_cycles: int = int(Env.get_environment('FAV_DEEP_SCAN_CYCLES', default='24'))
+        # Returns the tweet ids already saved in the Store. Set by Crawler.
+        self.known_tweet_ids: Callable[[List[str]], Set[str]] = lambda tweet_ids: set()
 
         consumer_key: str = Env.get_environment('TWITTER_CONSUMER_KEY', required=True)
         consumer_secret: str = Env.get_environment('TWITTER_CONSUMER_SECRET', required=True)
@@ -51,7 +121,8 @@ class Twitter:
                                           wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
 
         logger.debug(f'Twitter setting info. tweet_page={self.tweet_page}, tweet_count={self.tweet_count}, '
-                     f'mode={self.mode}')
+                     f'mode={self.mode}, fav_known_run={self.fav_known_run}, '
+                     f'fav_deep_scan_cycles={self.fav_deep_scan_cycles}')
 
     @staticmethod
     def make_original_image_url(url: str) -> str:
@@ -172,81 +243,157 @@ class Twitter:
         else:
             return tweet_medias
 
-        tweet_medias[target_tweet.id_str] = TweetMedia(urls=media_url_list, tweet=target_tweet)
+        tweet_medias[target_tweet.id_str] = TweetMedia.from_status(media_url_list, target_tweet)
 
         return tweet_medias
 
     @staticmethod
     def make_tweet_permalink(tweet: tweepy.Status) -> str:
-        return f'https://twitter.com/{tweet.user.screen_name}/status/{tweet.id_str}'
+        return TweetMedia.from_status([], tweet).permalink
 
     @staticmethod
     def make_tweet_description(tweet: tweepy.Status) -> str:
-        return f'{tweet.user.name}\n' \
-               f'@{tweet.user.screen_name}\n' \
-               f'{tweet.full_text}'
-
-    @staticmethod
-    def difference_tweet_medias(new: Dict[str, TweetMedia], old: Dict[str, TweetMedia]) -> Dict[str, TweetMedia]:
-        diff_keys = new.keys() - old.keys()
-        return {k: new[k] for k in diff_keys}
-
-    def get_favorite_media(self, user: TwitterUser) -> Dict[str, TweetMedia]:
-        logger.info(f'Get favorite tweet media. user={user.id}. pages={self.tweet_page}, count={self.tweet_count}')
-        fav_twitter_medias: Dict[str, TweetMedia] = {}
-        for tweets in tweepy.Cursor(self.api.favorites,
-                                    id=user.id,
-                                    count=self.tweet_count,
-                                    tweet_mode="extended").pages(self.tweet_page):
-            for tweet in tweets:
-                tweet_medias: Dict[str, TweetMedia] = {}
-                try:
-                    tweet_medias = self.get_tweet_medias(tweet)
-                except Exception as e:
-                    logger.exception(f'Get tweet media error. exception={e.args}')
-
-                if tweet_medias:
-                    fav_twitter_medias.update(tweet_medias)
-
-        return fav_twitter_medias
+        return TweetMedia.from_status([], tweet).description
+
+    def is_deep_fav_scan(self, user: TwitterUser) -> bool:
+        if self.fav_known_run <= 0 or self.fav_deep_scan_cycles <= 1:
+            return True
+        return user.fav_scans % self.fav_deep_scan_cycles == 0
+
+    def _update_known_run(self, user: TwitterUser, tweets: List[tweepy.Status], known_run: int) -> Tuple[int, bool]:
+        """Return the run of known tweets at the end of the page and whether paging can stop."""
+        snapshot: Optional[FavoriteSnapshot] = user.fav_snapshot
+        is_in_snapshot: List[bool] = [snapshot is not None and tweet.id in snapshot for tweet in tweets]
+        unknown_tweet_ids: List[str] = [tweet.id_str for tweet, known in zip(tweets, is_in_snapshot) if not known]
+        stored_tweet_ids: Set[str] = self.known_tweet_ids(unknown_tweet_ids) if unknown_tweet_ids else set()
+
+        is_stop: bool = len(tweets) > 0
+        for tweet, known in zip(tweets, is_in_snapshot):
+            if known or tweet.id_str in stored_tweet_ids:
+                known_run += 1
+                if known_run >= self.fav_known_run:
+                    return known_run, True
+            else:
+                known_run = 0
+                is_stop = False
+        # A page of known tweets stops paging even if it is shorter than the run
+        return known_run, is_stop
+
+    def _get_favorite_pages(self, user: TwitterUser) -> Iterator[List[tweepy.Status]]:
+        pages: Iterator[List[tweepy.Status]] = tweepy.Cursor(self.api.favorites,
+                                                             id=user.id,
+                                                             count=self.tweet_count,
+                                                             tweet_mode="extended").pages(self.tweet_page)
+        if self.is_deep_fav_scan(user):
+            logger.info(f'Deep scan favorites. user={user.id}, scans={user.fav_scans}')
+            yield from pages
+            return
+
+        # New favorites come first, so the tweets after a run of known ones were seen in the previous scans
+        known_run: int = 0
+        for page, tweets in enumerate(pages, 1):
+            yield tweets
+            known_run, is_stop = self._update_known_run(user, tweets, known_run)
+            if is_stop:
+                logger.info(f'Stop favorite paging. user={user.id}, page={page}, known_run={known_run}')
+                return
 
-    def get_rt_media(self, user: TwitterUser) -> Dict[str, TweetMedia]:
-        logger.info(f'Get RT tweet media. user={user.id}. pages={self.tweet_page}, count={self.tweet_count}, '
-                    f'since_id={user.since_id}')
-        rt_tweet_medias: Dict[str, TweetMedia] = {}
+    def _get_rt_pages(self, user: TwitterUser, progress: CrawlProgress) -> Iterator[List[tweepy.Status]]:
         for tweets in tweepy.Cursor(self.api.user_timeline,
                                     id=user.id,
                                     tweet_mode='extended',
                                     count=self.tweet_count,
                                     since_id=user.since_id).pages(self.tweet_page):
-            if user.since_id < tweets.since_id:
-                user.since_id = tweets.since_id
-
-            for tweet in tweets:
+            if progress.since_id < tweets.since_id:
+                progress.since_id = tweets.since_id
+            yield tweets
+
+    def get_page_tweet_medias(self, page_type: str, tweets: List[tweepy.Status]) -> Dict[str, TweetMedia]:
+        page_tweet_medias: Dict[str, TweetMedia] = {}
+        for tweet in tweets:
+            if page_type == 'rt':
                 if not self.is_retweeted(tweet):
                     continue
                 if 'mixed' in self.mode and (not self.is_favorited(tweet)):
                     continue
 
-                try:
-                    tweet_medias = self.get_tweet_medias(tweet)
-                except Exception as e:
-                    logger.exception(f'Get tweet media error. exception={e.args}')
-                    continue
+            try:
+                tweet_medias: Dict[str, TweetMedia] = self.get_tweet_medias(tweet)
+            except Exception as e:
+                logger.exception(f'Get tweet media error. exception={e.args}')
+                continue
+
+            if tweet_medias:
+                page_tweet_medias.update(tweet_medias)
+
+        return page_tweet_medias
+
+    def get_favorite_media(self, user: TwitterUser, fav_tweet_ids: Optional[Set[str]] = None) -> Dict[str, TweetMedia]:
+        """Return the favorited tweet media, and add the ids of all the favorited tweets to `fav_tweet_ids`."""
+        logger.info(f'Get favorite tweet media. user={user.id}. pages={self.tweet_page}, count={self.tweet_count}')
+        fav_twitter_medias: Dict[str, TweetMedia] = {}
+        for tweets in self._get_favorite_pages(user):
+            if fav_tweet_ids is not None:
+                fav_tweet_ids.update(tweet.id_str for tweet in tweets)
+            fav_twitter_medias.update(self.get_page_tweet_medias('fav', tweets))
+
+        return fav_twitter_medias
 
-                if tweet_medias:
-                    rt_tweet_medias.update(tweet_medias)
+    def get_rt_media(self, user: TwitterUser, progress: Optional[CrawlProgress] = None) -> Dict[str, TweetMedia]:
+        logger.info(f'Get RT tweet media. user={user.id}. pages={self.tweet_page}, count={self.tweet_count}, '
+                    f'since_id={user.since_id}')
+        rt_tweet_medias: Dict[str, TweetMedia] = {}
+        for tweets in self._get_rt_pages(user, progress or CrawlProgress(since_id=user.since_id)):
+            rt_tweet_medias.update(self.get_page_tweet_medias('rt', tweets))
 
         return rt_tweet_medias
 
-    def get_target_tweets(self, user: TwitterUser) -> dict:
+    def iter_target_tweet_pages(self, user: TwitterUser,
+                                progress: Optional[CrawlProgress] = None) -> Iterator[Tuple[str, List[tweepy.Status]]]:
+        """Yield the pages of the user, and raise `progress.since_id` to the newest tweet read."""
+        if 'fav' in self.mode:
+            logger.info(f'Get favorite tweet pages. user={user.id}. pages={self.tweet_page}, '
+                        f'count={self.tweet_count}')
+            for tweets in self._get_favorite_pages(user):
+                yield 'fav', tweets
+        if 'rt' in self.mode or 'mixed' in self.mode:
+            logger.info(f'Get RT tweet pages. user={user.id}. pages={self.tweet_page}, count={self.tweet_count}, '
+                        f'since_id={user.since_id}')
+            for tweets in self._get_rt_pages(user, progress or CrawlProgress(since_id=user.since_id)):
+                yield 'rt', tweets
+
+    @staticmethod
+    def difference_last_favorites(user: TwitterUser,
+                                  fav_tweet_medias: Dict[str, TweetMedia]) -> Dict[str, TweetMedia]:
+        snapshot: Optional[FavoriteSnapshot] = user.fav_snapshot
+        if snapshot is None:
+            return fav_tweet_medias
+        return {tweet_id: tweet_media for tweet_id, tweet_media in fav_tweet_medias.items()
+                if int(tweet_id) not in snapshot}
+
+    def remember_favorites(self, user: TwitterUser, fav_tweet_ids: Iterable[str]) -> None:
+        tweet_ids: List[int] = [int(tweet_id) for tweet_id in fav_tweet_ids]
+        # A deep scan sees every favorite, and drops the tweets no longer favorited.
+        # A scan which stopped early only adds the new favorites.
+        if user.fav_snapshot is None or self.is_deep_fav_scan(user):
+            snapshot: FavoriteSnapshot = FavoriteSnapshot(tweet_ids)
+        else:
+            snapshot = user.fav_snapshot.union(tweet_ids)
+        if snapshot != user.fav_snapshot:
+            user.fav_snapshot = snapshot
+        user.fav_scans += 1
+
+    def get_target_tweets(self, user: TwitterUser, progress: Optional[CrawlProgress] = None) -> dict:
+        """Return the target tweet media, and record the newest tweet and the favorites read in `progress`."""
+        if progress is None:
+            progress = CrawlProgress(since_id=user.since_id)
         target_tweet_medias: Dict[str, TweetMedia] = {}
         if 'fav' in self.mode:
-            new_fav_result = self.get_favorite_media(user)
-            target_tweet_medias.update(self.difference_tweet_medias(new_fav_result, self._last_fav_result))
-            self._last_fav_result = new_fav_result
+            new_fav_result = self.get_favorite_media(user, progress.fav_tweet_ids)
+            target_tweet_medias.update(self.difference_last_favorites(user, new_fav_result))
+            progress.fav_tweet_ids.update(new_fav_result.keys())
         if 'rt' in self.mode or 'mixed' in self.mode:
-            target_tweet_medias.update(self.get_rt_media(user))
+            target_tweet_medias.update(self.get_rt_media(user, progress))
         return target_tweet_medias
 
     class Debug:
@@ -286,18 +433,20 @@ class Twitter:
         def show_rt_media(self, user: TwitterUser) -> None:
             logger.info(f'Show RT tweet media. user={user.id}. pages={self.tweet_page}, count={self.tweet_count}, '
                         f'since_id={user.since_id}')
+            since_id: int = user.since_id
             for tweets in tweepy.Cursor(self.api.user_timeline,
                                         id=user.id,
                                         tweet_mode='extended',
                                         count=self.tweet_count,
                                         since_id=user.since_id).pages(self.tweet_page):
-                if user.since_id < tweets.since_id:
-                    user.since_id = tweets.since_id
+                since_id = max(since_id, tweets.since_id)
 
                 for tweet in tweets:
                     if not has_attributes(tweet, 'retweeted_status'):
                         continue
                     self.show_tweet_media(tweet)
+            # The next call shows only the newer tweets, once all of these are shown
+            user.since_id = since_id
 
 
 logger: logging.Logger = logging.getLogger(__name__)
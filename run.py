@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 
 import logging
+import signal
+import sys
 
 from app import crawler
 from app.log import Log
 
 
 def main() -> None:
+    # "docker stop" sends SIGTERM. Exiting with SystemExit runs atexit, which writes the rows buffered in Store.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
     crawler.Crawler().main()
 
 
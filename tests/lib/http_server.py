@@ -0,0 +1,249 @@
+import hashlib
+import http.server
+import re
+import threading
+
+from typing import Dict, List, Optional, Tuple
+
+
+class MediaServer:
+    """Local stand-in for the Twitter media CDN."""
+
+    def __init__(self) -> None:
+        self.contents: Dict[str, bytes] = {}
+        self.status: Dict[str, int] = {}
+        self.delay: float = 0.0
+        self.accept_ranges: bool = True
+        # Close the connection after sending this many body bytes, once per path
+        self.drop_after: Dict[str, int] = {}
+        self.requests: List[Dict[str, Optional[str]]] = []
+        self.connections: int = 0
+
+        handler = type('Handler', (MediaRequestHandler,), {'server_state': self})
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self._httpd.server_port}{path}'
+
+    def etag(self, path: str) -> str:
+        return f'"{hashlib.sha256(self.contents[path]).hexdigest()[:16]}"'
+
+    def start(self) -> 'MediaServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class MediaRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_state: MediaServer
+
+    def setup(self) -> None:
+        super().setup()
+        self.server_state.connections += 1
+
+    def log_message(self, *_: object) -> None:
+        pass
+
+    def handle(self) -> None:
+        try:
+            super().handle()
+        except ConnectionError:
+            # The client closed a keep-alive connection, e.g. after closing a segmented download response
+            pass
+
+    def do_HEAD(self) -> None:
+        self._respond(send_body=False)
+
+    def do_GET(self) -> None:
+        self._respond(send_body=True)
+
+    def _content_range(self, content: bytes) -> Optional[Tuple[int, int]]:
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if not self.server_state.accept_ranges or not match:
+            return None
+        # The whole content is sent when it has changed since the validator
+        if_range: Optional[str] = self.headers.get('If-Range')
+        if if_range is not None and if_range != self.server_state.etag(self.path):
+            return None
+        end: int = int(match.group(2)) if match.group(2) else len(content) - 1
+        return int(match.group(1)), end
+
+    def _respond(self, send_body: bool) -> None:
+        state: MediaServer = self.server_state
+        state.requests.append({'method': self.command, 'path': self.path, 'range': self.headers.get('Range'),
+                               'if_range': self.headers.get('If-Range')})
+        if state.delay:
+            # time.sleep may be patched by the tests for retry
+            threading.Event().wait(state.delay)
+        if self.path in state.status:
+            self.send_response(state.status[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        content: bytes = state.contents[self.path]
+        content_range: Optional[Tuple[int, int]] = self._content_range(content)
+        if content_range and content_range[0] >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(content)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = content_range or (0, len(content) - 1)
+        if content_range:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+        else:
+            self.send_response(200)
+        if state.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', state.etag(self.path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+
+        body: bytes = content[start:end + 1]
+        drop_after: Optional[int] = state.drop_after.pop(self.path, None)
+        if drop_after is not None:
+            body = body[:drop_after]
+            self.close_connection = True
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client may close the response without reading the body
+            self.close_connection = True
+
+
+class UploadSession:
+    def __init__(self, file_name: str, raw_size: int) -> None:
+        self.file_name: str = file_name
+        self.raw_size: int = raw_size
+        self.data: bytearray = bytearray()
+        self.is_final: bool = False
+
+
+class UploadServer:
+    """Local stand-in for the Google Photos uploads endpoint, with the raw and the resumable protocols."""
+
+    def __init__(self, granularity: int = 256 * 1024) -> None:
+        self.granularity: int = granularity
+        self.sessions: Dict[str, UploadSession] = {}
+        # Upload token -> uploaded bytes
+        self.uploads: Dict[str, bytes] = {}
+        # Indexes of the chunk requests which fail with 503, after committing half of the chunk
+        self.fail_chunks: List[int] = []
+        self.chunk_count: int = 0
+        self.requests: List[Dict[str, Optional[str]]] = []
+        self._lock: threading.Lock = threading.Lock()
+
+        handler = type('Handler', (UploadRequestHandler,), {'server_state': self})
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def url(self, path: str = '/v1/uploads') -> str:
+        return f'http://127.0.0.1:{self._httpd.server_port}{path}'
+
+    def start(self) -> 'UploadServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def add_upload(self, data: bytes) -> str:
+        with self._lock:
+            upload_token: str = f'upload_token{len(self.uploads)}'
+            self.uploads[upload_token] = data
+        return upload_token
+
+    def add_session(self, file_name: str, raw_size: int) -> str:
+        with self._lock:
+            session_id: str = f'session{len(self.sessions)}'
+            self.sessions[session_id] = UploadSession(file_name, raw_size)
+        return session_id
+
+    def count_chunk(self) -> int:
+        with self._lock:
+            self.chunk_count += 1
+            return self.chunk_count - 1
+
+
+class UploadRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_state: UploadServer
+
+    def log_message(self, *_: object) -> None:
+        pass
+
+    def _read_body(self) -> bytes:
+        if 'chunked' in (self.headers.get('Transfer-Encoding') or ''):
+            body: bytearray = bytearray()
+            while True:
+                size: int = int(self.rfile.readline().split(b';')[0], 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if size == 0:
+                    return bytes(body)
+        return self.rfile.read(int(self.headers.get('Content-Length') or '0'))
+
+    def _send(self, status: int, body: bytes = b'', headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        state: UploadServer = self.server_state
+        body: bytes = self._read_body()
+        command: str = self.headers.get('X-Goog-Upload-Command') or ''
+        state.requests.append({'path': self.path, 'protocol': self.headers.get('X-Goog-Upload-Protocol'),
+                               'command': command, 'offset': self.headers.get('X-Goog-Upload-Offset'),
+                               'authorization': self.headers.get('Authorization')})
+        if self.path == '/v1/uploads' and self.headers.get('X-Goog-Upload-Protocol') == 'raw':
+            self._send(200, state.add_upload(body).encode('utf-8'))
+        elif self.path == '/v1/uploads' and command == 'start':
+            session_id: str = state.add_session(self.headers.get('X-Goog-Upload-File-Name') or '',
+                                                int(self.headers.get('X-Goog-Upload-Raw-Size') or '0'))
+            self._send(200, headers={'X-Goog-Upload-Status': 'active',
+                                     'X-Goog-Upload-URL': state.url(f'/v1/uploads/{session_id}'),
+                                     'X-Goog-Upload-Chunk-Granularity': str(state.granularity)})
+        elif self.path.startswith('/v1/uploads/') and self.path[len('/v1/uploads/'):] in state.sessions:
+            self._do_session(state.sessions[self.path[len('/v1/uploads/'):]], command, body)
+        else:
+            self._send(404)
+
+    def _do_session(self, session: UploadSession, command: str, body: bytes) -> None:
+        state: UploadServer = self.server_state
+        if command == 'query':
+            upload_token: bytes = state.add_upload(bytes(session.data)).encode('utf-8') if session.is_final else b''
+            self._send(200, upload_token, {'X-Goog-Upload-Status': 'final' if session.is_final else 'active',
+                                           'X-Goog-Upload-Size-Received': str(len(session.data))})
+            return
+        if session.is_final or int(self.headers.get('X-Goog-Upload-Offset') or '-1') != len(session.data):
+            self._send(400, b'Invalid offset')
+            return
+        if state.count_chunk() in state.fail_chunks:
+            # The server has committed a part of the chunk when the request fails
+            session.data += body[:len(body) // 2 // state.granularity * state.granularity]
+            self._send(503, b'Service Unavailable')
+            return
+        session.data += body
+        if 'finalize' not in command:
+            self._send(200, headers={'X-Goog-Upload-Status': 'active'})
+        elif len(session.data) != session.raw_size:
+            self._send(400, b'Size mismatch')
+        else:
+            session.is_final = True
+            self._send(200, state.add_upload(bytes(session.data)).encode('utf-8'),
+                       {'X-Goog-Upload-Status': 'final'})
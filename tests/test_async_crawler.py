@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import nose2.tools
+from testfixtures import LogCapture
+from unittest import mock
+
+from app.async_crawler import AsyncCrawler
+from app.scheduler import Scheduler
+from app.twitter import TwitterUser
+from tests.lib.utils import delete_env
+
+TEST_MODE = 'rt'
+TEST_TWITTER_IDS = ['user1', 'user2', 'user3', 'user4', 'user5']
+
+mock_crawling_tweets = mock.MagicMock()
+sleep_delays: list = []
+
+
+async def mock_sleep(delay: float) -> None:
+    sleep_delays.append(delay)
+    raise Exception()
+
+
+class ConcurrencyRecorder:
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.running: int = 0
+        self.max_running: int = 0
+        self.users: list = []
+
+    def crawling_tweets(self, user: TwitterUser) -> int:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.users.append(user.id)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return 0
+
+
+class TestAsyncCrawler:
+    def setUp(self) -> None:
+        self.clear_env()
+        mock_crawling_tweets.reset_mock(side_effect=True)
+        mock_crawling_tweets.return_value = 0
+        sleep_delays.clear()
+
+    def tearDown(self) -> None:
+        self.clear_env()
+
+    @staticmethod
+    def clear_env() -> None:
+        delete_env('INTERVAL')
+        delete_env('CRAWL_CONCURRENCY')
+        delete_env('INTERVAL_JITTER')
+
+    @staticmethod
+    async def crawl_all(async_crawler: AsyncCrawler, user_list: list) -> None:
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(async_crawler._concurrency)
+        # noinspection PyProtectedMember
+        await asyncio.gather(*[async_crawler._crawl(user, semaphore) for user in user_list])
+
+    @nose2.tools.params(
+        ('1', 1),
+        ('2', 2),
+        ('5', 5),
+    )
+    def test_crawl__concurrency(self, concurrency: str, max_running: int) -> None:
+        os.environ['CRAWL_CONCURRENCY'] = concurrency
+        recorder = ConcurrencyRecorder()
+        user_list = [TwitterUser(id=user_id) for user_id in TEST_TWITTER_IDS]
+        async_crawler = AsyncCrawler(recorder.crawling_tweets, TEST_MODE, Scheduler(user_list))
+
+        asyncio.run(self.crawl_all(async_crawler, user_list))
+
+        assert recorder.max_running == max_running
+        assert sorted(recorder.users) == TEST_TWITTER_IDS
+
+    def test_crawl__exception(self) -> None:
+        mock_crawling_tweets.side_effect = Exception()
+        user = TwitterUser(id=TEST_TWITTER_IDS[0])
+        async_crawler = AsyncCrawler(mock_crawling_tweets, TEST_MODE, Scheduler([user]))
+
+        with LogCapture(level=logging.ERROR) as log:
+            asyncio.run(self.crawl_all(async_crawler, [user]))
+            log.check(('app.async_crawler', 'ERROR', f'Crawling error. user = {user.id}, exception=()'))
+
+    @mock.patch('asyncio.sleep', mock_sleep)
+    @nose2.tools.params(
+        ('10', 600),
+        (None, 300),
+    )
+    def test_crawl_user(self, interval: str, sleep_seconds: int) -> None:
+        if interval:
+            os.environ['INTERVAL'] = interval
+        os.environ['INTERVAL_JITTER'] = '0'
+        user = TwitterUser(id=TEST_TWITTER_IDS[0])
+        async_crawler = AsyncCrawler(mock_crawling_tweets, TEST_MODE, Scheduler([user]))
+
+        with LogCapture(level=logging.INFO) as log:
+            with nose2.tools.such.helper.assertRaises(Exception):
+                async_crawler.main([user])
+            log.check(('app.async_crawler', 'INFO', f'Crawling start. user = {user.id}, mode={TEST_MODE}'),
+                      ('app.async_crawler', 'INFO', f'Interval. user = {user.id}, sleep {sleep_seconds} seconds.'))
+
+        mock_crawling_tweets.assert_called_once_with(user)
+        assert len(sleep_delays) == 1
+        assert sleep_seconds - 1 < sleep_delays[0] <= sleep_seconds
@@ -1,19 +1,23 @@
+import hashlib
 import logging
 import os
-import urllib.error
-from typing import Dict, Tuple, List, Optional
+from typing import Any, Dict, Iterator, Tuple, List, Optional
 from unittest import mock
 
 import httplib2
 import nose2.tools
-import tweepy
+import requests
 from googleapiclient.errors import HttpError
 from testfixtures import LogCapture
 
-from app.crawler import Crawler
+from app.crawler import Crawler, PendingMediaItem
+from app.downloader import Downloader
+from app.errors import PermanentError, QuotaExceededError
 from app.google_photos import GooglePhotos
+from app.pipeline import PipelineError
 from app.store import Store
-from app.twitter import Twitter, TweetMedia, TwitterUser
+from app.twitter import CrawlProgress, FavoriteSnapshot, Twitter, TweetMedia, TwitterUser
+from tests.lib.logcapture_helper import LogCaptureHelper
 from tests.lib.utils import delete_env, load_json
 from tests.test_twitter import TwitterTestUtils
 
@@ -23,6 +27,9 @@ TEST_DESCRIPTION = 'test_description'
 TEST_MEDIA_URL = 'https://test.com/test.jpg'
 TEST_DOWNLOAD_DIR_PATH = './download/test_user_id'
 TEST_TWEET_ID = '1188832511515750404'
+TEST_MEDIA_HASH = 'a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3'
+TEST_UPLOAD_TOKEN = 'test_upload_token'
+TEST_CREATED_STATUS = {'message': 'Success'}
 TEST_TARGET_ID_COUNT = 1
 TEST_MEDIA_TWEETS = 'fav'
 TEST_TWEET = 'has_images'
@@ -34,38 +41,57 @@ mock_google_photos = mock.MagicMock(GooglePhotos)
 mock_twitter = mock.MagicMock(Twitter)
 mock_media_tweet = mock.MagicMock(TweetMedia)
 mock_store = mock.MagicMock(Store)
-mock_request = mock.MagicMock()
+mock_downloader = mock.MagicMock(Downloader)
 mock_makedirs = mock.MagicMock()
-mock_rmtree = mock.MagicMock()
+mock_remove = mock.MagicMock()
 mock_sleep = mock.MagicMock()
 mock_crawler_func = mock.MagicMock()
 mock_crawler_func2 = mock.MagicMock()
+mock_async_crawler = mock.MagicMock()
 
 
-@mock.patch('urllib.request', mock_request)
 class TestCrawler:
     crawler: Crawler
 
     @mock.patch('app.crawler.GooglePhotos', mock_google_photos)
     @mock.patch('app.crawler.Twitter', mock_twitter)
     @mock.patch('app.crawler.Store', mock_store)
+    @mock.patch('app.crawler.Downloader', mock_downloader)
     @mock.patch('os.makedirs', mock_makedirs)
     def setUp(self) -> None:
         self.clear_env()
 
         mock_google_photos.reset_mock()
         mock_google_photos.upload_media.reset_mock(side_effect=True)
+        mock_google_photos.upload_media.return_value = TEST_CREATED_STATUS
+        mock_google_photos.upload_file.reset_mock(side_effect=True)
+        mock_google_photos.upload_file.return_value = TEST_UPLOAD_TOKEN
+        mock_google_photos.create_media_items.reset_mock(side_effect=True)
+        mock_google_photos.create_media_items.side_effect = lambda items: [TEST_CREATED_STATUS for _ in items]
+        mock_google_photos.create_media_item.return_value = TEST_CREATED_STATUS
+        mock_google_photos.upload_stream.reset_mock(side_effect=True)
+        mock_google_photos.check_upload_quota.reset_mock(side_effect=True)
         mock_twitter.reset_mock(side_effect=True)
         mock_twitter.make_original_image_url.reset_mock(side_effect=True)
+        mock_twitter.mode = DEFAULT_MODE
         mock_store.reset_mock()
-        mock_store.fetch_not_added_tweet_ids.reset_mock(return_value=True)
-        mock_store.fetch_all_failed_upload_medias.reset_mock(return_value=True)
+        mock_store.fetch_not_added_tweet_ids.reset_mock(return_value=True, side_effect=True)
+        mock_store.fetch_due_failed_upload_medias.reset_mock(return_value=True)
         mock_store.insert_tweet_info.reset_mock(side_effect=True)
         mock_store.insert_failed_upload_media.reset_mock(side_effect=True)
-        mock_request.reset_mock(side_effect=True)
-        mock_request.urlretrieve.reset_mock(side_effect=True)
+        mock_store.fetch_uploaded_media_hash.reset_mock(side_effect=True)
+        mock_store.fetch_uploaded_media_hash.return_value = None
+        mock_store.fetch_all_uploaded_media_phashes.reset_mock(return_value=True)
+        mock_store.fetch_since_ids.reset_mock(return_value=True, side_effect=True)
+        mock_store.upsert_since_id.reset_mock(side_effect=True)
+        mock_store.fetch_fav_snapshots.reset_mock(return_value=True, side_effect=True)
+        mock_store.upsert_fav_snapshot.reset_mock(side_effect=True)
+        mock_downloader.reset_mock()
+        mock_downloader.download.reset_mock(side_effect=True)
+        mock_downloader.download.return_value = TEST_MEDIA_HASH
+        mock_downloader.open_stream.reset_mock(side_effect=True, return_value=True)
         mock_makedirs.reset_mock()
-        mock_rmtree.reset_mock()
+        mock_remove.reset_mock()
         mock_sleep.reset_mock(side_effect=True)
         mock_crawler_func.reset_mock(side_effect=True, return_value=True)
         mock_crawler_func2.reset_mock(side_effect=True, return_value=True)
@@ -73,6 +99,7 @@ class TestCrawler:
         mock_google_photos.return_value = mock_google_photos
         mock_twitter.return_value = mock_twitter
         mock_store.return_value = mock_store
+        mock_downloader.return_value = mock_downloader
 
         os.environ['SAVE_MODE'] = 'google'
         self.crawler = Crawler()
@@ -100,6 +127,19 @@ class TestCrawler:
         delete_env('GOOGLE_CLIENT_SECRET')
         delete_env('GOOGLE_REFRESH_TOKEN')
         delete_env('GOOGLE_ALBUM_TITLE')
+        delete_env('DOWNLOAD_WORKERS')
+        delete_env('DOWNLOAD_HOST_LIMIT')
+        delete_env('CRAWLER_ENGINE')
+        delete_env('GOOGLE_STREAMING_UPLOAD_ENABLED')
+        delete_env('STREAM_CHUNK_SIZE')
+        delete_env('CRAWL_PIPELINE_ENABLED')
+        delete_env('PERCEPTUAL_DEDUP_ENABLED')
+        delete_env('PERCEPTUAL_DEDUP_ACTION')
+        delete_env('PERCEPTUAL_DEDUP_THRESHOLD')
+        delete_env('INTERVAL_MIN')
+        delete_env('INTERVAL_MAX')
+        delete_env('INTERVAL_JITTER')
+        delete_env('INTERVAL_EWMA_ALPHA')
 
     @staticmethod
     def load_failed_upload_media(json_name: str) -> List[Tuple[str, str]]:
@@ -111,16 +151,81 @@ class TestCrawler:
         json_path = f'{JSON_DIR}/crawler/fetch_all_failed_upload_media/{json_name}.json'
         return [tuple(failed_upload_media_info) for failed_upload_media_info in load_json(json_path)]  # type: ignore
 
-    @mock.patch('os.makedirs', mock_makedirs)
+    def load_due_failed_upload_media(self, json_name: str, attempts: int = 0) -> List[Tuple[str, str, str, int]]:
+        return [(url, description, user_id, attempts)
+                for url, description, user_id in self.load_fetch_all_failed_upload_media(json_name)]
+
     @nose2.tools.params(
         ('https://test.com/test.jpg', 'download_dir/path/test.jpg'),
     )
     def test_download_media(self, media_url: str, download_path: str) -> None:
-        mock_makedirs.reset_mock()
         self.crawler.download_media(media_url, download_path)
 
-        mock_makedirs.assert_called_once_with(os.path.dirname(download_path), exist_ok=True)
-        mock_request.urlretrieve.assert_called_once_with(media_url, download_path)
+        mock_downloader.download.assert_called_once_with(media_url, download_path)
+
+    @nose2.tools.params(
+        10,
+        None,
+    )
+    def test_stream_media(self, size: Optional[int]) -> None:
+        def upload_stream(_: str, chunks: Iterator[bytes], __: Optional[int]) -> str:
+            b''.join(chunks)
+            return TEST_UPLOAD_TOKEN
+
+        mock_downloader.open_stream.return_value.__enter__.return_value = (iter([b'12', b'3']), size)
+        mock_google_photos.upload_stream.side_effect = upload_stream
+
+        upload_token, media_hash = self.crawler.stream_media(TEST_MEDIA_URL, 'test.jpg')
+
+        assert upload_token == TEST_UPLOAD_TOKEN
+        # sha256(b'123')
+        assert media_hash == TEST_MEDIA_HASH
+        mock_downloader.open_stream.assert_called_once_with(TEST_MEDIA_URL)
+        mock_google_photos.upload_stream.assert_called_once_with('test.jpg', mock.ANY, size)
+
+    @mock.patch('app.crawler.Crawler.stream_media', return_value=(TEST_UPLOAD_TOKEN, TEST_MEDIA_HASH))
+    def test_stream_google_photos(self, _: mock.MagicMock) -> None:
+        is_streamed: bool = self.crawler.stream_google_photos(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+
+        assert is_streamed is True
+        mock_google_photos.create_media_item.assert_called_once_with(TEST_UPLOAD_TOKEN, TEST_DESCRIPTION)
+        mock_store.insert_uploaded_media_hash.assert_called_once_with(TEST_MEDIA_HASH, TEST_MEDIA_URL, TEST_USER_ID)
+
+    @mock.patch('app.crawler.Crawler.stream_media', return_value=(TEST_UPLOAD_TOKEN, TEST_MEDIA_HASH))
+    def test_stream_google_photos__duplicate(self, _: mock.MagicMock) -> None:
+        mock_store.fetch_uploaded_media_hash.return_value = ('https://test.com/other.jpg', 'other_user')
+
+        with LogCapture(level=logging.INFO) as log:
+            is_streamed: bool = self.crawler.stream_google_photos(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+            log.check(('app.crawler', 'INFO', f'Skip duplicate media. media_url={TEST_MEDIA_URL}, '
+                                              f'uploaded_media_url=https://test.com/other.jpg'))
+
+        assert is_streamed is True
+        mock_google_photos.create_media_item.assert_not_called()
+        mock_store.insert_uploaded_media_hash.assert_not_called()
+
+    @mock.patch('app.crawler.Crawler.stream_media', return_value=(TEST_UPLOAD_TOKEN, TEST_MEDIA_HASH))
+    def test_stream_google_photos__not_created(self, _: mock.MagicMock) -> None:
+        mock_google_photos.create_media_item.return_value = {'code': 3, 'message': 'Failed'}
+
+        with LogCapture(level=logging.ERROR) as log:
+            is_streamed: bool = self.crawler.stream_google_photos(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+            log.check(('app.crawler', 'ERROR', f"Create media item failed. media_url={TEST_MEDIA_URL}, "
+                                               f"status={{'code': 3, 'message': 'Failed'}}"))
+
+        # The hash is not stored, so the media is uploaded again by the retry
+        assert is_streamed is False
+        mock_store.insert_uploaded_media_hash.assert_not_called()
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_stream_google_photos__failed(self) -> None:
+        mock_downloader.open_stream.side_effect = requests.exceptions.ConnectionError('Connection refused')
+
+        with LogCapture(level=logging.ERROR) as log:
+            is_streamed: bool = self.crawler.stream_google_photos(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+            log.check(('app.crawler', 'ERROR', 'Error reason=Connection refused'))
+        assert is_streamed is False
+        assert mock_downloader.open_stream.call_count == 3
 
     @nose2.tools.params(
         ('download_dir/path/test.jpg', 'test description', True),
@@ -130,6 +235,15 @@ class TestCrawler:
         assert is_upload is ans
         mock_google_photos.upload_media.assert_called_once_with(media_path, description)
 
+    def test_upload_google_photos__not_created(self) -> None:
+        mock_google_photos.upload_media.return_value = {'code': 3, 'message': 'Failed'}
+
+        with LogCapture(level=logging.ERROR) as log:
+            is_upload: bool = self.crawler.upload_google_photos('media_path', 'description')
+            log.check(('app.crawler', 'ERROR', "Create media item failed. path=media_path, "
+                                               "status={'code': 3, 'message': 'Failed'}"))
+        assert is_upload is False
+
     @nose2.tools.params(
         (500, 'Server Error'),
     )
@@ -167,7 +281,18 @@ class TestCrawler:
         # noinspection PyProtectedMember
         assert download_path == f'{self.crawler._download_dir}/{ans}'
 
-    @mock.patch('shutil.rmtree', mock_rmtree)
+    @nose2.tools.params(
+        ('https://pbs.twimg.com/media/test1.jpg', 'https://pbs.twimg.com/media/test2.jpg', True),
+        ('https://pbs.twimg.com/media/test.jpg', 'https://video.twimg.com/test.mp4', False),
+    )
+    def test_get_host_semaphore(self, url: str, other_url: str, is_same: bool) -> None:
+        # noinspection PyProtectedMember
+        semaphore = self.crawler._get_host_semaphore(url)
+        # noinspection PyProtectedMember
+        other_semaphore = self.crawler._get_host_semaphore(other_url)
+        assert (semaphore is other_semaphore) is is_same
+
+    @mock.patch('os.remove', mock_remove)
     @mock.patch('os.makedirs', mock_makedirs)
     @nose2.tools.params(
         ('https://test.com/test.jpg', 'other', 'google'),
@@ -183,32 +308,146 @@ class TestCrawler:
         if media_type == 'Twitter':
             msg_url = f'{url}?name=orig'
         download_path = f'{TEST_DOWNLOAD_DIR_PATH}/{os.path.basename(url)}'
-        download_file_msg = f'Download file. url={msg_url}, path={download_path}'
-        delete_msg = f'Delete directory. path={TEST_DOWNLOAD_DIR_PATH}'
+        delete_msg = f'Delete file. path={download_path}'
 
         with LogCapture() as log:
             is_save = self.crawler.save_media(url, TEST_DESCRIPTION, TEST_USER_ID)
             if save_mode == 'local':
-                log.check(('app.crawler', 'DEBUG', download_file_msg))
+                log.check()
             elif save_mode == 'google':
-                log.check(('app.crawler', 'DEBUG', download_file_msg), ('app.crawler', 'DEBUG', delete_msg))
+                log.check(('app.crawler', 'DEBUG', delete_msg))
         assert is_save is True
+        mock_downloader.download.assert_called_once_with(msg_url, download_path)
+        mock_store.insert_uploaded_media_hash.assert_called_once_with(TEST_MEDIA_HASH, msg_url, TEST_USER_ID)
 
         if save_mode == 'local':
             assert mock_google_photos.upload_media.call_count == 0
+            mock_remove.assert_not_called()
         elif save_mode == 'google':
             assert mock_google_photos.upload_media.call_count == 1
+            mock_remove.assert_called_once_with(download_path)
+
+    @mock.patch('os.remove', mock_remove)
+    @nose2.tools.params(
+        ('google', TEST_MEDIA_URL, TEST_USER_ID, True),
+        ('local', 'https://test.com/other.jpg', 'other_user', True),
+        ('local', TEST_MEDIA_URL, 'other_user', True),
+        ('local', f'{TEST_MEDIA_URL}?name=orig', TEST_USER_ID, False),
+    )
+    def test_save_media__duplicate(self, save_mode: str, uploaded_url: str, uploaded_user_id: str,
+                                   is_removed: bool) -> None:
+        self.crawler._save_mode = save_mode
+        mock_store.fetch_uploaded_media_hash.return_value = (uploaded_url, uploaded_user_id)
+
+        with LogCapture(level=logging.INFO) as log:
+            is_save = self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+            log.check(('app.crawler', 'INFO', f'Skip duplicate media. media_url={TEST_MEDIA_URL}, '
+                                              f'uploaded_media_url={uploaded_url}'))
+
+        assert is_save is True
+        mock_store.fetch_uploaded_media_hash.assert_called_once_with(TEST_MEDIA_HASH)
+        mock_google_photos.upload_media.assert_not_called()
+        mock_store.insert_uploaded_media_hash.assert_not_called()
+        # The same file downloaded again is the first copy itself
+        assert mock_remove.called is is_removed
+
+    @mock.patch('os.remove', mock_remove)
+    def test_save_media__fetch_hash_failed(self) -> None:
+        mock_store.fetch_uploaded_media_hash.side_effect = Exception('connection')
+
+        with LogCapture(level=logging.ERROR) as log:
+            is_save = self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+            log.check(('app.crawler', 'ERROR', f"Fetch failed. media_hash={TEST_MEDIA_HASH}, "
+                                               f"exception=('connection',)"))
+
+        assert is_save is True
+        assert mock_google_photos.upload_media.call_count == 1
+
+    @mock.patch('os.remove', mock_remove)
+    @nose2.tools.params(
+        ('skip', 0, None),
+        ('tag', 1, f'{TEST_DESCRIPTION}\nNear duplicate of https://test.com/other.jpg'),
+    )
+    def test_save_media__near_duplicate(self, action: str, upload_count: int, description: Optional[str]) -> None:
+        self.crawler._perceptual_dedup_enabled = True
+        self.crawler._perceptual_dedup_action = action
+        mock_store.fetch_all_uploaded_media_phashes.return_value = [(-1, 'https://test.com/other.jpg', 'other_user')]
+
+        with mock.patch('app.crawler.PerceptualHash.dhash', return_value=(1 << 64) - 2), \
+                LogCapture(level=logging.INFO) as log:
+            is_save = self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+            log.check((
+                'app.crawler', 'INFO',
+                f'{action.capitalize()} near duplicate media. media_url={TEST_MEDIA_URL}, '
+                f'uploaded_media_url=https://test.com/other.jpg'
+            ))
+
+        assert is_save is True
+        assert mock_google_photos.upload_media.call_count == upload_count
+        if description is not None:
+            mock_google_photos.upload_media.assert_called_once_with(mock.ANY, description)
+            mock_store.insert_uploaded_media_phash.assert_called_once_with(-2, TEST_MEDIA_URL, TEST_USER_ID)
+        mock_remove.assert_called_once_with(f'{TEST_DOWNLOAD_DIR_PATH}/test.jpg')
+
+    @mock.patch('os.remove', mock_remove)
+    @nose2.tools.params(
+        (True, 1 << 40, 1),
+        (True, None, 0),
+        (False, 1 << 40, 0),
+    )
+    def test_save_media__new_perceptual_hash(self, is_enabled: bool, phash: Optional[int], insert_count: int) -> None:
+        self.crawler._perceptual_dedup_enabled = is_enabled
+        mock_store.fetch_all_uploaded_media_phashes.return_value = []
+
+        with mock.patch('app.crawler.PerceptualHash.dhash', return_value=phash):
+            assert self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID) is True
+            assert self.crawler.save_media('https://test.com/test2.jpg', TEST_DESCRIPTION, TEST_USER_ID) is True
+
+        assert mock_google_photos.upload_media.call_count == 2 - insert_count
+        assert mock_store.insert_uploaded_media_phash.call_count == insert_count
+        # The index is loaded from the store only once
+        assert mock_store.fetch_all_uploaded_media_phashes.call_count == (1 if is_enabled and phash else 0)
+
+    @nose2.tools.params(
+        True,
+        False,
+    )
+    def test_save_media__streaming(self, is_streamed: bool) -> None:
+        self.crawler._streaming_upload_enabled = True
+        mock_twitter.make_original_image_url.side_effect = Twitter.make_original_image_url
+
+        with mock.patch('app.crawler.Crawler.stream_google_photos', return_value=is_streamed) as stream:
+            with LogCapture(level=logging.ERROR) as log:
+                is_save = self.crawler.save_media('https://pbs.twimg.com/media/test.jpg', TEST_DESCRIPTION,
+                                                  TEST_USER_ID)
+                if not is_streamed:
+                    log.check(('app.crawler', 'ERROR', 'upload failed. media_url='
+                                                       'https://pbs.twimg.com/media/test.jpg?name=orig'))
+            stream.assert_called_once_with('https://pbs.twimg.com/media/test.jpg?name=orig', TEST_DESCRIPTION,
+                                           TEST_USER_ID)
+        assert is_save is is_streamed
+        mock_downloader.download.assert_not_called()
 
-    @mock.patch('time.sleep', mock_sleep)  # for retry
     def test_save_media__download_failed(self) -> None:
-        mock_request.urlretrieve.side_effect = urllib.error.HTTPError(TEST_MEDIA_URL, code=500, msg='',
-                                                                      hdrs={}, fp=None)  # type: ignore
+        mock_downloader.download.side_effect = requests.exceptions.HTTPError('500 Server Error')
 
         with LogCapture(level=logging.ERROR) as log:
             is_save = self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
             log.check(('app.crawler', 'ERROR', f'Download failed. media_url={TEST_MEDIA_URL}'))
         assert is_save is False
+        # The partial file is kept for the retry to resume
+        mock_downloader.remove_partial.assert_not_called()
+
+    def test_save_media__download_gone(self) -> None:
+        mock_downloader.download.side_effect = PermanentError(requests.exceptions.HTTPError('404 Client Error'))
 
+        with LogCapture(level=logging.ERROR):
+            assert not self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID)
+
+        mock_downloader.remove_partial.assert_called_once_with(
+            self.crawler.make_download_path(TEST_MEDIA_URL, TEST_USER_ID))
+
+    @mock.patch('os.remove', mock_remove)
     @mock.patch('time.sleep', mock_sleep)  # for retry
     def test_save_media__upload_failed(self) -> None:
         mock_google_photos.upload_media.side_effect = Exception()
@@ -232,17 +471,36 @@ class TestCrawler:
         target_media_tweet = target_media_tweets[TEST_TWEET_ID]
 
         with LogCapture(level=logging.DEBUG) as log:
-            self.crawler.backup_media(target_media_tweets)
+            new_media_count: int = self.crawler.backup_media(target_media_tweets)
             log.check(('app.crawler', 'INFO', f'Target tweet media count={TEST_TARGET_ID_COUNT}'),
                       ('app.crawler', 'DEBUG', f'All media upload succeeded. urls={target_media_tweet.urls}'))
 
-            mock_crawler_func.assert_called_once_with(target_media_tweets[TEST_TWEET_ID].tweet)
+            mock_crawler_func.assert_called_once_with(target_media_tweets[TEST_TWEET_ID])
 
+        assert new_media_count == len(target_media_tweet.urls)
         if save_mode == 'local':
             assert mock_google_photos.init_album.call_count == 0
         elif save_mode == 'google':
             assert mock_google_photos.init_album.call_count == 1
 
+    @mock.patch('app.crawler.Crawler.store_failed_upload_media', mock_crawler_func2)
+    @mock.patch('app.crawler.Crawler.store_tweet_info', mock_crawler_func)
+    def test_backup_media__multiple_tweets(self) -> None:
+        target_media_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(TEST_MEDIA_TWEETS)
+        mock_store.fetch_not_added_tweet_ids.return_value = [(tweet_id,) for tweet_id in target_media_tweets]
+        failed_url: str = target_media_tweets[TEST_TWEET_ID].urls[0]
+
+        with mock.patch('app.crawler.Crawler.save_media', side_effect=lambda url, *_: url != failed_url) as save:
+            with LogCapture(level=logging.WARNING) as log:
+                self.crawler.backup_media(target_media_tweets)
+                log.check(('app.crawler', 'WARNING', f'Save failed. tweet_id={TEST_TWEET_ID}, media_url={failed_url}'))
+            assert save.call_count == sum(len(tweet_media.urls) for tweet_media in target_media_tweets.values())
+
+        stored_tweets = [args[0] for (args, _) in mock_crawler_func.call_args_list]
+        assert stored_tweets == [tweet_media for tweet_media in target_media_tweets.values()]
+        target_tweet: TweetMedia = target_media_tweets[TEST_TWEET_ID]
+        mock_crawler_func2.assert_called_once_with(target_tweet, self.load_failed_upload_media('one'))
+
     def test_backup_media__no_new_tweet(self) -> None:
         with LogCapture(level=logging.INFO) as log:
             self.crawler.backup_media({})
@@ -268,35 +526,134 @@ class TestCrawler:
                 self.crawler.backup_media(target_media_tweets)
                 log.check(('app.crawler', 'WARNING', f'Save failed. tweet_id={TEST_TWEET_ID}, media_url={url}'))
 
-        target_tweet: tweepy.Status = target_media_tweets[TEST_TWEET_ID].tweet
+        target_tweet: TweetMedia = target_media_tweets[TEST_TWEET_ID]
         failed_upload_media: List[Tuple[str, str]] = self.load_failed_upload_media('one')
         mock_crawler_func.assert_called_once_with(target_tweet, failed_upload_media)
 
+    @mock.patch('os.remove', mock_remove)
+    @mock.patch('app.crawler.Crawler.store_failed_upload_media', mock_crawler_func2)
+    @mock.patch('app.crawler.Crawler.store_tweet_info', mock_crawler_func)
+    def test_backup_media__create_failed(self) -> None:
+        self.crawler._save_mode = 'google'
+        target_media_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(TEST_MEDIA_TWEETS)
+        mock_store.fetch_not_added_tweet_ids.return_value = [(tweet_id,) for tweet_id in target_media_tweets]
+        mock_downloader.download.side_effect = lambda url, _: hashlib.sha256(url.encode()).hexdigest()
+        mock_twitter.make_original_image_url.side_effect = lambda url: url
+        failed_url: str = target_media_tweets[TEST_TWEET_ID].urls[0]
+        mock_google_photos.upload_file.side_effect = lambda path: path
+        mock_google_photos.create_media_items.side_effect = lambda items: [
+            {'code': 3, 'message': 'Failed'} if upload_token.endswith(Crawler.make_file_name(failed_url))
+            else TEST_CREATED_STATUS for upload_token, _ in items]
+
+        with LogCapture(level=logging.WARNING) as log:
+            self.crawler.backup_media(target_media_tweets)
+            assert LogCaptureHelper.check_contain(
+                log, ('app.crawler', 'WARNING', f'Save failed. tweet_id={TEST_TWEET_ID}, media_url={failed_url}'))
+
+        # All the media items of the cycle are created in one request
+        media_count: int = sum(len(tweet_media.urls) for tweet_media in target_media_tweets.values())
+        mock_google_photos.create_media_items.assert_called_once()
+        assert len(mock_google_photos.create_media_items.call_args[0][0]) == media_count
+        assert mock_store.insert_uploaded_media_hash.call_count == media_count - 1
+        target_tweet: TweetMedia = target_media_tweets[TEST_TWEET_ID]
+        mock_crawler_func2.assert_called_once_with(target_tweet, self.load_failed_upload_media('one'))
+        assert len(mock_crawler_func.call_args_list) == len(target_media_tweets)
+
+    @mock.patch('os.remove', mock_remove)
+    def test_save_media__pending(self) -> None:
+        self.crawler._save_mode = 'google'
+        media_items: List[PendingMediaItem] = []
+
+        is_save = self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID, media_items)
+
+        assert is_save is True
+        mock_google_photos.upload_media.assert_not_called()
+        assert media_items == [PendingMediaItem(upload_token=TEST_UPLOAD_TOKEN, description=TEST_DESCRIPTION,
+                                                url=TEST_MEDIA_URL, user_id=TEST_USER_ID, media_hash=TEST_MEDIA_HASH)]
+
+        # The same content is a duplicate while its media item waits to be created
+        with LogCapture(level=logging.INFO) as log:
+            other_url: str = 'https://test.com/other.jpg'
+            assert self.crawler.save_media(other_url, TEST_DESCRIPTION, TEST_USER_ID, media_items) is True
+            log.check(('app.crawler', 'INFO', f'Skip duplicate media. media_url={other_url}, '
+                                              f'uploaded_media_url={TEST_MEDIA_URL}'))
+        assert len(media_items) == 1
+        # Only the first one looks up the Store
+        mock_store.fetch_uploaded_media_hash.assert_called_once_with(TEST_MEDIA_HASH)
+
+        self.crawler.create_media_items(media_items)
+        assert media_items[0].is_saved is True
+        mock_store.insert_uploaded_media_hash.assert_called_once_with(TEST_MEDIA_HASH, TEST_MEDIA_URL, TEST_USER_ID)
+        assert self.crawler.find_uploaded_media(TEST_MEDIA_HASH) is None
+
+    @mock.patch('os.remove', mock_remove)
+    def test_save_media__pending_upload_failed(self) -> None:
+        self.crawler._save_mode = 'google'
+        mock_google_photos.upload_file.side_effect = Exception('Connection refused')
+        media_items: List[PendingMediaItem] = []
+
+        with LogCapture(level=logging.ERROR) as log:
+            is_save = self.crawler.save_media(TEST_MEDIA_URL, TEST_DESCRIPTION, TEST_USER_ID, media_items)
+            log.check(('app.crawler', 'ERROR', 'Error reason=Connection refused'),
+                      ('app.crawler', 'ERROR', f'upload failed. media_url={TEST_MEDIA_URL}'))
+
+        assert is_save is False
+        assert media_items == []
+        mock_remove.assert_called_once()
+
+    @nose2.tools.params(
+        (None, [True, False]),
+        (Exception('Connection refused'), [False, False]),
+    )
+    def test_create_media_items(self, exception: Optional[Exception], ans: List[bool]) -> None:
+        media_items: List[PendingMediaItem] = [
+            PendingMediaItem(upload_token=f'token{i}', description=TEST_DESCRIPTION, url=f'https://test.com/{i}.jpg',
+                             user_id=TEST_USER_ID, media_hash=f'{i}' * 64, phash=i)
+            for i in range(2)
+        ]
+        failed_status: Dict[str, Any] = {'code': 3, 'message': 'Failed'}
+        mock_google_photos.create_media_items.side_effect = \
+            exception or (lambda _: [TEST_CREATED_STATUS, failed_status])
+
+        with LogCapture(level=logging.ERROR) as log:
+            self.crawler.create_media_items(media_items)
+            status: Dict[str, Any] = failed_status if exception is None else {'code': 2, 'message': str(exception)}
+            assert LogCaptureHelper.check_contain(log, ('app.crawler', 'ERROR', f'Create media item failed. '
+                                                                                f'media_url=https://test.com/1.jpg, '
+                                                                                f'status={status}'))
+
+        mock_google_photos.create_media_items.assert_called_once_with(
+            [('token0', TEST_DESCRIPTION), ('token1', TEST_DESCRIPTION)])
+        assert [media_item.is_saved for media_item in media_items] == ans
+        assert mock_store.insert_uploaded_media_hash.call_count == ans.count(True)
+        assert mock_store.insert_uploaded_media_phash.call_count == ans.count(True)
+
     def test_store_tweet_info(self) -> None:
-        target_tweet: tweepy.Status = TwitterTestUtils.load_tweet(json_name=TEST_TWEET)
+        target_tweet: TweetMedia = TweetMedia.from_status([], TwitterTestUtils.load_tweet(json_name=TEST_TWEET))
         self.crawler.store_tweet_info(target_tweet)
-        mock_store.insert_tweet_info.assert_called_once_with(target_tweet.id_str, target_tweet.user.screen_name,
-                                                             str(target_tweet.created_at))
+        mock_store.insert_tweet_info.assert_called_once_with(target_tweet.id_str, target_tweet.screen_name,
+                                                             target_tweet.created_at)
 
     def test_store_tweet_info__exception(self) -> None:
         mock_store.insert_tweet_info.side_effect = Exception()
 
-        target_tweet: tweepy.Status = TwitterTestUtils.load_tweet(json_name=TEST_TWEET)
+        target_tweet: TweetMedia = TweetMedia.from_status([], TwitterTestUtils.load_tweet(json_name=TEST_TWEET))
         with LogCapture(level=logging.ERROR) as log:
             self.crawler.store_tweet_info(target_tweet)
             log.check(('app.crawler', 'ERROR', f'Insert failed. tweet_id={target_tweet.id_str}, exception=()'))
 
     def test_store_failed_upload_media(self) -> None:
-        target_tweet: tweepy.Status = TwitterTestUtils.load_tweet(json_name='has_video')
+        target_tweet: TweetMedia = TweetMedia.from_status([], TwitterTestUtils.load_tweet(json_name='has_video'))
         failed_upload_media: List[Tuple[str, str]] = self.load_failed_upload_media('one')
 
         self.crawler.store_failed_upload_media(target_tweet, failed_upload_media)
         failed_url, description = failed_upload_media[0]
         mock_store.insert_failed_upload_media.assert_called_once_with(failed_url, description,
-                                                                      target_tweet.user.screen_name)
+                                                                      target_tweet.screen_name)
 
     def test_store_failed_upload_media__three(self) -> None:
-        target_tweet: tweepy.Status = TwitterTestUtils.load_tweet(json_name='has_instagram_url')
+        target_tweet: TweetMedia = TweetMedia.from_status([],
+                                                          TwitterTestUtils.load_tweet(json_name='has_instagram_url'))
         failed_upload_media: List[Tuple[str, str]] = self.load_failed_upload_media('three')
 
         self.crawler.store_failed_upload_media(target_tweet, failed_upload_media)
@@ -304,7 +661,7 @@ class TestCrawler:
 
     def test_store_failed_upload_media__exception(self) -> None:
         mock_store.insert_failed_upload_media.side_effect = Exception()
-        target_tweet: tweepy.Status = TwitterTestUtils.load_tweet(json_name='has_video')
+        target_tweet: TweetMedia = TweetMedia.from_status([], TwitterTestUtils.load_tweet(json_name='has_video'))
         failed_upload_media: List[Tuple[str, str]] = self.load_failed_upload_media('one')
         failed_url, description = failed_upload_media[0]
 
@@ -315,44 +672,149 @@ class TestCrawler:
 
     @mock.patch('app.crawler.Crawler.save_media', mock_crawler_func)
     def test_retry_backup_media(self) -> None:
-        all_failed_upload_media: List[Tuple[str, str, str]] = self.load_fetch_all_failed_upload_media('one')
-        mock_store.fetch_all_failed_upload_medias.return_value = all_failed_upload_media
-        url, description, user_id = all_failed_upload_media[0]
+        due_failed_upload_media: List[Tuple[str, str, str, int]] = self.load_due_failed_upload_media('one')
+        mock_store.fetch_due_failed_upload_medias.return_value = due_failed_upload_media
+        url, description, user_id, _ = due_failed_upload_media[0]
 
         with LogCapture(level=logging.INFO) as log:
             self.crawler.retry_backup_media()
-            log.check(('app.crawler', 'INFO', f'Retry Save media. media_url={url}'))
+            log.check(('app.crawler', 'INFO', f'Retry Save media. media_url={url}, attempts=0'))
 
-        mock_store.fetch_all_failed_upload_medias.assert_called_once_with()
+        mock_store.fetch_due_failed_upload_medias.assert_called_once_with(100)
         mock_store.delete_failed_upload_media.assert_called_once_with(url)
         mock_crawler_func.assert_called_once_with(url, description, user_id)
 
+    @mock.patch('app.crawler.Crawler.save_media', mock_crawler_func)
+    def test_retry_backup_media__already_running(self) -> None:
+        # noinspection PyProtectedMember
+        self.crawler._retry_lock.acquire()
+
+        with LogCapture(level=logging.DEBUG) as log:
+            self.crawler.retry_backup_media()
+            log.check(('app.crawler', 'DEBUG', 'Retry backup is already running.'))
+
+        mock_store.fetch_due_failed_upload_medias.assert_not_called()
+        mock_crawler_func.assert_not_called()
+
+    @mock.patch('app.crawler.Crawler.save_media', mock_crawler_func)
+    def test_retry_backup_media__not_due(self) -> None:
+        mock_store.fetch_due_failed_upload_medias.return_value = []
+
+        # Crawling the other users in the interval does not retry the table again
+        self.crawler.retry_backup_media()
+        with LogCapture(level=logging.DEBUG) as log:
+            self.crawler.retry_backup_media()
+            log.check(('app.crawler', 'DEBUG', 'Retry backup is not due.'))
+
+        mock_store.fetch_due_failed_upload_medias.assert_called_once_with(100)
+
+    @mock.patch('app.crawler.Crawler.save_media', mock_crawler_func)
+    def test_retry_backup_media__interval(self) -> None:
+        # noinspection PyProtectedMember
+        self.crawler._retry_interval_seconds = 0
+        # noinspection PyProtectedMember
+        self.crawler._retry_max_per_cycle = 10
+        mock_store.fetch_due_failed_upload_medias.return_value = []
+
+        self.crawler.retry_backup_media()
+        self.crawler.retry_backup_media()
+
+        assert mock_store.fetch_due_failed_upload_medias.call_args_list == [mock.call(10), mock.call(10)]
+
     @mock.patch('app.crawler.Crawler.save_media', mock_crawler_func)
     def test_retry_backup_media__three(self) -> None:
-        all_failed_upload_media: List[Tuple[str, str, str]] = self.load_fetch_all_failed_upload_media('three')
-        mock_store.fetch_all_failed_upload_medias.return_value = all_failed_upload_media
+        mock_store.fetch_due_failed_upload_medias.return_value = self.load_due_failed_upload_media('three')
 
         self.crawler.retry_backup_media()
         assert mock_crawler_func.call_count == 3
 
-    def test_retry_backup_media__save_failed(self) -> None:
-        all_failed_upload_media: List[Tuple[str, str, str]] = self.load_fetch_all_failed_upload_media('one')
-        mock_store.fetch_all_failed_upload_medias.return_value = all_failed_upload_media
-        url, _, _ = all_failed_upload_media[0]
+    @nose2.tools.params(
+        (0, 1, 300),
+        (3, 4, 2400),
+        (8, 9, 76800),
+    )
+    def test_retry_backup_media__save_failed(self, attempts: int, ans_attempts: int, ans_seconds: float) -> None:
+        due_failed_upload_media: List[Tuple[str, str, str, int]] = self.load_due_failed_upload_media('one', attempts)
+        mock_store.fetch_due_failed_upload_medias.return_value = due_failed_upload_media
+        url, _, _, _ = due_failed_upload_media[0]
 
         with mock.patch('app.crawler.Crawler.save_media', return_value=False):
             with LogCapture(level=logging.WARNING) as log:
                 self.crawler.retry_backup_media()
-                log.check(('app.crawler', 'WARNING', f'Retry Save failed. media_url={url}'))
+                log.check(('app.crawler', 'WARNING', f'Retry Save failed. media_url={url}, attempts={ans_attempts}, '
+                                                     f'last_error=SaveFailed, retry_seconds={ans_seconds}'))
 
+        mock_store.update_failed_upload_attempt.assert_called_once_with(url, 'SaveFailed', ans_seconds)
         mock_store.delete_failed_upload_media.assert_not_called()
+        mock_store.move_failed_upload_media_to_dead.assert_not_called()
+
+    @mock.patch('app.crawler.Crawler.make_download_path', mock_crawler_func2)
+    def test_retry_backup_media__download_failed(self) -> None:
+        # noinspection PyProtectedMember
+        self.crawler._retry_backoff_max_seconds = 600
+        due_failed_upload_media: List[Tuple[str, str, str, int]] = self.load_due_failed_upload_media('one', 5)
+        mock_store.fetch_due_failed_upload_medias.return_value = due_failed_upload_media
+        mock_downloader.download.side_effect = requests.exceptions.HTTPError()
+        url, _, _, _ = due_failed_upload_media[0]
+
+        with LogCapture(level=logging.WARNING):
+            self.crawler.retry_backup_media()
+
+        # The class of the error is recorded, and the backoff stops growing at the max
+        mock_store.update_failed_upload_attempt.assert_called_once_with(url, 'HTTPError', 600)
+
+    def test_retry_backup_media__dead(self) -> None:
+        # noinspection PyProtectedMember
+        self.crawler._retry_max_attempts = 3
+        due_failed_upload_media: List[Tuple[str, str, str, int]] = self.load_due_failed_upload_media('one', 2)
+        mock_store.fetch_due_failed_upload_medias.return_value = due_failed_upload_media
+        url, _, _, _ = due_failed_upload_media[0]
+
+        with mock.patch('app.crawler.Crawler.save_media', return_value=False):
+            with LogCapture(level=logging.WARNING) as log:
+                self.crawler.retry_backup_media()
+                log.check(('app.crawler', 'WARNING', f'Retry Save gave up. media_url={url}, attempts=3, '
+                                                     f'last_error=SaveFailed'))
+
+        mock_store.move_failed_upload_media_to_dead.assert_called_once_with(url, 'SaveFailed')
+        mock_store.update_failed_upload_attempt.assert_not_called()
+        mock_downloader.remove_partial.assert_called_once_with(
+            self.crawler.make_download_path(url, due_failed_upload_media[0][2]))
+
+    @mock.patch('app.crawler.Crawler.make_download_path', mock_crawler_func2)
+    def test_retry_backup_media__permanent(self) -> None:
+        due_failed_upload_media: List[Tuple[str, str, str, int]] = self.load_due_failed_upload_media('three')
+        mock_store.fetch_due_failed_upload_medias.return_value = due_failed_upload_media
+        mock_downloader.download.side_effect = PermanentError(requests.exceptions.HTTPError('404 Client Error'))
+
+        with LogCapture(level=logging.WARNING):
+            self.crawler.retry_backup_media()
+
+        # A media which is gone is not tried again
+        assert mock_store.move_failed_upload_media_to_dead.call_args_list == [
+            mock.call(url, 'PermanentError') for url, _, _, _ in due_failed_upload_media]
+        mock_store.update_failed_upload_attempt.assert_not_called()
+
+    def test_retry_backup_media__quota(self) -> None:
+        mock_store.fetch_due_failed_upload_medias.return_value = self.load_due_failed_upload_media('three')
+        mock_google_photos.check_upload_quota.side_effect = QuotaExceededError(Exception('quota'))
+        url, _, _, _ = self.load_due_failed_upload_media('three')[0]
+
+        with LogCapture(level=logging.WARNING) as log:
+            self.crawler.retry_backup_media()
+            log.check_present(('app.crawler', 'WARNING', f'Retry Save paused by the upload quota. media_url={url}'))
+
+        # The rows stay due without an attempt, and the media are not downloaded
+        mock_downloader.download.assert_not_called()
+        mock_store.update_failed_upload_attempt.assert_not_called()
+        mock_store.move_failed_upload_media_to_dead.assert_not_called()
 
     @mock.patch('app.crawler.Crawler.save_media', mock_crawler_func)
     def test_retry_backup_media__exception(self) -> None:
         mock_crawler_func.side_effect = Exception()
-        all_failed_upload_media: List[Tuple[str, str, str]] = self.load_fetch_all_failed_upload_media('one')
-        mock_store.fetch_all_failed_upload_medias.return_value = all_failed_upload_media
-        url, _, _ = all_failed_upload_media[0]
+        due_failed_upload_media: List[Tuple[str, str, str, int]] = self.load_due_failed_upload_media('one')
+        mock_store.fetch_due_failed_upload_medias.return_value = due_failed_upload_media
+        url, _, _, _ = due_failed_upload_media[0]
 
         with LogCapture(level=logging.ERROR) as log:
             self.crawler.retry_backup_media()
@@ -362,12 +824,238 @@ class TestCrawler:
     @mock.patch('app.crawler.Crawler.retry_backup_media', mock_crawler_func2)
     def test_crawling_tweets(self) -> None:
         mock_twitter.get_target_tweets.return_value = {}
+        mock_crawler_func.return_value = 3
         user = TwitterUser(id=TEST_TWITTER_ID)
-        self.crawler.crawling_tweets(user)
 
-        mock_twitter.get_target_tweets(user)
+        assert self.crawler.crawling_tweets(user) == 3
+
+        mock_twitter.get_target_tweets.assert_called_once_with(user, CrawlProgress(since_id=1))
         mock_crawler_func.assert_called_once_with({})
         mock_crawler_func2.assert_called_once_with()
+        mock_twitter.remember_favorites.assert_not_called()
+
+    @mock.patch('app.crawler.Crawler.backup_media', mock_crawler_func)
+    @mock.patch('app.crawler.Crawler.retry_backup_media', mock_crawler_func2)
+    @nose2.tools.params(
+        True,
+        False,
+    )
+    def test_crawling_tweets__remember_favorites(self, is_flushed: bool) -> None:
+        mock_twitter.mode = 'fav'
+        mock_twitter.get_target_tweets.side_effect = \
+            lambda _, progress: progress.fav_tweet_ids.update({'1', '2'}) or {}
+        mock_crawler_func.return_value = 0
+        mock_store.flush.return_value = is_flushed
+        user = TwitterUser(id=TEST_TWITTER_ID)
+
+        with LogCapture(level=logging.WARNING):
+            self.crawler.crawling_tweets(user)
+
+        # The favorites of a cycle which is not stored are scanned again in the next one
+        if is_flushed:
+            mock_twitter.remember_favorites.assert_called_once_with(user, {'1', '2'})
+        else:
+            mock_twitter.remember_favorites.assert_not_called()
+        mock_store.flush.return_value = mock.DEFAULT
+
+    def test_load_since_ids(self) -> None:
+        mock_store.fetch_since_ids.return_value = [('user1', 1234)]
+        user_list = [TwitterUser(id='user1'), TwitterUser(id='user2')]
+
+        with LogCapture(level=logging.INFO) as log:
+            self.crawler.load_since_ids(user_list)
+            log.check(('app.crawler', 'INFO', 'Load since_id. user = user1, since_id=1234'))
+
+        mock_store.fetch_since_ids.assert_called_once_with(['user1', 'user2'])
+        assert user_list == [TwitterUser(id='user1', since_id=1234), TwitterUser(id='user2')]
+
+    def test_load_since_ids__exception(self) -> None:
+        mock_store.fetch_since_ids.side_effect = Exception('connection')
+        user_list = [TwitterUser(id='user1')]
+
+        with LogCapture(level=logging.ERROR) as log:
+            self.crawler.load_since_ids(user_list)
+            log.check(('app.crawler', 'ERROR', "Fetch failed. table=twitter_user, exception=('connection',)"))
+        assert user_list == [TwitterUser(id='user1')]
+        mock_store.fetch_since_ids.side_effect = None
+
+    @nose2.tools.params(
+        (1, 0),
+        (1234, 1),
+    )
+    def test_store_since_id(self, since_id: int, upsert_count: int) -> None:
+        self.crawler.store_since_id(TwitterUser(id=TEST_TWITTER_ID, since_id=since_id))
+
+        assert mock_store.upsert_since_id.call_count == upsert_count
+
+    def test_store_since_id__exception(self) -> None:
+        mock_store.upsert_since_id.side_effect = Exception('connection')
+
+        with LogCapture(level=logging.ERROR) as log:
+            self.crawler.store_since_id(TwitterUser(id=TEST_TWITTER_ID, since_id=1234))
+            log.check(('app.crawler', 'ERROR', f"Upsert failed. user = {TEST_TWITTER_ID}, since_id=1234, "
+                                               f"exception=('connection',)"))
+        mock_store.upsert_since_id.side_effect = None
+
+    def test_fetch_known_tweet_ids(self) -> None:
+        mock_store.fetch_not_added_tweet_ids.side_effect = lambda ids: [('2',)]
+
+        assert self.crawler.twitter.known_tweet_ids == self.crawler.fetch_known_tweet_ids
+        assert self.crawler.fetch_known_tweet_ids(['1', '2', '3']) == {'1', '3'}
+
+    def test_fetch_known_tweet_ids__exception(self) -> None:
+        mock_store.fetch_not_added_tweet_ids.side_effect = Exception('connection')
+
+        with LogCapture(level=logging.ERROR) as log:
+            assert self.crawler.fetch_known_tweet_ids(['1']) == set()
+            log.check(('app.crawler', 'ERROR',
+                       "Fetch failed. table=uploaded_media_tweet, exception=('connection',)"))
+
+    def test_load_album_id(self) -> None:
+        mock_store.fetch_google_album_id.return_value = 'testAlbumId'
+
+        assert self.crawler.google_photos.load_album_id == self.crawler.load_album_id
+        assert self.crawler.load_album_id('test_album_title') == 'testAlbumId'
+        mock_store.fetch_google_album_id.assert_called_once_with('test_album_title')
+
+    def test_load_album_id__exception(self) -> None:
+        mock_store.fetch_google_album_id.side_effect = Exception('connection')
+
+        with LogCapture(level=logging.ERROR) as log:
+            assert self.crawler.load_album_id('test_album_title') is None
+            log.check(('app.crawler', 'ERROR', "Fetch failed. table=google_album, exception=('connection',)"))
+        mock_store.fetch_google_album_id.side_effect = None
+
+    def test_store_album_id__exception(self) -> None:
+        mock_store.upsert_google_album.side_effect = Exception('connection')
+
+        assert self.crawler.google_photos.store_album_id == self.crawler.store_album_id
+        with LogCapture(level=logging.ERROR) as log:
+            self.crawler.store_album_id('test_album_title', 'testAlbumId')
+            log.check(('app.crawler', 'ERROR', 'Upsert failed. album_title=test_album_title, album_id=testAlbumId, '
+                                               "exception=('connection',)"))
+        mock_store.upsert_google_album.side_effect = None
+
+    def test_load_fav_snapshots(self) -> None:
+        mock_store.fetch_fav_snapshots.return_value = [('user1', FavoriteSnapshot([3, 1, 2]).to_bytes())]
+        user_list = [TwitterUser(id='user1'), TwitterUser(id='user2')]
+
+        with LogCapture(level=logging.INFO) as log:
+            self.crawler.load_fav_snapshots(user_list)
+            log.check(('app.crawler', 'INFO', 'Load fav_snapshot. user = user1, tweets=3'))
+
+        mock_store.fetch_fav_snapshots.assert_called_once_with(['user1', 'user2'])
+        assert user_list[0].fav_snapshot == FavoriteSnapshot([1, 2, 3])
+        assert user_list[1].fav_snapshot is None
+
+    def test_load_fav_snapshots__exception(self) -> None:
+        mock_store.fetch_fav_snapshots.side_effect = Exception('connection')
+        user_list = [TwitterUser(id='user1')]
+
+        with LogCapture(level=logging.ERROR) as log:
+            self.crawler.load_fav_snapshots(user_list)
+            log.check(('app.crawler', 'ERROR', "Fetch failed. table=twitter_user, exception=('connection',)"))
+        assert user_list[0].fav_snapshot is None
+        mock_store.fetch_fav_snapshots.side_effect = None
+
+    def test_store_fav_snapshot(self) -> None:
+        user = TwitterUser(id=TEST_TWITTER_ID)
+        self.crawler.store_fav_snapshot(user)
+        mock_store.upsert_fav_snapshot.assert_not_called()
+
+        user.fav_snapshot = FavoriteSnapshot([1, 2])
+        self.crawler.store_fav_snapshot(user)
+        self.crawler.store_fav_snapshot(user)
+        mock_store.upsert_fav_snapshot.assert_called_once_with(TEST_TWITTER_ID, FavoriteSnapshot([1, 2]).to_bytes())
+        assert user.fav_snapshot.is_stored
+
+    def test_store_fav_snapshot__exception(self) -> None:
+        mock_store.upsert_fav_snapshot.side_effect = Exception('connection')
+        user = TwitterUser(id=TEST_TWITTER_ID, fav_snapshot=FavoriteSnapshot([1, 2]))
+
+        with LogCapture(level=logging.ERROR) as log:
+            self.crawler.store_fav_snapshot(user)
+            log.check(('app.crawler', 'ERROR', f"Upsert failed. user = {TEST_TWITTER_ID}, tweets=2, "
+                                               f"exception=('connection',)"))
+        assert user.fav_snapshot is not None and not user.fav_snapshot.is_stored
+        mock_store.upsert_fav_snapshot.side_effect = None
+
+    @mock.patch('app.crawler.Crawler.backup_media', mock_crawler_func)
+    @mock.patch('app.crawler.Crawler.retry_backup_media', mock_crawler_func2)
+    def test_crawling_tweets__store_since_id(self) -> None:
+        mock_crawler_func.return_value = 0
+        user = TwitterUser(id=TEST_TWITTER_ID)
+
+        def get_target_tweets(_: TwitterUser, progress: CrawlProgress) -> dict:
+            progress.since_id = 1234
+            return {}
+
+        mock_twitter.get_target_tweets.side_effect = get_target_tweets
+        self.crawler.crawling_tweets(user)
+        mock_store.upsert_since_id.assert_called_once_with(TEST_TWITTER_ID, 1234)
+        assert user.since_id == 1234
+
+    @mock.patch('app.crawler.Crawler.backup_media', mock_crawler_func)
+    @mock.patch('app.crawler.Crawler.retry_backup_media', mock_crawler_func2)
+    def test_crawling_tweets__failed_cycle(self) -> None:
+        user = TwitterUser(id=TEST_TWITTER_ID, since_id=1000)
+        read_since_ids: List[int] = []
+
+        def get_target_tweets(_: TwitterUser, progress: CrawlProgress) -> dict:
+            read_since_ids.append(progress.since_id)
+            progress.since_id = 2000
+            return {}
+
+        mock_twitter.get_target_tweets.side_effect = get_target_tweets
+        mock_crawler_func.side_effect = [Exception('backup'), 0, 0]
+        mock_store.flush.side_effect = [False, True]
+        with nose2.tools.such.helper.assertRaises(Exception):
+            self.crawler.crawling_tweets(user)
+        with LogCapture(level=logging.WARNING):
+            self.crawler.crawling_tweets(user)
+        assert user.since_id == 1000
+        mock_store.upsert_since_id.assert_not_called()
+
+        self.crawler.crawling_tweets(user)
+
+        # The cycles after a failed one in the same process read the same tweets again
+        assert read_since_ids == [1000, 1000, 1000]
+        assert user.since_id == 2000
+        mock_store.upsert_since_id.assert_called_once_with(TEST_TWITTER_ID, 2000)
+        mock_crawler_func.side_effect = None
+        mock_store.flush.side_effect = None
+
+    @mock.patch('app.crawler.Crawler.backup_media', mock_crawler_func)
+    @mock.patch('app.crawler.Crawler.retry_backup_media', mock_crawler_func2)
+    def test_crawling_tweets__flush_failed(self) -> None:
+        mock_crawler_func.return_value = 0
+        mock_twitter.get_target_tweets.return_value = {}
+        mock_store.flush.return_value = False
+        user = TwitterUser(id=TEST_TWITTER_ID, since_id=1234, fav_snapshot=FavoriteSnapshot([1]))
+
+        with LogCapture(level=logging.WARNING) as log:
+            self.crawler.crawling_tweets(user)
+            log.check(('app.crawler', 'WARNING', f'Keep the checkpoint until the tweets are stored. '
+                                                 f'user = {TEST_TWITTER_ID}'))
+
+        # The next cycle reads the tweets again, which are not stored yet
+        mock_store.upsert_since_id.assert_not_called()
+        mock_store.upsert_fav_snapshot.assert_not_called()
+        mock_crawler_func2.assert_called_once_with()
+        mock_store.flush.return_value = mock.DEFAULT
+
+    @mock.patch('app.crawler.Crawler.retry_backup_media', mock_crawler_func2)
+    def test_crawling_tweets__pipeline(self) -> None:
+        self.crawler._pipeline_enabled = True
+        user = TwitterUser(id=TEST_TWITTER_ID)
+
+        with mock.patch('app.crawler.Crawler.CyclePipeline') as cycle_pipeline:
+            self.crawler.crawling_tweets(user)
+            cycle_pipeline.assert_called_once_with(self.crawler)
+            cycle_pipeline.return_value.run.assert_called_once_with(user, CrawlProgress(since_id=1))
+
+        mock_twitter.get_target_tweets.assert_not_called()
+        mock_crawler_func2.assert_called_once_with()
 
     @mock.patch('time.sleep', mock_sleep)
     @mock.patch('app.crawler.Crawler.crawling_tweets', mock_crawler_func)
@@ -377,21 +1065,42 @@ class TestCrawler:
     )
     def test_main(self, interval: Optional[str]) -> None:
         mock_sleep.side_effect = Exception()
+        mock_crawler_func.return_value = 0
         setattr(mock_twitter, 'mode', DEFAULT_MODE)
 
         test_interval: str = DEFAULT_INTERVAL
         if interval:
             os.environ['INTERVAL'] = interval
             test_interval = interval
+        os.environ['INTERVAL_JITTER'] = '0'
         os.environ['TWITTER_USER_IDS'] = TEST_TWITTER_ID
 
         with LogCapture(level=logging.INFO) as log:
             with nose2.tools.such.helper.assertRaises(Exception):
                 self.crawler.main()
             log.check(('app.crawler', 'INFO', f'Crawling start. user = {TEST_TWITTER_ID}, mode={DEFAULT_MODE}'),
-                      ('app.crawler', 'INFO', f'Interval. sleep {test_interval} minutes.'))
+                      ('app.crawler', 'INFO', mock.ANY))
 
         mock_crawler_func.assert_called_once_with(TwitterUser(id=TEST_TWITTER_ID))
+        (sleep_seconds,), _ = mock_sleep.call_args
+        assert int(test_interval) * 60 - 1 < sleep_seconds <= int(test_interval) * 60
+
+    @mock.patch('time.sleep', mock_sleep)
+    @mock.patch('app.crawler.Crawler.crawling_tweets', mock_crawler_func)
+    def test_main__users(self) -> None:
+        mock_sleep.side_effect = [None, Exception()]
+        mock_crawler_func.return_value = 0
+        setattr(mock_twitter, 'mode', DEFAULT_MODE)
+        os.environ['INTERVAL_JITTER'] = '0'
+        os.environ['TWITTER_USER_IDS'] = 'user1,user2'
+
+        with LogCapture(level=logging.INFO):
+            with nose2.tools.such.helper.assertRaises(Exception):
+                self.crawler.main()
+
+        # Every user is due at the start, then each one is crawled again after its own interval
+        crawled_users = [args[0].id for (args, _) in mock_crawler_func.call_args_list]
+        assert crawled_users == ['user1', 'user2', 'user1']
 
     @mock.patch('time.sleep', mock_sleep)
     @mock.patch('app.crawler.Crawler.crawling_tweets', mock_crawler_func)
@@ -405,3 +1114,159 @@ class TestCrawler:
             with nose2.tools.such.helper.assertRaises(Exception):
                 self.crawler.main()
             log.check(('app.crawler', 'ERROR', 'Crawling error exception=()'))
+
+    @mock.patch('app.crawler.AsyncCrawler', mock_async_crawler)
+    def test_main__asyncio(self) -> None:
+        mock_async_crawler.reset_mock()
+        setattr(mock_twitter, 'mode', DEFAULT_MODE)
+        os.environ['TWITTER_USER_IDS'] = TEST_TWITTER_ID
+        self.crawler._engine = 'asyncio'
+
+        self.crawler.main()
+
+        mock_async_crawler.assert_called_once_with(self.crawler.crawling_tweets, DEFAULT_MODE, mock.ANY)
+        mock_async_crawler.return_value.main.assert_called_once_with([TwitterUser(id=TEST_TWITTER_ID)])
+
+
+class TestCyclePipeline:
+    crawler: Crawler
+
+    @mock.patch('app.crawler.GooglePhotos', mock_google_photos)
+    @mock.patch('app.crawler.Twitter', mock_twitter)
+    @mock.patch('app.crawler.Store', mock_store)
+    @mock.patch('app.crawler.Downloader', mock_downloader)
+    @mock.patch('os.makedirs', mock_makedirs)
+    def setUp(self) -> None:
+        TestCrawler.clear_env()
+        mock_google_photos.reset_mock()
+        mock_google_photos.create_media_items.reset_mock(side_effect=True)
+        mock_google_photos.create_media_items.side_effect = lambda items: [TEST_CREATED_STATUS for _ in items]
+        mock_twitter.reset_mock(side_effect=True)
+        mock_twitter.make_original_image_url.reset_mock(side_effect=True)
+        mock_twitter.get_page_tweet_medias.reset_mock(side_effect=True)
+        mock_twitter.difference_last_favorites.reset_mock(side_effect=True)
+        mock_store.reset_mock()
+        mock_store.fetch_not_added_tweet_ids.reset_mock(side_effect=True)
+        mock_store.fetch_uploaded_media_hash.reset_mock(side_effect=True)
+        mock_store.fetch_uploaded_media_hash.return_value = None
+        mock_crawler_func.reset_mock(side_effect=True, return_value=True)
+        mock_crawler_func2.reset_mock(side_effect=True, return_value=True)
+
+        mock_google_photos.return_value = mock_google_photos
+        mock_twitter.return_value = mock_twitter
+        mock_store.return_value = mock_store
+        mock_downloader.return_value = mock_downloader
+
+        os.environ['SAVE_MODE'] = 'google'
+        self.crawler = Crawler()
+
+    def tearDown(self) -> None:
+        TestCrawler.clear_env()
+
+    @mock.patch('os.remove', mock_remove)
+    @mock.patch('app.crawler.Crawler.store_failed_upload_media', mock_crawler_func2)
+    @mock.patch('app.crawler.Crawler.store_tweet_info', mock_crawler_func)
+    @nose2.tools.params(
+        ('fav', 50, 1),
+        ('rt', 50, 1),
+        ('rt', 3, 3),
+    )
+    def test_run(self, page_type: str, batch_create_limit: int, create_count: int) -> None:
+        target_media_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(TEST_MEDIA_TWEETS)
+        tweet_ids: List[str] = list(target_media_tweets.keys())
+        pages: List[Dict[str, TweetMedia]] = [
+            {tweet_id: target_media_tweets[tweet_id] for tweet_id in tweet_ids[:3]},
+            # the second page finds one tweet again
+            {tweet_id: target_media_tweets[tweet_id] for tweet_id in tweet_ids[2:]},
+        ]
+        # A TweetMedia has the id_str of a tweet, so it stands in for the tweepy.Status of a page
+        mock_twitter.iter_target_tweet_pages.return_value = iter([(page_type, list(page.values())) for page in pages])
+        mock_twitter.get_page_tweet_medias.side_effect = \
+            lambda _, tweets: {tweet.id_str: target_media_tweets[tweet.id_str] for tweet in tweets}
+        mock_twitter.difference_last_favorites.side_effect = lambda _, tweet_medias: tweet_medias
+        mock_twitter.make_original_image_url.side_effect = lambda url: url
+        mock_store.fetch_not_added_tweet_ids.side_effect = lambda ids: [(tweet_id,) for tweet_id in ids]
+        failed_url: str = target_media_tweets[TEST_TWEET_ID].urls[0]
+        user = TwitterUser(id=TEST_TWITTER_ID)
+        progress: CrawlProgress = CrawlProgress()
+
+        with mock.patch('app.crawler.Crawler.fetch_media',
+                        side_effect=lambda url, _: None if url == failed_url else
+                        hashlib.sha256(url.encode()).hexdigest()) as fetch, \
+                mock.patch('app.crawler.Crawler.upload_google_photos_file', return_value=TEST_UPLOAD_TOKEN) as upload, \
+                mock.patch('app.crawler.BATCH_CREATE_LIMIT', batch_create_limit):
+            with LogCapture(level=logging.WARNING) as log:
+                new_media_count: int = self.crawler.CyclePipeline(self.crawler).run(user, progress)
+                log.check(('app.crawler', 'WARNING', f'Save failed. tweet_id={TEST_TWEET_ID}, media_url={failed_url}'))
+
+            media_count: int = sum(len(tweet_media.urls) for tweet_media in target_media_tweets.values())
+            assert new_media_count == media_count
+            assert fetch.call_count == media_count
+            assert upload.call_count == media_count - 1
+
+        # The media items are created in batches, and the last one is created after the stages stop
+        assert mock_google_photos.create_media_items.call_count == create_count
+        assert sum(len(args[0]) for (args, _) in mock_google_photos.create_media_items.call_args_list) == \
+            media_count - 1
+        mock_twitter.iter_target_tweet_pages.assert_called_once_with(user, progress)
+        assert mock_store.fetch_not_added_tweet_ids.call_count == 2
+        assert mock_google_photos.init_album.call_count == 1
+        stored_tweets = [args[0] for (args, _) in mock_crawler_func.call_args_list]
+        assert sorted(tweet.id_str for tweet in stored_tweets) == sorted(tweet_ids)
+        target_tweet: TweetMedia = target_media_tweets[TEST_TWEET_ID]
+        mock_crawler_func2.assert_called_once_with(target_tweet, self.load_failed_upload_media('one'))
+
+        # The favorites are remembered by crawling_tweets after the tweets are stored
+        assert progress.fav_tweet_ids == (set(tweet_ids) if page_type == 'fav' else set())
+        mock_twitter.remember_favorites.assert_not_called()
+
+    @mock.patch('app.crawler.Crawler.store_tweet_info', mock_crawler_func)
+    def test_run__no_new_tweet_ids(self) -> None:
+        target_media_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(TEST_MEDIA_TWEETS)
+        mock_twitter.iter_target_tweet_pages.return_value = iter([('rt', 0)])
+        mock_twitter.get_page_tweet_medias.return_value = target_media_tweets
+        mock_store.fetch_not_added_tweet_ids.return_value = []
+
+        with mock.patch('app.crawler.Crawler.fetch_media') as fetch:
+            self.crawler.CyclePipeline(self.crawler).run(TwitterUser(id=TEST_TWITTER_ID), CrawlProgress())
+            fetch.assert_not_called()
+
+        mock_crawler_func.assert_not_called()
+        mock_google_photos.init_album.assert_not_called()
+
+    @mock.patch('app.crawler.Crawler.store_tweet_info', mock_crawler_func)
+    def test_run__streaming(self) -> None:
+        target_media_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(TEST_MEDIA_TWEETS)
+        target_media_tweet: TweetMedia = target_media_tweets[TEST_TWEET_ID]
+        mock_twitter.iter_target_tweet_pages.return_value = iter([('rt', 0)])
+        mock_twitter.get_page_tweet_medias.return_value = {TEST_TWEET_ID: target_media_tweet}
+        mock_store.fetch_not_added_tweet_ids.return_value = [(TEST_TWEET_ID,)]
+        self.crawler._streaming_upload_enabled = True
+
+        with mock.patch('app.crawler.Crawler.fetch_media') as fetch, \
+                mock.patch('app.crawler.Crawler.upload_media_stream', return_value=True) as upload_stream:
+            self.crawler.CyclePipeline(self.crawler).run(TwitterUser(id=TEST_TWITTER_ID), CrawlProgress())
+            fetch.assert_not_called()
+            assert upload_stream.call_count == len(target_media_tweet.urls)
+
+        mock_crawler_func.assert_called_once_with(target_media_tweet)
+
+    @mock.patch('app.crawler.Crawler.store_tweet_info', mock_crawler_func)
+    def test_run__stage_error(self) -> None:
+        target_media_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(TEST_MEDIA_TWEETS)
+        mock_twitter.iter_target_tweet_pages.return_value = iter([('fav', [target_media_tweets[TEST_TWEET_ID]])])
+        mock_twitter.get_page_tweet_medias.return_value = target_media_tweets
+        mock_twitter.difference_last_favorites.side_effect = lambda _, tweet_medias: tweet_medias
+        mock_store.fetch_not_added_tweet_ids.side_effect = Exception('fetch')
+
+        with LogCapture(level=logging.ERROR):
+            with nose2.tools.such.helper.assertRaises(PipelineError):
+                self.crawler.CyclePipeline(self.crawler).run(TwitterUser(id=TEST_TWITTER_ID), CrawlProgress())
+
+        # The tweets dropped by the error are not remembered as backed up
+        mock_crawler_func.assert_not_called()
+        mock_twitter.remember_favorites.assert_not_called()
+
+    @staticmethod
+    def load_failed_upload_media(json_name: str) -> List[Tuple[str, str]]:
+        return TestCrawler.load_failed_upload_media(json_name)
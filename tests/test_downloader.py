@@ -0,0 +1,293 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import nose2.tools
+import requests
+from testfixtures import LogCapture
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Type
+from unittest import mock
+
+from app.downloader import Downloader, DownloadStats
+from app.errors import PermanentError
+from tests.lib.http_server import MediaServer
+from tests.lib.logcapture_helper import LogCaptureHelper
+from tests.lib.utils import delete_env
+
+TEST_CONTENT = os.urandom(100 * 1024)
+TEST_PATH = '/media/test.jpg'
+TEST_HASH = hashlib.sha256(TEST_CONTENT).hexdigest()
+
+mock_sleep = mock.MagicMock()
+
+
+class TestDownloader:
+    server: MediaServer
+    download_dir: str
+
+    def setUp(self) -> None:
+        self.clear_env()
+        os.environ['STREAM_CHUNK_SIZE'] = '4096'
+        mock_sleep.reset_mock()
+        self.server = MediaServer().start()
+        self.server.contents[TEST_PATH] = TEST_CONTENT
+        self.download_dir = tempfile.mkdtemp()
+        self.downloader = Downloader()
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        shutil.rmtree(self.download_dir)
+        self.clear_env()
+
+    @staticmethod
+    def clear_env() -> None:
+        delete_env('DOWNLOAD_CONNECT_TIMEOUT')
+        delete_env('DOWNLOAD_READ_TIMEOUT')
+        delete_env('STREAM_CHUNK_SIZE')
+        delete_env('DOWNLOAD_WORKERS')
+        delete_env('DOWNLOAD_SEGMENTS')
+        delete_env('DOWNLOAD_SEGMENT_THRESHOLD')
+
+    @nose2.tools.params(
+        (None, None, (10.0, 60.0)),
+        ('1.5', '3', (1.5, 3.0)),
+    )
+    def test_timeout(self, connect_timeout: str, read_timeout: str, ans: tuple) -> None:
+        if connect_timeout:
+            os.environ['DOWNLOAD_CONNECT_TIMEOUT'] = connect_timeout
+        if read_timeout:
+            os.environ['DOWNLOAD_READ_TIMEOUT'] = read_timeout
+        assert Downloader().timeout == ans
+
+    def test_download(self) -> None:
+        download_path = f'{self.download_dir}/user/test.jpg'
+        url = self.server.url(TEST_PATH)
+
+        with LogCapture(level=logging.DEBUG) as log:
+            media_hash: str = self.downloader.download(url, download_path)
+            assert LogCaptureHelper.check_contain(log, ('app.downloader', 'DEBUG',
+                                                        f'Download file. url={url}, path={download_path}'))
+
+        assert media_hash == TEST_HASH
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        stats: DownloadStats = self.downloader.stats()
+        assert stats.count == 1 and stats.total_bytes == len(TEST_CONTENT)
+        assert stats.average_seconds > 0
+
+    def test_download__keep_alive(self) -> None:
+        for i in range(3):
+            self.downloader.download(self.server.url(TEST_PATH), f'{self.download_dir}/test{i}.jpg')
+
+        assert self.server.connections == 1
+        assert self.downloader.stats().count == 3
+
+    def test_download__same_path(self) -> None:
+        download_path = f'{self.download_dir}/test.jpg'
+        self.server.delay = 0.05
+
+        # The same media found on several tweets is downloaded by several workers at once
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures: List[Future] = [executor.submit(self.downloader.download, self.server.url(TEST_PATH),
+                                                     download_path) for _ in range(4)]
+            assert [future.result() for future in futures] == [TEST_HASH] * 4
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert not os.path.exists(Downloader.make_partial_path(download_path))
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    @nose2.tools.params(
+        (503, requests.exceptions.HTTPError, 3),
+        # The media of a deleted tweet is not there however many times it is requested
+        (404, PermanentError, 1),
+    )
+    def test_download__http_error(self, status: int, error_type: Type[Exception], request_count: int) -> None:
+        self.server.status[TEST_PATH] = status
+
+        with nose2.tools.such.helper.assertRaises(error_type):
+            self.downloader.download(self.server.url(TEST_PATH), f'{self.download_dir}/test.jpg')
+        assert len(self.server.requests) == request_count
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_download__timeout(self) -> None:
+        os.environ['DOWNLOAD_READ_TIMEOUT'] = '0.05'
+        self.server.delay = 0.2
+        downloader = Downloader()
+
+        with nose2.tools.such.helper.assertRaises(requests.exceptions.Timeout):
+            downloader.download(self.server.url(TEST_PATH), f'{self.download_dir}/test.jpg')
+        assert mock_sleep.call_count == 2
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_download__resume_after_drop(self) -> None:
+        download_path = f'{self.download_dir}/test.jpg'
+        self.server.drop_after[TEST_PATH] = 30000
+
+        with LogCapture():
+            assert self.downloader.download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert not os.path.exists(Downloader.make_partial_path(download_path))
+        # Only the whole chunks received before the drop are kept
+        ranges = [request['range'] for request in self.server.requests]
+        assert ranges == [None, f'bytes={30000 // 4096 * 4096}-']
+
+    def write_partial_file(self, download_path: str, content: bytes, validator: Optional[str]) -> None:
+        with open(Downloader.make_partial_path(download_path), 'wb') as f:
+            f.write(content)
+        if validator is not None:
+            with open(Downloader.make_validator_path(download_path), 'w') as f:
+                f.write(validator)
+
+    @nose2.tools.params(
+        (True, 'bytes=1000-', 206),
+        (False, 'bytes=1000-', 200),
+    )
+    def test_download__resume_partial_file(self, accept_ranges: bool, ans_range: str, ans_status: int) -> None:
+        download_path = f'{self.download_dir}/test.jpg'
+        self.write_partial_file(download_path, TEST_CONTENT[:1000], self.server.etag(TEST_PATH))
+        self.server.accept_ranges = accept_ranges
+
+        with LogCapture(level=logging.DEBUG) as log:
+            assert self.downloader.download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+            assert LogCaptureHelper.check_contain(log, ('app.downloader', 'DEBUG',
+                                                        f'Resume download. url={self.server.url(TEST_PATH)}, '
+                                                        f'offset=1000, status={ans_status}'))
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert self.server.requests[0]['range'] == ans_range
+        assert self.server.requests[0]['if_range'] == self.server.etag(TEST_PATH)
+        assert not os.path.exists(Downloader.make_validator_path(download_path))
+
+    @nose2.tools.params(
+        ('"changed"', 'bytes=1000-'),
+        (None, None),
+    )
+    def test_download__partial_file_changed(self, validator: Optional[str], ans_range: Optional[str]) -> None:
+        download_path = f'{self.download_dir}/test.jpg'
+        self.write_partial_file(download_path, os.urandom(1000), validator)
+
+        # The partial file of another content, or of an unknown one, is started over
+        assert self.downloader.download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert [request['range'] for request in self.server.requests] == [ans_range]
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    @nose2.tools.params(
+        (len(TEST_CONTENT), 1),
+        (len(TEST_CONTENT) + 10, 2),
+    )
+    def test_download__partial_file_out_of_range(self, partial_size: int, ans_request_count: int) -> None:
+        download_path = f'{self.download_dir}/test.jpg'
+        self.write_partial_file(download_path, (TEST_CONTENT * 2)[:partial_size], self.server.etag(TEST_PATH))
+
+        with LogCapture():
+            assert self.downloader.download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert len(self.server.requests) == ans_request_count
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_download__segments(self) -> None:
+        os.environ['DOWNLOAD_SEGMENTS'] = '3'
+        os.environ['DOWNLOAD_SEGMENT_THRESHOLD'] = '1024'
+        download_path = f'{self.download_dir}/test.jpg'
+        self.server.drop_after[TEST_PATH] = 0
+        downloader = Downloader()
+
+        assert downloader.download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert os.listdir(self.download_dir) == ['test.jpg']
+        ranges = sorted(request['range'] or '' for request in self.server.requests)
+        # The first response is dropped and decides the segments, then each segment is fetched by range
+        assert ranges[0] == ''
+        assert set(ranges[1:]) == {'bytes=0-34133', 'bytes=34134-68267', 'bytes=68268-102399'}
+
+    @nose2.tools.params(
+        ('2', str(len(TEST_CONTENT) + 1)),
+        ('1', '1024'),
+    )
+    def test_download__not_segmented(self, segments: str, threshold: str) -> None:
+        os.environ['DOWNLOAD_SEGMENTS'] = segments
+        os.environ['DOWNLOAD_SEGMENT_THRESHOLD'] = threshold
+
+        Downloader().download(self.server.url(TEST_PATH), f'{self.download_dir}/test.jpg')
+
+        assert [request['range'] for request in self.server.requests] == [None]
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_download__segments_resume(self) -> None:
+        os.environ['DOWNLOAD_SEGMENTS'] = '2'
+        os.environ['DOWNLOAD_SEGMENT_THRESHOLD'] = '1024'
+        download_path = f'{self.download_dir}/test.jpg'
+        partial_path = Downloader.make_partial_path(download_path)
+        half = len(TEST_CONTENT) // 2
+        with open(f'{partial_path}.0', 'wb') as f:
+            f.write(TEST_CONTENT[:half])
+        with open(f'{partial_path}.1', 'wb') as f:
+            f.write(TEST_CONTENT[half:half + 100])
+        with open(Downloader.make_validator_path(download_path), 'w') as f:
+            f.write(self.server.etag(TEST_PATH))
+
+        assert Downloader().download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        ranges = [request['range'] for request in self.server.requests]
+        assert ranges == [None, f'bytes={half + 100}-{len(TEST_CONTENT) - 1}']
+        assert self.server.requests[1]['if_range'] == self.server.etag(TEST_PATH)
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_download__segments_changed(self) -> None:
+        os.environ['DOWNLOAD_SEGMENTS'] = '2'
+        os.environ['DOWNLOAD_SEGMENT_THRESHOLD'] = '1024'
+        download_path = f'{self.download_dir}/test.jpg'
+        partial_path = Downloader.make_partial_path(download_path)
+        with open(f'{partial_path}.0', 'wb') as f:
+            f.write(os.urandom(100))
+        with open(Downloader.make_validator_path(download_path), 'w') as f:
+            f.write('"changed"')
+
+        # The segments of the old content are not resumed
+        assert Downloader().download(self.server.url(TEST_PATH), download_path) == TEST_HASH
+
+        with open(download_path, 'rb') as f:
+            assert f.read() == TEST_CONTENT
+        assert os.listdir(self.download_dir) == ['test.jpg']
+
+    def test_remove_partial(self) -> None:
+        download_path = f'{self.download_dir}/test.jpg'
+        self.write_partial_file(download_path, TEST_CONTENT[:1000], self.server.etag(TEST_PATH))
+        with open(f'{Downloader.make_partial_path(download_path)}.0', 'wb') as f:
+            f.write(TEST_CONTENT[:1000])
+
+        with LogCapture(level=logging.DEBUG) as log:
+            self.downloader.remove_partial(download_path)
+            log.check(('app.downloader', 'DEBUG', f'Delete partial file. path={download_path}.part'),
+                      ('app.downloader', 'DEBUG', f'Delete partial file. path={download_path}.part.validator'))
+        assert os.listdir(self.download_dir) == []
+
+    def test_hash_chunks(self) -> None:
+        media_hash = hashlib.sha256()
+
+        assert list(Downloader.hash_chunks(iter([b'12', b'3']), media_hash)) == [b'12', b'3']
+        assert media_hash.hexdigest() == hashlib.sha256(b'123').hexdigest()
+
+    def test_open_stream(self) -> None:
+        with self.downloader.open_stream(self.server.url(TEST_PATH)) as (chunks, size):
+            content = b''.join(chunks)
+
+        assert content == TEST_CONTENT
+        assert size == len(TEST_CONTENT)
+        assert self.downloader.stats().count == 1
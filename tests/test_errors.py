@@ -0,0 +1,124 @@
+import logging
+
+import httplib2
+import nose2.tools
+import requests
+from googleapiclient.errors import HttpError
+from typing import List, Optional, Type
+from testfixtures import LogCapture
+
+from app.errors import DOWNLOAD_STATUSES, GOOGLE_API_STATUSES, PERMANENT, QUOTA, TRANSIENT, ErrorStats, \
+    PermanentError, QuotaExceededError, QuotaGate, classify, classify_errors, error_counter, get_retry_after
+
+# 2020-01-01 00:00:00 PST
+TEST_RESET_TIME = 1577865600.0
+
+
+def make_http_error(status: int, headers: Optional[dict] = None) -> HttpError:
+    response = httplib2.Response({'status': status, **(headers or {})})
+    response.reason = 'test'
+    return HttpError(resp=response, content=b'{}')
+
+
+def make_requests_error(status: int) -> requests.exceptions.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f'{status} test', response=response)
+
+
+class TestErrors:
+    @nose2.tools.params(
+        (make_requests_error(404), DOWNLOAD_STATUSES, PERMANENT),
+        (make_requests_error(429), DOWNLOAD_STATUSES, TRANSIENT),
+        (make_requests_error(503), DOWNLOAD_STATUSES, TRANSIENT),
+        (requests.exceptions.Timeout(), DOWNLOAD_STATUSES, TRANSIENT),
+        (make_http_error(400), GOOGLE_API_STATUSES, PERMANENT),
+        (make_http_error(429), GOOGLE_API_STATUSES, QUOTA),
+        (make_http_error(401), GOOGLE_API_STATUSES, TRANSIENT),
+        (QuotaExceededError(make_http_error(429)), None, QUOTA),
+    )
+    def test_classify(self, error: Exception, statuses: Optional[dict], ans: str) -> None:
+        assert classify(error, statuses) == ans
+
+    @nose2.tools.params(
+        ({'retry-after': '120'}, 120.0),
+        ({'retry-after': 'Wed, 01 Jan 2020 00:00:00 GMT'}, None),
+        ({}, None),
+    )
+    def test_get_retry_after(self, headers: dict, ans: Optional[float]) -> None:
+        assert get_retry_after(make_http_error(429, headers)) == ans
+
+    @nose2.tools.params(
+        (make_requests_error(404), PermanentError, ErrorStats(permanent=1)),
+        (make_http_error(429), QuotaExceededError, ErrorStats(quota=1)),
+        (make_requests_error(503), requests.exceptions.HTTPError, ErrorStats(transient=1)),
+        (PermanentError(make_requests_error(404)), PermanentError, ErrorStats()),
+    )
+    def test_classify_errors(self, error: Exception, error_type: Type[Exception], ans: ErrorStats) -> None:
+        statuses: dict = {**DOWNLOAD_STATUSES, **GOOGLE_API_STATUSES}
+
+        @classify_errors(statuses)
+        def fail() -> None:
+            raise error
+
+        before: ErrorStats = error_counter.stats()
+        with nose2.tools.such.helper.assertRaises(error_type):
+            fail()
+
+        # The errors classified already are counted where they were raised
+        after: ErrorStats = error_counter.stats()
+        assert ErrorStats(permanent=after.permanent - before.permanent, transient=after.transient - before.transient,
+                          quota=after.quota - before.quota) == ans
+
+    def test_log_stats(self) -> None:
+        stats: ErrorStats = error_counter.stats()
+
+        with LogCapture(level=logging.DEBUG) as log:
+            error_counter.log_stats()
+            log.check(('app.errors', 'DEBUG', f'Error stats. permanent={stats.permanent}, '
+                                              f'transient={stats.transient}, quota={stats.quota}'))
+
+
+class TestQuotaGate:
+    now: float
+    gate: QuotaGate
+
+    def setUp(self) -> None:
+        self.now = TEST_RESET_TIME - 3600
+        self.gate = QuotaGate('test', clock=lambda: self.now)
+
+    def use_quota(self, error: Exception) -> None:
+        with self.gate.guard():
+            raise QuotaExceededError(error)
+
+    @nose2.tools.params(
+        # Until the daily reset at midnight Pacific Time
+        ({}, [3600.0, 0.0]),
+        ({'retry-after': '60'}, [60.0, 0.0]),
+    )
+    def test_guard(self, headers: dict, seconds_ans: List[float]) -> None:
+        with LogCapture(level=logging.WARNING) as log:
+            with nose2.tools.such.helper.assertRaises(QuotaExceededError):
+                self.use_quota(make_http_error(429, headers))
+            log.check(('app.errors', 'WARNING', f'Pause test until the quota is reset. '
+                                                f'seconds={seconds_ans[0]:.0f}, status=429'))
+
+        # The requests fail without being sent while the gate is closed
+        sent: List[bool] = []
+        with nose2.tools.such.helper.assertRaises(QuotaExceededError):
+            with self.gate.guard():
+                sent.append(True)
+        assert sent == []
+
+        seconds: List[float] = [self.gate.seconds_until_open]
+        self.now += seconds[0]
+        seconds.append(self.gate.seconds_until_open)
+        assert seconds == seconds_ans
+        self.gate.check()
+
+    def test_guard__other_error(self) -> None:
+        with nose2.tools.such.helper.assertRaises(PermanentError):
+            with self.gate.guard():
+                raise PermanentError(make_http_error(400))
+
+        assert self.gate.seconds_until_open == 0.0
@@ -1,5 +1,12 @@
+import datetime
 import googleapiclient.errors
 import logging
+import queue
+import threading
+import shutil
+import socket
+import tempfile
+import time
 
 import httplib2
 import nose2.tools
@@ -7,11 +14,14 @@ import os
 
 from google.oauth2.credentials import Credentials
 from httplib2 import Response
+from concurrent.futures import ThreadPoolExecutor
 from testfixtures import LogCapture
-from typing import Any, Tuple, Dict, Union
+from typing import Any, List, Tuple, Type, Dict, Optional, Union
 from unittest import mock
 
-from app.google_photos import GooglePhotos, GoogleApiResponseNG
+from app.errors import PermanentError, QuotaExceededError
+from app.google_photos import GooglePhotos, GoogleApiResponseNG, SharedCredentials, TokenFile
+from tests.lib.http_server import UploadServer
 from tests.lib.utils import load_json, delete_env
 
 JSON_DIR = f'{os.path.dirname(__file__)}/json'
@@ -21,6 +31,8 @@ TEST_DESCRIPTION = 'test_description'
 TEST_ALBUM_ID = 'testAlbumId'
 TEST_ALBUM_TITLE = 'test_album_title'
 TEST_NEXT_PAGE_TOKEN = 'test_next_page_token'
+TEST_EXIST_ALBUM_ID = 'testdM4vLK55Y6FmxvVcuNHx9D2pTn5yPjKTWLiwRYTnBXEuBfQguzjzohu01xfiSBiH7'
+MIB = 1024 * 1024
 
 mock_service = mock.MagicMock()
 mock_auth = mock.MagicMock()
@@ -64,6 +76,7 @@ class MockGoogleapiclient:
 
 class TestGooglePhotos:
     google_photos: GooglePhotos
+    token_dir: str
 
     @mock.patch('app.google_photos.AuthorizedHttp', mock_auth)
     @mock.patch('app.google_photos.build', mock_service)
@@ -71,16 +84,29 @@ class TestGooglePhotos:
         os.environ['GOOGLE_CLIENT_ID'] = 'DUMMY'
         os.environ['GOOGLE_CLIENT_SECRET'] = 'DUMMY'
         os.environ['GOOGLE_REFRESH_TOKEN'] = 'DUMMY'
+        self.token_dir = tempfile.mkdtemp()
+        os.environ['GOOGLE_TOKEN_FILE'] = f'{self.token_dir}/google_token.json'
 
         mock_service.reset_mock()
-        mock_auth.reset_mock()
+        mock_auth.reset_mock(side_effect=True)
         self.google_photos = GooglePhotos()
 
-    @staticmethod
-    def tearDown() -> None:
+    def tearDown(self) -> None:
+        self.google_photos.stop_token_refresher()
+        shutil.rmtree(self.token_dir)
         delete_env('GOOGLE_CLIENT_ID')
         delete_env('GOOGLE_CLIENT_SECRET')
         delete_env('GOOGLE_REFRESH_TOKEN')
+        delete_env('GOOGLE_UPLOAD_WORKERS')
+        delete_env('GOOGLE_TOKEN_FILE')
+        delete_env('GOOGLE_TOKEN_REFRESH_MARGIN')
+
+    def set_upload_https(self, *authorized_https: Any) -> None:
+        upload_https: queue.Queue = queue.Queue()
+        for authorized_http in authorized_https:
+            upload_https.put(authorized_http)
+        # noinspection PyProtectedMember
+        self.google_photos._upload_https = upload_https
 
     def test_make_credentials(self) -> None:
         credentials: Credentials = self.google_photos.make_credentials()
@@ -88,9 +114,129 @@ class TestGooglePhotos:
         assert credentials.client_id == 'DUMMY'
         assert credentials.client_secret == 'DUMMY'
         assert credentials.refresh_token == 'DUMMY'
-        assert credentials.token == 'dummy_access_token'
+        # Without a saved token, the first request refreshes the token instead of failing with 401
+        assert credentials.token is None
+        assert not credentials.valid
         assert credentials.token_uri == 'https://oauth2.googleapis.com/token'
 
+    @nose2.tools.params(
+        ('DUMMY', 'saved_token'),
+        ('other_client', None),
+    )
+    def test_make_credentials__saved_token(self, client_id: str, token_ans: Optional[str]) -> None:
+        expiry: datetime.datetime = datetime.datetime(2099, 1, 1, 12, 30)
+        TokenFile(os.environ['GOOGLE_TOKEN_FILE']).save(client_id, 'saved_token', expiry)
+
+        credentials: Credentials = self.google_photos.make_credentials()
+
+        assert credentials.token == token_ans
+        if token_ans is not None:
+            assert credentials.expiry == expiry
+            assert credentials.valid
+
+    def test_token_file(self) -> None:
+        token_file = TokenFile(os.environ['GOOGLE_TOKEN_FILE'])
+        expiry: datetime.datetime = datetime.datetime(2099, 1, 1, 12, 30)
+
+        token_file.save('DUMMY', 'saved_token', expiry)
+        os.chmod(token_file.path, 0o644)
+        token_file.save('DUMMY', 'saved_token2', expiry)
+
+        assert os.stat(token_file.path).st_mode & 0o777 == 0o600
+        assert token_file.load('DUMMY') == ('saved_token2', expiry)
+        assert os.listdir(self.token_dir) == ['google_token.json']
+
+    @nose2.tools.params(
+        ('{"client_id": "DUMMY", "tok', 'Unterminated string'),
+        ('{"client_id": "DUMMY", "token": "saved_token"}', "'expiry'"),
+        ('{"client_id": "DUMMY", "token": "saved_token", "expiry": "2099-01-01"}', 'does not match format'),
+        ('{"client_id": "DUMMY", "token": "saved_token", "expiry": null}', 'must be str'),
+        ('["DUMMY"]', 'not a JSON object'),
+    )
+    def test_token_file__broken(self, content: str, ans_exception: str) -> None:
+        token_file = TokenFile(os.environ['GOOGLE_TOKEN_FILE'])
+        with open(token_file.path, 'w') as f:
+            f.write(content)
+
+        # A new token is fetched instead of stopping the crawler at startup
+        with LogCapture(level=logging.WARNING) as log:
+            assert token_file.load('DUMMY') is None
+            assert len(log.records) == 1
+            assert log.records[0].getMessage().startswith(f'Load token failed. path={token_file.path}, exception=')
+            assert ans_exception in log.records[0].getMessage()
+        assert self.google_photos.make_credentials().token is None
+
+    def test_refresh_credentials(self) -> None:
+        credentials: Credentials = self.google_photos.make_credentials()
+        refreshed_tokens: List[str] = []
+
+        def refresh(_: Credentials, __: Any) -> None:
+            time.sleep(0.05)
+            refreshed_tokens.append(f'token{len(refreshed_tokens)}')
+            credentials.token = refreshed_tokens[-1]
+
+        # The workers get 401 with the same token at about the same time
+        with mock.patch('google.oauth2.credentials.Credentials.refresh', refresh):
+            workers: List[threading.Thread] = [threading.Thread(target=credentials.refresh, args=(None,))
+                                               for _ in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        assert isinstance(credentials, SharedCredentials)
+        assert refreshed_tokens == ['token0']
+        assert credentials.token == 'token0'
+
+    def test_refresh_credentials__save(self) -> None:
+        credentials: SharedCredentials = self.google_photos.make_credentials()
+        expiry: datetime.datetime = datetime.datetime(2099, 1, 1, 12, 30)
+
+        def refresh(_: Credentials, __: Any) -> None:
+            credentials.token = 'refreshed_token'
+            credentials.expiry = expiry
+
+        with mock.patch('google.oauth2.credentials.Credentials.refresh', refresh):
+            credentials.refresh(None)
+
+        # The next start uses the refreshed token
+        assert self.google_photos.make_credentials().token == 'refreshed_token'
+        assert TokenFile(os.environ['GOOGLE_TOKEN_FILE']).load('DUMMY') == ('refreshed_token', expiry)
+
+    def test_start_token_refresher(self) -> None:
+        # The token lasts for an hour, and is refreshed 0.1 seconds after it is refreshed
+        os.environ['GOOGLE_TOKEN_REFRESH_MARGIN'] = '3599.9'
+        with mock.patch('app.google_photos.build', mock_service), mock.patch('app.google_photos.AuthorizedHttp'):
+            google_photos = GooglePhotos()
+        refreshed_at: List[float] = []
+        refreshed = threading.Event()
+
+        def refresh(credentials: Credentials, _: Any) -> None:
+            refreshed_at.append(time.monotonic())
+            credentials.token = f'token{len(refreshed_at)}'
+            credentials.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+            if len(refreshed_at) == 3:
+                refreshed.set()
+
+        started_at: float = time.monotonic()
+        with mock.patch('google.oauth2.credentials.Credentials.refresh', refresh):
+            thread: threading.Thread = google_photos.start_token_refresher()
+            assert refreshed.wait(5)
+            google_photos.stop_token_refresher()
+            thread.join(5)
+
+        assert not thread.is_alive()
+        # Without a token, the first refresh runs at once, and the next ones before the token expires
+        assert refreshed_at[0] - started_at < 0.05
+        assert all(0.05 < after - before < 1 for before, after in zip(refreshed_at, refreshed_at[1:]))
+        assert google_photos.credentials.valid
+
+    def test_refresh_token__exception(self) -> None:
+        with mock.patch('google.oauth2.credentials.Credentials.refresh', side_effect=Exception('invalid_grant')):
+            with LogCapture(level=logging.ERROR) as log:
+                assert not self.google_photos.refresh_token()
+                log.check(('app.google_photos', 'ERROR', "Refresh token failed. exception=('invalid_grant',)"))
+
     @nose2.tools.params(
         'Success',
         'OK',
@@ -155,10 +301,15 @@ class TestGooglePhotos:
         assert 'body' in kwargs and kwargs['body'] == new_item_ans
 
     @mock.patch('time.sleep', mock_sleep)  # for retry
-    def test_create_media_item__retry(self) -> None:
-        res: dict = {'status': 500, 'reason': 'Server Error'}
+    @nose2.tools.params(
+        (500, 'Server Error', googleapiclient.errors.HttpError, 2, 3),
+        (400, 'Bad Request', PermanentError, 0, 1),
+    )
+    def test_create_media_item__retry(self, status: int, reason: str, error_type: Type[Exception], log_count: int,
+                                      retry_count: int) -> None:
+        res: dict = {'status': status, 'reason': reason}
         error_response = httplib2.Response(res)
-        error_response.reason = 'Server Error'
+        error_response.reason = reason
         config: dict = {'mediaItems.return_value.batchCreate.return_value.execute.side_effect':
                         googleapiclient.errors.HttpError(resp=error_response, content=b"{}")}
         mock_error_service = mock.MagicMock()
@@ -166,11 +317,70 @@ class TestGooglePhotos:
         self.google_photos.service = mock_error_service
 
         with LogCapture(level=logging.WARNING) as log:
-            with nose2.tools.such.helper.assertRaises(googleapiclient.errors.HttpError):
+            with nose2.tools.such.helper.assertRaises(error_type):
                 # noinspection PyProtectedMember
                 self.google_photos._create_media_item(TEST_UPLOAD_TOKEN, TEST_DESCRIPTION)
-            assert len(log.records) == 2
-            assert mock_error_service.mediaItems.return_value.batchCreate.return_value.execute.call_count == 3
+            assert len(log.records) == log_count
+            assert mock_error_service.mediaItems.return_value.batchCreate.return_value.execute.call_count == \
+                retry_count
+
+    @staticmethod
+    def batch_create(body: dict) -> mock.MagicMock:
+        # Answer in the reverse order of the request, and fail the tokens ending with 'ng'
+        results: list = [{'uploadToken': item['simpleMediaItem']['uploadToken'],
+                          'status': {'code': 3, 'message': 'Failed'}
+                          if item['simpleMediaItem']['uploadToken'].endswith('ng') else {'message': 'Success'}}
+                         for item in body['newMediaItems']]
+        request = mock.MagicMock()
+        request.execute.return_value = {'newMediaItemResults': results[::-1]}
+        return request
+
+    @nose2.tools.params(
+        (1, [1]),
+        (50, [50]),
+        (120, [50, 50, 20]),
+    )
+    def test_create_media_items(self, count: int, batch_sizes: list) -> None:
+        mock_service.mediaItems.return_value.batchCreate.side_effect = self.batch_create
+        self.google_photos.service = mock_service
+        self.google_photos._album_id = TEST_ALBUM_ID
+        self.google_photos._album_title = TEST_ALBUM_TITLE
+        items: list = [(f'token{i}' + ('ng' if i % 7 == 0 else ''), f'description{i}') for i in range(count)]
+
+        statuses: list = self.google_photos.create_media_items(items)
+
+        assert [GooglePhotos.is_created(status) for status in statuses] == [i % 7 != 0 for i in range(count)]
+        bodies: list = [kwargs['body']
+                        for (_, kwargs) in mock_service.mediaItems.return_value.batchCreate.call_args_list]
+        assert [len(body['newMediaItems']) for body in bodies] == batch_sizes
+        # Each batch goes first in the album, so the last item comes first as if created one by one
+        album_order: list = [item['description'] for body in reversed(bodies) for item in body['newMediaItems']]
+        assert album_order == [description for _, description in reversed(items)]
+        mock_service.mediaItems.return_value.batchCreate.side_effect = None
+
+    @mock.patch('time.sleep', mock_sleep)  # for retry
+    def test_create_media_items__http_error(self) -> None:
+        error_response = httplib2.Response({'status': 500, 'reason': 'Server Error'})
+        error_response.reason = 'Server Error'
+        responses: list = [googleapiclient.errors.HttpError(resp=error_response, content=b"{}")] * 3
+
+        def batch_create(body: dict) -> mock.MagicMock:
+            if responses:
+                raise responses.pop()
+            return self.batch_create(body)
+
+        mock_service.mediaItems.return_value.batchCreate.side_effect = batch_create
+        self.google_photos.service = mock_service
+        items: list = [(f'token{i}', f'description{i}') for i in range(60)]
+
+        with LogCapture(level=logging.ERROR) as log:
+            statuses: list = self.google_photos.create_media_items(items)
+            log.check(('app.google_photos', 'ERROR', 'Batch create failed. count=50, status=500'))
+
+        # Only the items of the failed batch fail
+        assert [GooglePhotos.is_created(status) for status in statuses] == [False] * 50 + [True] * 10
+        assert statuses[0]['code'] == 500
+        mock_service.mediaItems.return_value.batchCreate.side_effect = None
 
     @nose2.tools.params(
         'request_200',
@@ -179,7 +389,7 @@ class TestGooglePhotos:
         MockGoogleapiclient.UploadApi.json_name = json_name
         MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
         mock_auth.request.return_value = MockGoogleapiclient.UploadApi.request()
-        self.google_photos.authorized_http = mock_auth
+        self.set_upload_https(mock_auth)
         file_path = f'{STATIC_CONTENT_DIR}/images/test.png'
 
         # noinspection PyProtectedMember
@@ -187,19 +397,69 @@ class TestGooglePhotos:
         assert isinstance(upload_token, str)
         assert len(upload_token) != 0
 
+    @nose2.tools.params(
+        ('1', 8, 1),
+        ('4', 8, 4),
+        ('4', 2, 2),
+    )
+    @mock.patch('app.google_photos.AuthorizedHttp')
+    def test_execute_upload_api__parallel(self, upload_workers: str, upload_count: int, max_parallel_ans: int,
+                                          authorized_http_class: mock.MagicMock) -> None:
+        os.environ['GOOGLE_UPLOAD_WORKERS'] = upload_workers
+        MockGoogleapiclient.UploadApi.json_name = 'request_200'
+        MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
+        lock = threading.Lock()
+        parallels: List[int] = [0]
+        max_parallels: List[int] = [0]
+        used_https: set = set()
+
+        def make_authorized_http(credentials: Credentials) -> mock.MagicMock:
+            authorized_http = mock.MagicMock()
+
+            def request(**_: Any) -> Tuple[Any, bytes]:
+                with lock:
+                    # A connection is used by one worker at a time
+                    assert id(authorized_http) not in used_https
+                    used_https.add(id(authorized_http))
+                    parallels[0] += 1
+                    max_parallels[0] = max(max_parallels[0], parallels[0])
+                time.sleep(0.05)
+                with lock:
+                    used_https.remove(id(authorized_http))
+                    parallels[0] -= 1
+                return MockGoogleapiclient.UploadApi.request()
+
+            authorized_http.request.side_effect = request
+            return authorized_http
+
+        authorized_http_class.side_effect = make_authorized_http
+        with mock.patch('app.google_photos.build', mock_service):
+            google_photos = GooglePhotos()
+        file_path = f'{STATIC_CONTENT_DIR}/images/test.png'
+
+        with ThreadPoolExecutor(max_workers=upload_count) as executor:
+            upload_tokens: List[str] = list(executor.map(google_photos.upload_file, [file_path] * upload_count))
+
+        assert upload_tokens == ['test123456'] * upload_count
+        assert authorized_http_class.call_count == int(upload_workers)
+        assert max_parallels[0] == max_parallel_ans
+
     @mock.patch('time.sleep', mock_sleep)  # for retry
     @nose2.tools.params(
-        ('request_400', 2, 3),
+        ('request_500', GoogleApiResponseNG, 2, 3),
+        # A rejected media fails the same way however many times it is sent
+        ('request_400', PermanentError, 0, 1),
     )
-    def test_execute_upload_api__retry(self, json_name: str, log_count: int, retry_count: int) -> None:
+    def test_execute_upload_api__retry(self, json_name: str, error_type: Type[Exception], log_count: int,
+                                       retry_count: int) -> None:
         MockGoogleapiclient.UploadApi.json_name = json_name
         MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
         mock_auth.request.return_value = MockGoogleapiclient.UploadApi.request()
-        self.google_photos.authorized_http = mock_auth
+        self.set_upload_https(mock_auth)
         file_path = f'{STATIC_CONTENT_DIR}/images/test.png'
 
         with LogCapture(level=logging.WARNING) as log:
-            with nose2.tools.such.helper.assertRaises(GoogleApiResponseNG):
+            with nose2.tools.such.helper.assertRaises(error_type):
                 # noinspection PyProtectedMember
                 self.google_photos._execute_upload_api(file_path)
 
@@ -209,6 +469,30 @@ class TestGooglePhotos:
             assert len(log.records) == log_count
             assert mock_auth.request.call_count == retry_count
 
+    def test_upload_file__quota(self) -> None:
+        MockGoogleapiclient.UploadApi.json_name = 'request_429'
+        MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
+        mock_auth.request.return_value = MockGoogleapiclient.UploadApi.request()
+        self.set_upload_https(mock_auth)
+        self.google_photos.service = mock_service
+        file_path = f'{STATIC_CONTENT_DIR}/images/test.png'
+
+        with LogCapture(level=logging.WARNING) as log:
+            with nose2.tools.such.helper.assertRaises(QuotaExceededError):
+                self.google_photos.upload_file(file_path)
+            assert log.records[-1].getMessage().startswith('Pause Google Photos uploads until the quota is reset.')
+
+        # The uploads and the media items fail without a request until the quota is reset
+        with nose2.tools.such.helper.assertRaises(QuotaExceededError):
+            self.google_photos.upload_file(file_path)
+        with nose2.tools.such.helper.assertRaises(QuotaExceededError):
+            self.google_photos.check_upload_quota()
+        with LogCapture(level=logging.ERROR):
+            statuses: list = self.google_photos.create_media_items([(TEST_UPLOAD_TOKEN, TEST_DESCRIPTION)])
+        assert statuses == [{'code': 429, 'message': statuses[0]['message']}]
+        assert mock_auth.request.call_count == 1
+        mock_service.mediaItems.return_value.batchCreate.assert_not_called()
+
     @nose2.tools.params(
         'albums',
     )
@@ -316,6 +600,72 @@ class TestGooglePhotos:
         else:
             assert len(album_id) != 0
 
+    def set_albums_list(self) -> None:
+        MockGoogleapiclient.ExecuteFetchAlbumsApi.next_page = 1
+        MockGoogleapiclient.ExecuteFetchAlbumsApi.json_name = 'albums'
+        MockGoogleapiclient.ExecuteFetchAlbumsApi.func_name = 'albums_list_execute'
+        mock_service.albums.return_value.list.return_value.execute.side_effect = \
+            MockGoogleapiclient.ExecuteFetchAlbumsApi.execute
+        self.google_photos.service = mock_service
+        self.google_photos._album_title = 'exist_title'
+
+    @nose2.tools.params(
+        ('storedAlbumId', 'storedAlbumId', 0, []),
+        (None, TEST_EXIST_ALBUM_ID, 1, [('exist_title', TEST_EXIST_ALBUM_ID)]),
+    )
+    def test_init_album__cache(self, stored_album_id: Optional[str], album_id_ans: str, list_count: int,
+                               stored_ans: list) -> None:
+        self.set_albums_list()
+        load_album_id = mock.MagicMock(return_value=stored_album_id)
+        store_album_id = mock.MagicMock()
+        self.google_photos.load_album_id = load_album_id
+        self.google_photos.store_album_id = store_album_id
+
+        self.google_photos.init_album()
+        # The album id in the memory is used from then on
+        self.google_photos.init_album()
+
+        # noinspection PyProtectedMember
+        assert self.google_photos._album_id == album_id_ans
+        load_album_id.assert_called_once_with('exist_title')
+        assert mock_service.albums.return_value.list.call_count == list_count
+        assert [call[0] for call in store_album_id.call_args_list] == stored_ans
+
+    @nose2.tools.params(
+        (1, True),
+        (2, False),
+    )
+    def test_create_media_items__invalid_album(self, invalid_count: int, is_created_ans: bool) -> None:
+        self.set_albums_list()
+        self.google_photos._album_id = 'deletedAlbumId'
+        store_album_id = mock.MagicMock()
+        self.google_photos.store_album_id = store_album_id
+        error_response = httplib2.Response({'status': 400, 'reason': 'Bad Request'})
+        error_response.reason = 'Bad Request'
+        content: bytes = b'{"error": {"code": 400, "message": "Invalid album id.", "status": "INVALID_ARGUMENT"}}'
+        album_ids: list = []
+
+        def batch_create(body: dict) -> mock.MagicMock:
+            album_ids.append(body['albumId'])
+            if len(album_ids) <= invalid_count:
+                raise googleapiclient.errors.HttpError(resp=error_response, content=content)
+            return self.batch_create(body)
+
+        mock_service.mediaItems.return_value.batchCreate.side_effect = batch_create
+        items: list = [(f'token{i}', f'description{i}') for i in range(3)]
+
+        with LogCapture(level=logging.WARNING) as log:
+            statuses: list = self.google_photos.create_media_items(items)
+            log.check_present(('app.google_photos', 'WARNING',
+                               'Invalid album. album_title=exist_title, album_id=deletedAlbumId, status=400'))
+
+        # The album is revalidated once, and the invalid album is not retried
+        assert album_ids == ['deletedAlbumId', TEST_EXIST_ALBUM_ID]
+        store_album_id.assert_called_once_with('exist_title', TEST_EXIST_ALBUM_ID)
+        assert [GooglePhotos.is_created(status) for status in statuses] == [is_created_ans] * 3
+        mock_service.mediaItems.return_value.batchCreate.side_effect = None
+        mock_service.albums.return_value.list.return_value.execute.side_effect = None
+
     @nose2.tools.params(
         (f'{STATIC_CONTENT_DIR}/images/test.png', TEST_DESCRIPTION),
     )
@@ -332,7 +682,7 @@ class TestGooglePhotos:
         MockGoogleapiclient.UploadApi.json_name = 'request_200'
         MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
         mock_auth.request.return_value = MockGoogleapiclient.UploadApi.request()
-        self.google_photos.authorized_http = mock_auth
+        self.set_upload_https(mock_auth)
 
         msg = f'Upload media to Google Photos. path={file_path}'
         with LogCapture(level=logging.INFO) as log:
@@ -340,3 +690,165 @@ class TestGooglePhotos:
             log.check(('app.google_photos', 'INFO', msg))
         assert isinstance(response_status, dict)
         assert 'message' in response_status and response_status['message'] == 'Success'
+
+    @nose2.tools.params(
+        ('test.mp4', [b'chunk1', b'chunk2'], 12),
+        ('test.jpg', [b'chunk'], None),
+    )
+    def test_upload_stream(self, file_name: str, chunks: list, size: Optional[int]) -> None:
+        MockGoogleapiclient.UploadApi.json_name = 'request_200'
+        MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
+        mock_auth.request.return_value = MockGoogleapiclient.UploadApi.request()
+        self.set_upload_https(mock_auth)
+        self.google_photos.service = mock_service
+
+        msg = f'Upload media stream to Google Photos. file_name={file_name}'
+        with LogCapture(level=logging.INFO) as log:
+            upload_token: str = self.google_photos.upload_stream(file_name, iter(chunks), size)
+            log.check(('app.google_photos', 'INFO', msg))
+        assert upload_token == 'test123456'
+        mock_service.mediaItems.return_value.batchCreate.assert_not_called()
+
+        (_, kwargs) = mock_auth.request.call_args
+        assert list(kwargs['body']) == chunks
+        assert kwargs['headers']['X-Goog-Upload-File-Name'] == file_name
+        if size is None:
+            assert 'Content-Length' not in kwargs['headers']
+        else:
+            assert kwargs['headers']['Content-Length'] == str(size)
+
+    def test_upload_stream__response_ng(self) -> None:
+        MockGoogleapiclient.UploadApi.json_name = 'request_500'
+        MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
+        mock_auth.request.return_value = MockGoogleapiclient.UploadApi.request()
+        self.set_upload_https(mock_auth)
+
+        with nose2.tools.such.helper.assertRaises(GoogleApiResponseNG):
+            self.google_photos.upload_stream('test.jpg', iter([b'chunk']))
+        # A stream cannot be replayed, so it is not retried here
+        assert mock_auth.request.call_count == 1
+
+    def test_upload_stream__resend(self) -> None:
+        # httplib2 or AuthorizedHttp sends the body again, after the stream is consumed
+        def request(**kwargs: Any) -> Tuple[httplib2.Response, bytes]:
+            list(kwargs['body'])
+            list(kwargs['body'])
+            return MockGoogleapiclient.UploadApi.request()
+        MockGoogleapiclient.UploadApi.json_name = 'request_200'
+        MockGoogleapiclient.UploadApi.func_name = 'upload_api_execute'
+        mock_auth.request.side_effect = request
+        self.set_upload_https(mock_auth)
+
+        # The caller reopens the stream instead of sending an empty body
+        with nose2.tools.such.helper.assertRaises(ConnectionError):
+            self.google_photos.upload_stream('test.jpg', iter([b'chunk']), 5)
+
+
+class TestGooglePhotosUploadServer:
+    google_photos: GooglePhotos
+    server: UploadServer
+    media_dir: str
+
+    @mock.patch('app.google_photos.build', mock_service)
+    def setUp(self) -> None:
+        os.environ['GOOGLE_CLIENT_ID'] = 'DUMMY'
+        os.environ['GOOGLE_CLIENT_SECRET'] = 'DUMMY'
+        os.environ['GOOGLE_REFRESH_TOKEN'] = 'DUMMY'
+        os.environ['GOOGLE_RESUMABLE_UPLOAD_THRESHOLD_MB'] = '1'
+        os.environ['GOOGLE_UPLOAD_CHUNK_SIZE_MB'] = '1'
+        self.server = UploadServer().start()
+        os.environ['GOOGLE_UPLOAD_API_URL'] = self.server.url()
+        self.media_dir = tempfile.mkdtemp()
+        os.environ['GOOGLE_TOKEN_FILE'] = f'{self.media_dir}/google_token.json'
+        TokenFile(os.environ['GOOGLE_TOKEN_FILE']).save(
+            'DUMMY', 'saved_token', datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        mock_sleep.reset_mock()
+        self.google_photos = GooglePhotos()
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        shutil.rmtree(self.media_dir)
+        delete_env('GOOGLE_CLIENT_ID')
+        delete_env('GOOGLE_CLIENT_SECRET')
+        delete_env('GOOGLE_REFRESH_TOKEN')
+        delete_env('GOOGLE_RESUMABLE_UPLOAD_THRESHOLD_MB')
+        delete_env('GOOGLE_UPLOAD_CHUNK_SIZE_MB')
+        delete_env('GOOGLE_UPLOAD_API_URL')
+        delete_env('GOOGLE_TOKEN_FILE')
+
+    def make_media(self, size: int) -> str:
+        path: str = f'{self.media_dir}/test.mp4'
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    @staticmethod
+    def read_media(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_upload_file__raw(self) -> None:
+        file_path = f'{STATIC_CONTENT_DIR}/images/test.png'
+
+        upload_token: str = self.google_photos.upload_file(file_path)
+
+        assert [request['protocol'] for request in self.server.requests] == ['raw']
+        # The saved token is used without a refresh
+        assert self.server.requests[0]['authorization'] == 'Bearer saved_token'
+        assert self.server.uploads[upload_token] == self.read_media(file_path)
+
+    @mock.patch('time.sleep', mock_sleep)
+    @nose2.tools.params(
+        ([], ['0', '1048576', '2097152'], 0),
+        ([0], ['0', '524288', '1572864'], 1),
+        ([1], ['0', '1048576', '1572864'], 1),
+        ([1, 2], ['0', '1048576', '1572864', '2097152'], 2),
+    )
+    def test_upload_file__resumable(self, fail_chunks: List[int], offsets_ans: List[str], query_count: int) -> None:
+        file_path: str = self.make_media(MIB * 5 // 2)
+        self.server.fail_chunks = fail_chunks
+
+        with LogCapture(level=logging.WARNING) as log:
+            upload_token: str = self.google_photos.upload_file(file_path)
+            assert len(log.records) == query_count
+
+        assert self.server.uploads[upload_token] == self.read_media(file_path)
+        commands: List[Optional[str]] = [request['command'] for request in self.server.requests]
+        assert commands[0] == 'start' and commands[-1] == 'upload, finalize'
+        assert commands.count('query') == query_count
+        assert [request['offset'] for request in self.server.requests
+                if request['command'] in ('upload', 'upload, finalize')] == offsets_ans
+
+    @mock.patch('time.sleep', mock_sleep)
+    def test_upload_file__resumable_timeout(self) -> None:
+        file_path: str = self.make_media(MIB * 5 // 2)
+        # noinspection PyProtectedMember
+        upload_chunk = self.google_photos._upload_chunk
+        timeouts: List[Exception] = [socket.timeout('timed out')]
+
+        def timeout_once(*args: Any) -> str:
+            if timeouts:
+                raise timeouts.pop()
+            return upload_chunk(*args)
+
+        with mock.patch.object(self.google_photos, '_upload_chunk', side_effect=timeout_once):
+            with LogCapture(level=logging.WARNING) as log:
+                upload_token: str = self.google_photos.upload_file(file_path)
+                assert len(log.records) == 1
+
+        assert self.server.uploads[upload_token] == self.read_media(file_path)
+
+    @mock.patch('time.sleep', mock_sleep)
+    def test_upload_file__resumable_give_up(self) -> None:
+        file_path: str = self.make_media(MIB * 5 // 2)
+        self.server.fail_chunks = list(range(100))
+
+        with LogCapture(level=logging.WARNING) as log:
+            with nose2.tools.such.helper.assertRaises(GoogleApiResponseNG):
+                self.google_photos.upload_file(file_path)
+            assert len(log.records) == 4
+
+        assert mock_sleep.call_count == 4
+        # The chunks go on from the committed bytes until the session fails too many times in a row
+        assert len(self.server.uploads) == 0
+        assert len(self.server.sessions['session0'].data) > 0
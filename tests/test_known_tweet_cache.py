@@ -0,0 +1,82 @@
+import logging
+import random
+
+import nose2.tools
+from typing import List, Set
+from unittest import mock
+from testfixtures import LogCapture
+
+from app.known_tweet_cache import KnownTweetCache, KnownTweetCacheStats
+
+
+class TestKnownTweetCache:
+    def test_classify(self) -> None:
+        cache = KnownTweetCache(max_size=10)
+        cache.add('5')
+
+        # Before it is warmed, only the added ids are known
+        assert cache.classify(['5', '6']) == ([], ['6'])
+        with LogCapture(level=logging.INFO) as log:
+            cache.warm(['1', '3'])
+            log.check(('app.known_tweet_cache', 'INFO', 'Warm known tweet cache. size=3, watermark=0'))
+        assert cache.classify(['1', '2', '3', '4', '5', '6']) == (['2', '4', '6'], [])
+        assert cache.stats() == KnownTweetCacheStats(size=3, watermark=0, hits=7, misses=1)
+
+    @nose2.tools.params(
+        'abc',
+        '01',
+        '9223372036854775808',
+        '１',
+    )
+    def test_classify__not_int64(self, tweet_id: str) -> None:
+        cache = KnownTweetCache(max_size=10)
+        with LogCapture(level=logging.INFO):
+            cache.warm(['1'])
+        cache.add(tweet_id)
+
+        assert cache.classify([tweet_id]) == ([], [tweet_id])
+
+    def test_warm__evict(self) -> None:
+        cache = KnownTweetCache(max_size=3)
+
+        with LogCapture(level=logging.INFO):
+            cache.warm(['50', '10', '40', '20', '30'])
+
+        assert cache.stats().watermark == 30
+        assert cache.classify(['10', '25', '30', '35', '50', '60']) == (['35', '60'], ['10', '25'])
+
+    @mock.patch('app.known_tweet_cache.MERGE_SIZE', 2)
+    def test_add__evict(self) -> None:
+        cache = KnownTweetCache(max_size=3)
+        with LogCapture(level=logging.INFO):
+            cache.warm(['10', '20'])
+
+        cache.add('30')
+        cache.add('40')
+
+        # The oldest id is dropped when the added ids are merged
+        assert cache.stats() == KnownTweetCacheStats(size=3, watermark=20, hits=0, misses=0)
+        assert cache.classify(['10', '20', '25', '40']) == (['25'], ['10'])
+
+    @nose2.tools.params(
+        (100, 1000),
+        (1000, 1000),
+        (5000, 1000),
+    )
+    def test_classify__same_as_set(self, max_size: int, stored_count: int) -> None:
+        rand = random.Random(max_size)
+        stored_ids: Set[str] = {str(rand.randrange(1, 10000)) for _ in range(stored_count)}
+        cache = KnownTweetCache(max_size=max_size)
+        with LogCapture(level=logging.INFO):
+            cache.warm(sorted(stored_ids)[:stored_count // 2])
+        for tweet_id in sorted(stored_ids)[stored_count // 2:]:
+            cache.add(tweet_id)
+
+        tweet_ids: List[str] = [str(rand.randrange(1, 10000)) for _ in range(2000)]
+        not_added_ids, unknown_ids = cache.classify(tweet_ids)
+
+        # The cache never answers wrong, and asks the database only when it cannot answer
+        assert not set(not_added_ids) & stored_ids
+        assert not set(tweet_ids) - set(not_added_ids) - set(unknown_ids) - stored_ids
+        if max_size >= len(stored_ids):
+            assert unknown_ids == []
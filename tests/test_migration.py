@@ -0,0 +1,175 @@
+import logging
+import os
+import shutil
+import tempfile
+
+import nose2.tools
+from typing import Any, Iterator, List, Sequence, Tuple
+from unittest import mock
+from testfixtures import LogCapture
+
+from app.migration import Migrator, tweet_id_at
+from app.store_backend import PostgresBackend, SQLiteBackend
+from tests.lib.utils import delete_env
+
+TEST_TWEET_ID = 1179751757171154944
+
+
+class TestMigrator:
+    db_dir: str
+    backend: SQLiteBackend
+
+    def setUp(self) -> None:
+        self.db_dir = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(f'{self.db_dir}/test.db')
+
+    def tearDown(self) -> None:
+        self.backend.close()
+        shutil.rmtree(self.db_dir)
+        delete_env('DATABASE_PARTITION_TWEETS')
+
+    def migrate(self) -> List[int]:
+        with LogCapture(level=logging.INFO):
+            return Migrator(self.backend).migrate()
+
+    def test_migrate__sqlite(self) -> None:
+        with LogCapture(level=logging.INFO):
+            self.backend.execute('insert', 'INSERT INTO uploaded_media_tweet (tweet_id, user_id, add_date, tweet_date) '
+                                           'VALUES (%s, %s, %s, %s)',
+                                 (str(TEST_TWEET_ID), 'test_user', '2020-01-01 09:00:00', '2019-10-03 00:00:00'))
+
+        assert self.migrate() == [1, 2, 4, 5]
+
+        # The rows are kept with the id in integer
+        assert self.backend.execute('fetch', 'SELECT typeof(tweet_id), tweet_id, user_id, add_date, tweet_date '
+                                             'FROM uploaded_media_tweet') == [
+            ('integer', TEST_TWEET_ID, 'test_user', '2020-01-01 09:00:00', '2019-10-03 00:00:00')]
+        assert self.backend.execute('fetch', "SELECT name FROM sqlite_master WHERE type = 'index' "
+                                             "AND tbl_name = 'uploaded_media_tweet' AND sql IS NOT NULL") == [
+            ('uploaded_media_tweet_user_id_tweet_date_idx',)]
+        assert self.backend.execute('fetch', 'SELECT version, name FROM schema_migrations ORDER BY version') == [
+            (1, 'typed_uploaded_media_tweet'), (2, 'uploaded_media_tweet_user_id_tweet_date_idx'),
+            (4, 'failed_upload_media_retry'), (5, 'crawler_state_tables')]
+
+    def test_migrate__applied(self) -> None:
+        self.migrate()
+
+        assert self.migrate() == []
+
+    def test_migrate__partition_sqlite(self) -> None:
+        os.environ['DATABASE_PARTITION_TWEETS'] = 'true'
+
+        # SQLite has no partitions, so the migration is skipped without being recorded
+        assert self.migrate() == [1, 2, 4, 5]
+        assert self.backend.execute('fetch', 'SELECT version FROM schema_migrations WHERE version = 3') == []
+
+    def test_migrate__failed_upload_media(self) -> None:
+        with LogCapture(level=logging.INFO):
+            self.backend.execute('insert', 'INSERT INTO failed_upload_media (url, description, user_id) '
+                                           'VALUES (%s, %s, %s)', ('test_url', 'test_description', 'test_user'))
+
+        self.migrate()
+
+        # The rows failed before the migration are due at once
+        assert self.backend.execute('fetch', 'SELECT url, attempts, last_error, next_attempt_at '
+                                             'FROM failed_upload_media') == [('test_url', 0, None, '')]
+        assert self.backend.execute('fetch', 'SELECT count(*) FROM failed_upload_media_dead') == [(0,)]
+
+    def test_migrate__state_tables(self) -> None:
+        # database.sql has only the tables of the first schema, and the migrations make the others
+        self.migrate()
+
+        assert self.backend.execute('fetch', "SELECT name FROM sqlite_master WHERE type = 'table' "
+                                             "AND name IN ('uploaded_media_hash', 'uploaded_media_phash', "
+                                             "'twitter_user', 'google_album') ORDER BY name") == [
+            ('google_album',), ('twitter_user',), ('uploaded_media_hash',), ('uploaded_media_phash',)]
+        self.backend.execute('insert', 'INSERT INTO twitter_user (user_id, update_date) VALUES (%s, %s)',
+                             ('test_user', '2020-01-01 09:00:00'))
+        assert self.backend.execute('fetch', 'SELECT since_id, fav_snapshot FROM twitter_user') == [(1, None)]
+
+
+class TestMigratorPostgres:
+    backend: mock.MagicMock
+    backfill_counts: Iterator[Tuple[int]]
+    copy_batches: Iterator[Tuple[Any, int]]
+
+    def setUp(self) -> None:
+        self.backend = mock.MagicMock(PostgresBackend)
+        self.backend.name = 'postgres'
+        self.backend.execute.side_effect = self.execute
+        self.backend.execute_autocommit.side_effect = self.execute
+        self.backfill_counts = iter([(3,), (0,)])
+        self.copy_batches = iter([(TEST_TWEET_ID, 1), (None, 0)])
+
+    @staticmethod
+    def tearDown() -> None:
+        delete_env('DATABASE_PARTITION_TWEETS')
+
+    def execute(self, _: str, query: str, __: Sequence[Any] = ()) -> List[tuple]:
+        if query.startswith('WITH batch'):
+            return [next(self.backfill_counts)]
+        if query.startswith('SELECT max(tweet_id)'):
+            return [next(self.copy_batches)]
+        if 'to_regclass' in query:
+            return [(None,)]
+        return []
+
+    def get_queries(self) -> List[str]:
+        queries: List[str] = []
+        for call in self.backend.mock_calls:
+            if call[0] in ('execute', 'execute_autocommit'):
+                queries.append(call[1][1])
+            elif call[0] == 'execute_transaction':
+                queries.append(' / '.join(query for query, _ in call[1][1]))
+        return queries
+
+    @nose2.tools.params(
+        ('false', [1, 2, 4, 5]),
+        ('true', [1, 2, 3, 4, 5]),
+    )
+    def test_migrate(self, partition: str, ans: List[int]) -> None:
+        os.environ['DATABASE_PARTITION_TWEETS'] = partition
+
+        with LogCapture(level=logging.INFO) as log:
+            assert Migrator(self.backend).migrate() == ans
+            assert 'Backfill uploaded_media_tweet. rows=3' in [record.getMessage() for record in log.records]
+
+        queries: List[str] = self.get_queries()
+        # The indexes are built without a transaction, which CREATE INDEX CONCURRENTLY cannot be in
+        assert 'CREATE UNIQUE INDEX CONCURRENTLY uploaded_media_tweet_tweet_id_new_idx ' \
+               'ON uploaded_media_tweet (tweet_id_new)' in queries
+        assert 'CREATE INDEX CONCURRENTLY uploaded_media_tweet_user_id_tweet_date_idx ' \
+               'ON uploaded_media_tweet (user_id, tweet_date)' in queries
+        # The columns are swapped in the transaction which records the version
+        swap: str = next(query for query in queries if query.startswith('DROP TRIGGER uploaded_media_tweet_typed'))
+        assert swap.endswith('INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, %s)')
+        if partition == 'true':
+            self.backend.execute.assert_any_call('migrate', 'INSERT INTO uploaded_media_tweet_partitioned '
+                                                            'SELECT * FROM uploaded_media_tweet '
+                                                            'WHERE tweet_id > %s AND tweet_id <= %s '
+                                                            'ON CONFLICT (tweet_id) DO NOTHING', (-1, TEST_TWEET_ID))
+            assert any(query.startswith('LOCK TABLE uploaded_media_tweet IN ACCESS EXCLUSIVE MODE')
+                       for query in queries)
+        # The columns are added without a rewrite, and the dead-letter table is made with the record of the version
+        assert 'CREATE INDEX CONCURRENTLY failed_upload_media_next_attempt_at_idx ' \
+               'ON failed_upload_media (next_attempt_at)' in queries
+        assert any(query.startswith('CREATE TABLE IF NOT EXISTS failed_upload_media_dead') for query in queries)
+        # The tables of an older database.sql are made, and twitter_user gets the columns added to it since
+        assert queries[-1].startswith('CREATE TABLE IF NOT EXISTS uploaded_media_hash')
+        assert 'ALTER TABLE twitter_user ADD COLUMN IF NOT EXISTS fav_snapshot bytea' in queries[-1]
+        # psycopg2 opens a transaction for the other operations, even in autocommit mode
+        concurrently: List[str] = [query for query in queries if 'CONCURRENTLY' in query]
+        assert [call[1][1] for call in self.backend.execute_autocommit.mock_calls
+                if 'CONCURRENTLY' in call[1][1]] == concurrently
+
+    def test_migrate__applied(self) -> None:
+        self.backend.execute.side_effect = \
+            lambda _, query, __=(): [(1,), (2,), (4,), (5,)] if 'SELECT version' in query else []
+
+        with LogCapture(level=logging.INFO) as log:
+            assert Migrator(self.backend).migrate() == []
+            log.check()
+
+    def test_tweet_id_at(self) -> None:
+        # The tweet was posted in October 2019
+        assert tweet_id_at(2019) < TEST_TWEET_ID < tweet_id_at(2020)
@@ -0,0 +1,112 @@
+import os
+import random
+import shutil
+import tempfile
+
+import nose2.tools
+import numpy
+from PIL import Image
+from typing import List, Optional, Tuple
+
+from app.perceptual_hash import PerceptualHash, PerceptualHashIndex
+
+TEST_MEDIA = ('https://pbs.twimg.com/media/test.jpg', 'test_user')
+
+
+class TestPerceptualHash:
+    image_dir: str
+
+    def setUp(self) -> None:
+        self.image_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.image_dir)
+
+    def make_image(self, name: str, pixels: numpy.ndarray, size: Tuple[int, int], quality: int = 95) -> str:
+        path: str = f'{self.image_dir}/{name}'
+        Image.fromarray(pixels.astype(numpy.uint8)).resize(size).save(path, quality=quality)
+        return path
+
+    @staticmethod
+    def make_pixels(seed: int) -> numpy.ndarray:
+        return numpy.random.RandomState(seed).randint(0, 256, size=(32, 32, 3))
+
+    def test_dhash(self) -> None:
+        original: str = self.make_image('orig.png', self.make_pixels(1), (1024, 768))
+        resized: str = self.make_image('large.jpg', self.make_pixels(1), (400, 300), quality=60)
+        other: str = self.make_image('other.jpg', self.make_pixels(2), (1024, 768))
+
+        original_hash: Optional[int] = PerceptualHash.dhash(original)
+        resized_hash: Optional[int] = PerceptualHash.dhash(resized)
+        other_hash: Optional[int] = PerceptualHash.dhash(other)
+
+        assert original_hash is not None and resized_hash is not None and other_hash is not None
+        assert 0 <= original_hash < 1 << 64
+        assert PerceptualHash.distance(original_hash, resized_hash) <= 6
+        assert PerceptualHash.distance(original_hash, other_hash) > 12
+
+    def test_dhash__not_image(self) -> None:
+        path: str = f'{self.image_dir}/test.mp4'
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1024))
+
+        assert PerceptualHash.dhash(path) is None
+
+    @nose2.tools.params(
+        (0, 0),
+        ((1 << 63) - 1, (1 << 63) - 1),
+        (1 << 63, -(1 << 63)),
+        ((1 << 64) - 1, -1),
+    )
+    def test_to_signed(self, phash: int, ans: int) -> None:
+        assert PerceptualHash.to_signed(phash) == ans
+        assert PerceptualHash.to_unsigned(ans) == phash
+
+
+class TestPerceptualHashIndex:
+    @staticmethod
+    def flip_bits(phash: int, count: int, rand: random.Random) -> int:
+        for bit in rand.sample(range(64), count):
+            phash ^= 1 << bit
+        return phash
+
+    def test_find(self) -> None:
+        index = PerceptualHashIndex(threshold=6)
+        index.add(0x0123456789abcdef, TEST_MEDIA)
+        index.add(0x0123456789abcdef, ('https://pbs.twimg.com/media/other.jpg', 'other_user'))
+
+        assert len(index) == 1
+        assert index.find(0x0123456789abcdef) == (TEST_MEDIA, 0)
+        assert index.find(0x0123456789abcdef ^ 0b111111) == (TEST_MEDIA, 6)
+        assert index.find(0x0123456789abcdef ^ 0b1111111) is None
+
+    def test_find__nearest(self) -> None:
+        index = PerceptualHashIndex(threshold=8)
+        index.add(0b1111, ('far', 'test_user'))
+        index.add(0b1, ('near', 'test_user'))
+
+        assert index.find(0) == (('near', 'test_user'), 1)
+
+    @nose2.tools.params(
+        (3, 3),
+        (6, 3),
+        (10, 3),
+        (6, 4),
+        (6, 2),
+    )
+    def test_find__same_as_linear_search(self, threshold: int, chunks: int) -> None:
+        rand = random.Random(threshold)
+        index = PerceptualHashIndex(threshold=threshold, chunks=chunks)
+        hashes: List[int] = [rand.getrandbits(64) for _ in range(2000)]
+        for i, phash in enumerate(hashes):
+            index.add(phash, (str(i), 'test_user'))
+
+        queries: List[int] = [self.flip_bits(rand.choice(hashes), rand.randint(0, threshold + 2), rand)
+                              for _ in range(200)]
+        for query in queries:
+            distances: List[int] = [PerceptualHash.distance(query, phash) for phash in hashes]
+            nearest: Optional[Tuple[Tuple[str, str], int]] = index.find(query)
+            if min(distances) > threshold:
+                assert nearest is None
+            else:
+                assert nearest is not None and nearest[1] == min(distances)
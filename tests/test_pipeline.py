@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+import nose2.tools
+from testfixtures import LogCapture
+from typing import Callable, Iterator, List
+
+from app.pipeline import Pipeline
+from tests.lib.logcapture_helper import LogCaptureHelper
+
+
+def collector(results: List[int]) -> Callable[[int], List[None]]:
+    def collect(item: int) -> List[None]:
+        results.append(item)
+        return []
+    return collect
+
+
+class TestPipeline:
+    @nose2.tools.params(
+        (1, 1),
+        (4, 2),
+    )
+    def test_run(self, workers: int, queue_size: int) -> None:
+        results: List[int] = []
+        lock = threading.Lock()
+
+        def split(item: int) -> Iterator[int]:
+            yield item * 10
+            yield item * 10 + 1
+
+        def collect(item: int) -> List[None]:
+            with lock:
+                results.append(item)
+            return []
+
+        Pipeline(queue_size=queue_size) \
+            .add_stage('split', split, workers=workers) \
+            .add_stage('double', lambda item: [item * 2], workers=workers) \
+            .add_stage('collect', collect, workers=workers) \
+            .run(range(5))
+
+        assert sorted(results) == sorted([(i * 10 + j) * 2 for i in range(5) for j in range(2)])
+
+    def test_run__stage_exception(self) -> None:
+        results: List[int] = []
+
+        def fail_on_two(item: int) -> List[int]:
+            if item == 2:
+                raise Exception('two')
+            return [item]
+
+        pipeline: Pipeline = Pipeline(queue_size=1) \
+            .add_stage('fail', fail_on_two) \
+            .add_stage('collect', collector(results))
+        with LogCapture(level=logging.ERROR) as log:
+            pipeline.run(range(4))
+            assert LogCaptureHelper.check_contain(log, ('app.pipeline', 'ERROR',
+                                                        "Pipeline stage error. stage=fail, exception=('two',)"))
+
+        assert results == [0, 1, 3]
+        # The dropped item is counted, so the caller can keep its checkpoint
+        assert pipeline.errors == 1
+
+    def test_run__source_exception(self) -> None:
+        results: List[int] = []
+
+        def source() -> Iterator[int]:
+            yield 1
+            raise Exception('source')
+
+        with nose2.tools.such.helper.assertRaises(Exception):
+            Pipeline(queue_size=1).add_stage('collect', collector(results)).run(source())
+
+        assert results == [1]
+
+    def test_run__backpressure(self) -> None:
+        produced: List[int] = []
+        consumed: List[int] = []
+        max_backlog: List[int] = [0]
+
+        def source() -> Iterator[int]:
+            for i in range(20):
+                produced.append(i)
+                max_backlog[0] = max(max_backlog[0], len(produced) - len(consumed))
+                yield i
+
+        def slow(item: int) -> List[None]:
+            time.sleep(0.005)
+            consumed.append(item)
+            return []
+
+        Pipeline(queue_size=2).add_stage('slow', slow).run(source())
+
+        assert consumed == list(range(20))
+        # queue_size items are waiting, one is being processed and one is blocked in put()
+        assert max_backlog[0] <= 4
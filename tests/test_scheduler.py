@@ -0,0 +1,125 @@
+import os
+import random
+
+import nose2.tools
+from typing import List
+
+from app.scheduler import Scheduler
+from app.twitter import TwitterUser
+from tests.lib.utils import delete_env
+
+TEST_TWITTER_IDS = ['user1', 'user2', 'user3']
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now: float = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestScheduler:
+    clock: FakeClock
+    user_list: List[TwitterUser]
+
+    def setUp(self) -> None:
+        self.clear_env()
+        os.environ['INTERVAL_JITTER'] = '0'
+        self.clock = FakeClock()
+        self.user_list = [TwitterUser(id=user_id) for user_id in TEST_TWITTER_IDS]
+
+    def tearDown(self) -> None:
+        self.clear_env()
+
+    @staticmethod
+    def clear_env() -> None:
+        delete_env('INTERVAL')
+        delete_env('INTERVAL_MIN')
+        delete_env('INTERVAL_MAX')
+        delete_env('INTERVAL_JITTER')
+        delete_env('INTERVAL_EWMA_ALPHA')
+
+    def crawl(self, scheduler: Scheduler, new_media_counts: dict, crawl_seconds: float = 10) -> TwitterUser:
+        user, sleep_seconds = scheduler.next_user()
+        self.clock.now += sleep_seconds + crawl_seconds
+        scheduler.complete(user, new_media_counts[user.id])
+        return user
+
+    def test_next_user(self) -> None:
+        scheduler = Scheduler(self.user_list, clock=self.clock)
+
+        crawled_users = [self.crawl(scheduler, {user_id: 0 for user_id in TEST_TWITTER_IDS}).id for _ in range(6)]
+
+        assert crawled_users == TEST_TWITTER_IDS * 2
+        user, sleep_seconds = scheduler.next_user()
+        assert user.id == 'user1'
+        # user1 was due at 1000 + 300 and crawled for 10 seconds, then it is due at 1000 + 600
+        assert sleep_seconds == 1000 + 600 - self.clock.now
+
+    def test_complete__no_drift(self) -> None:
+        scheduler = Scheduler(self.user_list[:1], clock=self.clock)
+
+        for _ in range(10):
+            self.crawl(scheduler, {'user1': 0}, crawl_seconds=30)
+
+        # The crawl time does not push back the next due time
+        assert scheduler.get_schedule(self.user_list[0]).due_at == 1000 + 300 * 10
+
+    def test_complete__overrun(self) -> None:
+        scheduler = Scheduler(self.user_list[:1], clock=self.clock)
+
+        self.crawl(scheduler, {'user1': 0}, crawl_seconds=400)
+
+        assert scheduler.next_user()[1] == 0
+
+    def test_complete__adaptive(self) -> None:
+        scheduler = Scheduler(self.user_list, clock=self.clock)
+        new_media_counts = {'user1': 20, 'user2': 1, 'user3': 0}
+
+        for _ in range(60):
+            self.crawl(scheduler, new_media_counts)
+
+        intervals = {user.id: scheduler.get_schedule(user).interval_seconds for user in self.user_list}
+        assert 60 <= intervals['user1'] < intervals['user2'] < intervals['user3'] <= 3600
+        # A quiet user has half of the mean weight, so it waits twice the INTERVAL
+        assert intervals['user3'] == 600
+        rates = {user.id: scheduler.get_schedule(user).media_rate for user in self.user_list}
+        assert rates['user1'] > rates['user2'] > rates['user3'] == 0
+
+    @nose2.tools.params(
+        ('3', '8', 180, 480),
+        ('5', '5', 300, 300),
+    )
+    def test_complete__bounds(self, interval_min: str, interval_max: str, ans_min: int, ans_max: int) -> None:
+        os.environ['INTERVAL_MIN'] = interval_min
+        os.environ['INTERVAL_MAX'] = interval_max
+        scheduler = Scheduler(self.user_list, clock=self.clock)
+        new_media_counts = {'user1': 1000, 'user2': 0, 'user3': 0}
+
+        for _ in range(30):
+            self.crawl(scheduler, new_media_counts)
+
+        assert scheduler.get_schedule(self.user_list[0]).interval_seconds == ans_min
+        assert scheduler.get_schedule(self.user_list[1]).interval_seconds == ans_max
+
+    def test_complete__same_budget(self) -> None:
+        scheduler = Scheduler(self.user_list, clock=self.clock)
+        for user, count in zip(self.user_list, [3, 1, 2]):
+            scheduler.get_schedule(user).media_rate = count
+            scheduler.get_schedule(user).last_crawled_at = self.clock.now
+
+        # noinspection PyProtectedMember
+        intervals = [scheduler._make_interval(scheduler.get_schedule(user)) for user in self.user_list]
+
+        # The users are polled as often in total as with the flat interval
+        assert abs(sum(1 / interval for interval in intervals) - len(self.user_list) / 300) < 1e-9
+
+    def test_complete__jitter(self) -> None:
+        os.environ['INTERVAL_JITTER'] = '0.2'
+        scheduler = Scheduler(self.user_list, clock=self.clock, rand=random.Random(1))
+
+        intervals = {scheduler.complete(user, 0).interval_seconds for user in self.user_list}
+
+        assert len(intervals) == 3
+        assert all(240 <= interval <= 360 for interval in intervals)
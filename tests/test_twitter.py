@@ -10,7 +10,7 @@ from tweepy.models import ResultSet
 from unittest import mock
 
 from app.instagram import Instagram
-from app.twitter import Twitter, TwitterUser, TweetMedia
+from app.twitter import CrawlProgress, FavoriteSnapshot, Twitter, TwitterUser, TweetMedia
 from app.util import has_attributes
 from tests.lib.logcapture_helper import LogCaptureHelper
 from tests.lib.utils import load_json, delete_env
@@ -47,9 +47,7 @@ class TwitterTestUtils:
         json_path = f'{JSON_DIR}/twitter/target_tweet_medias/{json_name}.json'
         target_tweet_medias: dict = load_json(json_path)
 
-        return {tweet_id: TweetMedia(urls=media_info['urls'],
-                                     tweet=tweepy.Status.parse(tweepy.api, media_info['tweet']))
-                for tweet_id, media_info in target_tweet_medias.items()}
+        return {tweet_id: TweetMedia(**media_info) for tweet_id, media_info in target_tweet_medias.items()}
 
     @staticmethod
     def load_tweet(json_name: str) -> tweepy.Status:
@@ -65,13 +63,21 @@ class TestTweetMedia:
         target_tweet_medias: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(json_name=json_name)
         for _, tweet_media in target_tweet_medias.items():
             urls: List[str] = tweet_media.urls
-            tweet: tweepy.Status = tweet_media.tweet
-            msg = f'user_id={tweet.user.screen_name}, tweet_date={str(tweet.created_at)}, ' \
-                  f'permalink={Twitter.make_tweet_permalink(tweet)}, media_urls={urls}'
+            msg = f'user_id={tweet_media.screen_name}, tweet_date={tweet_media.created_at}, ' \
+                  f'permalink={tweet_media.permalink}, media_urls={urls}'
             with LogCapture() as log:
                 tweet_media.show_info()
                 log.check(('app.twitter', 'INFO', msg))
 
+    def test_from_status(self) -> None:
+        tweet: tweepy.Status = TwitterTestUtils.load_tweet(json_name='has_images')
+        tweet_media: TweetMedia = TweetMedia.from_status(['test.jpg'], tweet)
+
+        assert tweet_media == TweetMedia(urls=['test.jpg'], id_str=tweet.id_str, screen_name=tweet.user.screen_name,
+                                         user_name=tweet.user.name, full_text=tweet.full_text,
+                                         created_at=str(tweet.created_at))
+        assert not hasattr(tweet_media, '__dict__')
+
 
 @mock.patch('tweepy.Cursor', mock_cursor)
 @mock.patch('app.twitter.Instagram', mock_instagram)
@@ -258,13 +264,6 @@ class TestTwitter:
                f'@{tweet.user.screen_name}\n' \
                f'{tweet.full_text}' == description
 
-    def test_difference_tweet_medias(self) -> None:
-        old_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(json_name='old')
-        new_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(json_name='new')
-        target_tweet_medias: Dict[str, TweetMedia] = Twitter.difference_tweet_medias(new_tweets, old_tweets)
-
-        assert len(target_tweet_medias) == 1
-
     @nose2.tools.params(
         6,
     )
@@ -275,7 +274,8 @@ class TestTwitter:
         with LogCapture(level=logging.INFO) as log:
             target_tweet_medias: Dict[str, TweetMedia] = self.twitter.get_favorite_media(self.user)
             log.check(('app.twitter', 'INFO', f'Get favorite tweet media. user={self.user.id}. '
-                                              f'pages={self.twitter.tweet_page}, count={self.twitter.tweet_count}'))
+                                              f'pages={self.twitter.tweet_page}, count={self.twitter.tweet_count}'),
+                      ('app.twitter', 'INFO', f'Deep scan favorites. user={self.user.id}, scans=0'))
 
         assert len(target_tweet_medias) == count
         for tweet_id, tweet_media in target_tweet_medias.items():
@@ -325,6 +325,134 @@ class TestTwitter:
 
         assert len(target_tweet_medias) == 0
 
+    @nose2.tools.params(
+        ('rt', ['rt']),
+        ('fav', ['fav']),
+        ('rtfav', ['fav', 'rt']),
+        ('mixed', ['rt']),
+    )
+    def test_iter_target_tweet_pages(self, mode: str, page_types: List[str]) -> None:
+        self.mock_cursor.pages.side_effect = MockTweepyCursor.pages
+        self.twitter.mode = mode
+
+        pages = list(self.twitter.iter_target_tweet_pages(self.user))
+
+        assert [page_type for page_type, _ in pages] == page_types
+        for _, tweets in pages:
+            assert len(tweets) != 0
+
+    def test_iter_target_tweet_pages__since_id(self) -> None:
+        tweets: ResultSet = ResultSet(max_id=1, since_id=1234)
+        self.mock_cursor.pages.return_value = iter([tweets])
+        self.twitter.mode = 'rt'
+        progress: CrawlProgress = CrawlProgress(since_id=self.user.since_id)
+
+        assert list(self.twitter.iter_target_tweet_pages(self.user, progress)) == [('rt', tweets)]
+
+        # The user keeps the since_id until the crawler has stored the tweets
+        assert progress.since_id == 1234
+        assert self.user.since_id == 1
+
+    @staticmethod
+    def load_fav_pages(page_count: int) -> List[ResultSet]:
+        pages: List[ResultSet] = []
+        for _ in range(page_count):
+            tweets: ResultSet = ResultSet(max_id=1, since_id=1)
+            for tweet_dict in load_json(f'{JSON_DIR}/twitter/tweets/fav.json'):
+                tweets.append(tweepy.Status.parse(tweepy.api, tweet_dict))
+            pages.append(tweets)
+        return pages
+
+    @nose2.tools.params(
+        # fav_scans, known tweets in the snapshot, fav_known_run, page count
+        (0, 9, 20, 3),
+        (1, 9, 20, 1),
+        (1, 0, 20, 3),
+        (1, 5, 5, 1),
+        (1, 4, 5, 3),
+        (1, 9, 0, 3),
+        (24, 9, 20, 3),
+    )
+    def test_get_favorite_pages(self, fav_scans: int, known_count: int, fav_known_run: int, ans: int) -> None:
+        pages: List[ResultSet] = self.load_fav_pages(3)
+        self.mock_cursor.pages.return_value = iter(pages)
+        self.twitter.fav_known_run = fav_known_run
+        # The newest favorite is unknown, and the older ones are known
+        user = TwitterUser(id=TEST_TWITTER_ID, fav_scans=fav_scans,
+                           fav_snapshot=FavoriteSnapshot(tweet.id for tweet in pages[0][9 - known_count:]))
+
+        # noinspection PyProtectedMember
+        assert len(list(self.twitter._get_favorite_pages(user))) == ans
+
+    def test_get_favorite_pages__store(self) -> None:
+        self.mock_cursor.pages.return_value = iter(self.load_fav_pages(3))
+        self.twitter.known_tweet_ids = lambda tweet_ids: set(tweet_ids)
+        user = TwitterUser(id=TEST_TWITTER_ID, fav_scans=1)
+
+        with LogCapture(level=logging.INFO) as log:
+            # noinspection PyProtectedMember
+            assert len(list(self.twitter._get_favorite_pages(user))) == 1
+            log.check(('app.twitter', 'INFO', f'Stop favorite paging. user={TEST_TWITTER_ID}, page=1, known_run=9'))
+
+    @nose2.tools.params(
+        ('fav', 'fav', 6),
+        ('rt', 'timeline', 7),
+        ('rt', 'fav', 0),
+    )
+    def test_get_page_tweet_medias(self, page_type: str, json_name: str, count: int) -> None:
+        self.mock_instagram.get_media_urls.return_value = [INSTAGRAM_DUMMY_URL]
+        tweets = [tweepy.Status.parse(tweepy.api, tweet) for tweet in
+                  load_json(f'{JSON_DIR}/twitter/tweets/{json_name}.json')]
+
+        tweet_medias: Dict[str, TweetMedia] = self.twitter.get_page_tweet_medias(page_type, tweets)
+        assert len(tweet_medias) == count
+
+    def test_difference_last_favorites(self) -> None:
+        old_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(json_name='old')
+        new_tweets: Dict[str, TweetMedia] = TwitterTestUtils.load_target_media_tweets(json_name='new')
+        user = TwitterUser(id='test_user')
+        assert self.twitter.difference_last_favorites(user, new_tweets) == new_tweets
+
+        self.twitter.remember_favorites(user, old_tweets.keys())
+        assert len(self.twitter.difference_last_favorites(user, new_tweets)) == 1
+
+    def test_remember_favorites(self) -> None:
+        self.twitter.fav_deep_scan_cycles = 1
+        user = TwitterUser(id='test_user')
+        self.twitter.remember_favorites(user, ['3', '1', '2'])
+        snapshot: Optional[FavoriteSnapshot] = user.fav_snapshot
+        assert snapshot is not None and len(snapshot) == 3 and not snapshot.is_stored
+
+        snapshot.is_stored = True
+        self.twitter.remember_favorites(user, ['2', '3', '1'])
+        # The same favorites keep the stored snapshot
+        assert user.fav_snapshot is snapshot
+        self.twitter.remember_favorites(user, ['2', '3'])
+        assert user.fav_snapshot is not snapshot and len(user.fav_snapshot) == 2
+        assert user.fav_scans == 3
+
+    @nose2.tools.params(
+        (1, 3),
+        (24, 1),
+    )
+    def test_remember_favorites__merge(self, fav_scans: int, ans: int) -> None:
+        user = TwitterUser(id='test_user', fav_scans=fav_scans, fav_snapshot=FavoriteSnapshot([1, 2]))
+
+        self.twitter.remember_favorites(user, ['3'])
+
+        # A shallow scan adds to the snapshot, and a deep scan replaces it
+        assert user.fav_snapshot is not None and len(user.fav_snapshot) == ans and 3 in user.fav_snapshot
+
+    def test_favorite_snapshot(self) -> None:
+        snapshot = FavoriteSnapshot([1234567890123456789, 5, 5, 3])
+        restored = FavoriteSnapshot.from_bytes(snapshot.to_bytes())
+
+        assert len(snapshot.to_bytes()) == 3 * 8
+        assert restored == snapshot and restored.is_stored
+        assert 1234567890123456789 in restored and 3 in restored
+        assert 4 not in restored and 1234567890123456790 not in restored and '3' not in restored
+        assert 1 not in FavoriteSnapshot()
+
     @nose2.tools.params(
         ('rt', 7),
         ('fav', 6),
@@ -336,9 +464,13 @@ class TestTwitter:
         self.mock_cursor.pages.side_effect = MockTweepyCursor.pages
         self.mock_instagram.get_media_urls.return_value = [INSTAGRAM_DUMMY_URL]
         self.twitter.mode = mode
-        target_tweet_medias: Dict[str, TweetMedia] = self.twitter.get_target_tweets(self.user)
+        progress: CrawlProgress = CrawlProgress()
+        target_tweet_medias: Dict[str, TweetMedia] = self.twitter.get_target_tweets(self.user, progress)
 
         assert len(target_tweet_medias) == count
+        # The favorites are remembered by the crawler once their media are backed up
+        assert (len(progress.fav_tweet_ids) > 0) is ('fav' in mode)
+        assert self.user.fav_snapshot is None
         for tweet_id, tweet_media in target_tweet_medias.items():
             assert isinstance(tweet_id, str)
             assert isinstance(tweet_media, TweetMedia)
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from typing import List
+
+from app.store import Store
+
+# fetch_not_added_tweet_ids is called with a page of tweets
+PAGE_SIZE = 200
+
+
+def measure(db_url: str, count: int) -> List[float]:
+    """Return the rows per second of writing the tweets, finding the new ones, and writing the snapshots."""
+    os.environ['DATABASE_URL'] = db_url
+    store = Store()
+    tweet_ids: List[str] = [str(i) for i in range(count)]
+
+    def insert_tweets() -> None:
+        for tweet_id in tweet_ids:
+            store.insert_tweet_info(tweet_id, 'benchmark_user', '2020-01-01 00:00:00')
+        store.flush()
+
+    def fetch_not_added_tweet_ids() -> None:
+        for i in range(0, count, PAGE_SIZE):
+            store.fetch_not_added_tweet_ids(tweet_ids[i:i + PAGE_SIZE] + [f'new{i}'])
+
+    def upsert_since_ids() -> None:
+        for i in range(count):
+            store.upsert_since_id(f'benchmark_user{i % 10}', i)
+
+    rates: List[float] = []
+    for operation in [insert_tweets, fetch_not_added_tweet_ids, upsert_since_ids]:
+        started_at: float = time.perf_counter()
+        operation()
+        rates.append(count / (time.perf_counter() - started_at))
+    store.close()
+    return rates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the throughput of the Store backends')
+    parser.add_argument('-n', '--rows', type=int, default=10000, help='number of rows of each operation')
+    parser.add_argument('--postgres', help='url of an empty PostgreSQL database made from database.sql')
+    args = parser.parse_args()
+
+    db_dir: str = tempfile.mkdtemp()
+    db_urls: List[str] = [f'sqlite:///{db_dir}/benchmark.db']
+    if args.postgres:
+        db_urls.append(args.postgres)
+    print(f'rows={args.rows}')
+    print(f'{"backend":10} {"insert/s":>12} {"fetch/s":>12} {"upsert/s":>12}')
+    try:
+        for target_url in db_urls:
+            rates: List[float] = measure(target_url, args.rows)
+            print(f'{target_url.split(":")[0]:10} ' + ' '.join(f'{rate:12.0f}' for rate in rates))
+    finally:
+        shutil.rmtree(db_dir)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import argparse
+import copy
+import dataclasses
+import gc
+import os
+import tracemalloc
+import tweepy
+
+from typing import Callable, Dict, List
+
+from app.twitter import TweetMedia
+from tests.lib.utils import load_json
+
+JSON_DIR = f'{os.path.dirname(__file__)}/../json'
+MIB = 1024 * 1024
+
+
+@dataclasses.dataclass
+class StatusTweetMedia(object):
+    """TweetMedia before it was made compact, which kept the whole tweepy.Status."""
+    urls: List[str]
+    tweet: tweepy.Status
+
+
+def make_tweet_dicts(count: int) -> List[dict]:
+    tweets: List[dict] = load_json(f'{JSON_DIR}/twitter/tweets/fav.json')
+    tweet_dicts: List[dict] = []
+    for i in range(count):
+        tweet_dict: dict = copy.deepcopy(tweets[i % len(tweets)])
+        tweet_dict['id'] = i + 1
+        tweet_dict['id_str'] = str(i + 1)
+        tweet_dicts.append(tweet_dict)
+    return tweet_dicts
+
+
+def get_media_urls(tweet: tweepy.Status) -> List[str]:
+    extended_entities: dict = getattr(tweet, 'extended_entities', {})
+    return [media['media_url_https'] for media in extended_entities.get('media', [])]
+
+
+def measure(tweet_dicts: List[dict], make_media: Callable[[List[str], tweepy.Status], object]) -> float:
+    """Return the MiB still allocated for the tweet media of a cycle, after the API responses are freed."""
+    gc.collect()
+    tracemalloc.start()
+    tweet_medias: Dict[str, object] = {}
+    # The API response of each page is parsed and dropped, as tweepy.Cursor does
+    for tweet_dict in copy.deepcopy(tweet_dicts):
+        tweet: tweepy.Status = tweepy.Status.parse(tweepy.api, tweet_dict)
+        tweet_medias[tweet.id_str] = make_media(get_media_urls(tweet), tweet)
+    del tweet, tweet_dict
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / MIB
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the memory held by the tweet media of a cycle')
+    parser.add_argument('-n', '--tweets', type=int, default=5000, help='number of tweets in a cycle')
+    args = parser.parse_args()
+
+    target_tweet_dicts: List[dict] = make_tweet_dicts(args.tweets)
+    status_mib: float = measure(target_tweet_dicts, lambda urls, tweet: StatusTweetMedia(urls=urls, tweet=tweet))
+    compact_mib: float = measure(target_tweet_dicts, TweetMedia.from_status)
+    print(f'tweets={args.tweets}')
+    print(f'tweepy.Status  : {status_mib:8.2f} MiB')
+    print(f'TweetMedia     : {compact_mib:8.2f} MiB ({status_mib / compact_mib:.1f}x smaller)')
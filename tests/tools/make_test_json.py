@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import argparse
+import dataclasses
 import inspect
 import json
 import os
@@ -27,8 +28,8 @@ class TwitterJson:
 
     @staticmethod
     def json_dump_default(obj: object) -> Any:
-        if isinstance(obj, TweetMedia) and hasattr(obj, '__dict__'):
-            return obj.__dict__
+        if isinstance(obj, TweetMedia):
+            return dataclasses.asdict(obj)
         if isinstance(obj, tweepy.Status) and hasattr(obj, '_json'):
             # noinspection PyProtectedMember
             return obj._json